@@ -0,0 +1,306 @@
+"""
+Benchmark for the memory tool: latency percentiles and peak memory of the main
+MemoryFunctions operations and Tools methods on synthetic memory files.
+
+Runs without Open WebUI (only numpy and pydantic are needed); the tools get a
+stub __event_emitter__. Results are printed as JSON so runs can be compared
+across commits:
+
+    python benchmark.py --sizes 1000,10000 --output bench_output.txt
+    python benchmark.py --sizes 1000000 --repeat 3 --backend binary
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import datetime
+import tempfile
+import tracemalloc
+import subprocess
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# A vocabulary about as varied as real notes: a few common words plus a few
+# thousand made-up ones, so memos do not share most of their character 4-grams
+# (which would make every lookup in the near-duplicate index a false candidate).
+COMMON_WORDS = (
+    "the a to of and in on for with at my is was will need remember about from"
+).split()
+SYLLABLES = (
+    "ba be bi bo bu da de di do du ka ke ki ko ku la le li lo lu ma me mi mo "
+    "mu na ne ni no nu ra re ri ro ru sa se si so su ta te ti to tu"
+).split()
+WORDS = sorted(
+    {
+        "".join(random.Random(seed).choices(SYLLABLES, k=3 + seed % 2))
+        for seed in range(4000)
+    }
+)
+TAGS = ["personal", "work", "education", "life", "person", "others"]
+
+
+def load_tool_module():
+    """Import gpt4-memory-mimic.py, whose file name is not a valid module name."""
+    path = os.path.join(HERE, "gpt4-memory-mimic.py")
+    spec = importlib.util.spec_from_file_location("gpt4_memory_mimic", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_memo(rng: random.Random, number: int) -> str:
+    words = [
+        rng.choice(COMMON_WORDS) if rng.random() < 0.4 else rng.choice(WORDS)
+        for _ in range(rng.randint(6, 18))
+    ]
+    # The number keeps memos distinct, so duplicate detection never skips them.
+    return f"{' '.join(words).capitalize()} (note {number})."
+
+
+def synthetic_entry(rng: random.Random, number: int, start: datetime.datetime):
+    stamp = start + datetime.timedelta(minutes=number)
+    return {
+        "tag": rng.choice(TAGS),
+        "memo": synthetic_memo(rng, number),
+        "by": rng.choice(["user", "LLM"]),
+        "last_modified": stamp.strftime("%Y-%m-%d_%H:%M:%S"),
+    }
+
+
+def generate_memory_file(module, backend: str, path: str, size: int, seed: int):
+    """Write a memory file of size entries straight through the storage backend."""
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1)
+    memory_data = {
+        number: synthetic_entry(rng, number, start) for number in range(1, size + 1)
+    }
+    storage_class = module.STORAGE_BACKENDS[backend]
+    storage = storage_class(storage_class.path_for(path), journal=True)
+    storage.next_id = size + 1
+    storage.save(memory_data)
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def measure(operation, repeat: int, setup=None) -> dict:
+    """
+    Time repeat calls of operation, then run it once more under tracemalloc for
+    its peak allocation; tracing is kept out of the timed calls as it slows
+    Python code down several times over.
+    """
+    samples = []
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        started = time.perf_counter()
+        operation(argument)
+        samples.append((time.perf_counter() - started) * 1000)
+    argument = setup() if setup else None
+    tracemalloc.start()
+    try:
+        operation(argument)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "samples": len(samples),
+        "mean_ms": round(sum(samples) / len(samples), 3),
+        "p50_ms": round(percentile(samples, 0.5), 3),
+        "p90_ms": round(percentile(samples, 0.9), 3),
+        "p99_ms": round(percentile(samples, 0.99), 3),
+        "max_ms": round(max(samples), 3),
+        "peak_bytes": peak,
+    }
+
+
+async def stub_event_emitter(event: dict):
+    """Stands in for Open WebUI's __event_emitter__ and drops every event."""
+
+
+def benchmark_size(module, backend: str, size: int, repeat: int, batch: int, seed):
+    """Run every benchmark against fresh memory files of size entries."""
+    directory = "memory_jsons"
+    os.makedirs(directory, exist_ok=True)
+    for name in ("memory.json", "other.json"):
+        generate_memory_file(module, backend, os.path.join(directory, name), size, seed)
+
+    tools = module.Tools()
+    tools.valves.DEBUG = False
+    tools.valves.PER_USER_MEMORY = False
+    tools.valves.STORAGE_BACKEND = backend
+    tools.valves.MEMORY_REFRESH_INTERVAL = 0
+    loop = asyncio.new_event_loop()
+    run = loop.run_until_complete
+    counter = iter(range(size + 1, sys.maxsize))
+    rng = random.Random(seed + 1)
+    results = {}
+
+    def options():
+        return {"directory": directory, "backend": backend}
+
+    # Raw storage read, then the full open that also builds every index.
+    memory = module.MemoryFunctions(**options())
+    results["load_memory"] = measure(lambda _: memory.load_memory(), repeat)
+    results["open_memory_file"] = measure(
+        lambda _: module.MemoryFunctions(**options()), repeat
+    )
+    results["add_to_memory"] = measure(
+        lambda _: memory.add_to_memory(
+            "work", synthetic_memo(rng, next(counter)), "user"
+        ),
+        repeat,
+    )
+    results["reindex_memory"] = measure(lambda _: memory.reindex_memory(), repeat)
+    # Alternating between two files: the second and later switches hit the cache.
+    names = iter(["other.json", "memory.json"] * (repeat + 1))
+    results["switch_memory_file"] = measure(
+        lambda _: memory.switch_memory_file(next(names)), repeat
+    )
+    memory.cache.max_files = 0
+    results["switch_memory_file_uncached"] = measure(
+        lambda _: memory.switch_memory_file(next(names)), repeat
+    )
+    memory.close()
+
+    def call(method, **kwargs):
+        return run(method(__event_emitter__=stub_event_emitter, **kwargs))
+
+    def new_entries(_=None):
+        return [
+            {"tag": "life", "memo": synthetic_memo(rng, next(counter)), "by": "LLM"}
+            for _ in range(batch)
+        ]
+
+    def some_indices(_=None):
+        return rng.sample(range(1, len(tools.memory.memory_data) + 1), batch)
+
+    results["batch_add"] = measure(
+        lambda entries: call(
+            tools.add_multiple_memories, memory_entries=entries, llm_wants_to_add=True
+        ),
+        repeat,
+        setup=new_entries,
+    )
+    results["batch_update"] = measure(
+        lambda indices: call(
+            tools.update_multiple_memories,
+            memory_updates=[
+                {"index": index, "tag": "work", "memo": memo["memo"], "by": "user"}
+                for index, memo in zip(indices, new_entries())
+            ],
+            llm_wants_to_update=True,
+        ),
+        repeat,
+        setup=some_indices,
+    )
+    results["batch_delete"] = measure(
+        lambda indices: call(
+            tools.delete_multiple_memories, indices=indices, llm_wants_to_delete=True
+        ),
+        repeat,
+        setup=some_indices,
+    )
+    results["recall_memories"] = measure(lambda _: call(tools.recall_memories), repeat)
+    # What download_memory streams to the client for download_all.
+    memory = tools.memory
+    results["download_memory_tarball"] = measure(
+        lambda _: sum(
+            len(chunk)
+            for chunk in memory.stream_tarball(["memory.json", "other.json"], 0)
+        ),
+        repeat,
+    )
+
+    for closing in tools._stores.retire_all():
+        closing.close()
+    if tools._maintenance is not None:
+        tools._maintenance.cancel()
+        run(asyncio.gather(tools._maintenance, return_exceptions=True))
+    if tools._io is not None:
+        tools._io.shutdown()
+    loop.close()
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000,100000",
+        help="Comma-separated memory file sizes; add 1000000 for the largest run.",
+    )
+    parser.add_argument("--repeat", type=int, default=20, help="Samples per benchmark.")
+    parser.add_argument(
+        "--batch", type=int, default=100, help="Entries per batch add/update/delete."
+    )
+    parser.add_argument(
+        "--backend", default="json", choices=["json", "binary", "sqlite"]
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON here instead of stdout.")
+    arguments = parser.parse_args()
+
+    module = load_tool_module()
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": arguments.backend,
+        "repeat": arguments.repeat,
+        "batch": arguments.batch,
+        "seed": arguments.seed,
+        "results": {},
+    }
+    cwd = os.getcwd()
+    for size in (int(size) for size in arguments.sizes.split(",")):
+        # Tools keeps its files under ./memory_jsons, so every size runs in a
+        # scratch directory of its own.
+        with tempfile.TemporaryDirectory() as scratch:
+            os.chdir(scratch)
+            try:
+                report["results"][str(size)] = benchmark_size(
+                    module,
+                    arguments.backend,
+                    size,
+                    arguments.repeat,
+                    arguments.batch,
+                    arguments.seed,
+                )
+            finally:
+                os.chdir(cwd)
+        print(f"Finished {size} entries.", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Compare the storage backends: load time, size on disk, peak resident memory
+and the time to count memories per tag (what list_memory_files needs for a
+file that is not open) for memory files of json, binary and sqlite.
+
+Every load runs in a fresh Python process, so the peak RSS of one backend is
+not inflated by another. Results are printed as JSON:
+
+    python format_comparison.py --sizes 10000,100000,1000000
+    python format_comparison.py --sizes 10000 --backends binary,sqlite --repeat 10
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+try:
+    import resource
+except ImportError:  # Windows: no getrusage, so no peak RSS.
+    resource = None
+
+from benchmark import generate_memory_file, git_commit, load_tool_module, percentile
+
+BACKENDS = ["json", "binary", "sqlite"]
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes, or None."""
+    # getrusage keeps the peak of the parent across fork and exec on Linux, so
+    # read the kernel's own high-water mark, which starts afresh with exec.
+    try:
+        with open("/proc/self/status", encoding="ascii") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def timings(samples: list) -> dict:
+    return {
+        "mean_ms": round(sum(samples) / len(samples), 3),
+        "p50_ms": round(percentile(samples, 0.5), 3),
+        "max_ms": round(max(samples), 3),
+    }
+
+
+def measure_file(backend: str, memory_file: str, repeat: int) -> dict:
+    """Load memory_file repeat times through its backend; runs in the child."""
+    module = load_tool_module()
+    storage_class = module.STORAGE_BACKENDS[backend]
+    rss_before = peak_rss()
+    loads, counts = [], []
+    for _ in range(repeat):
+        storage = storage_class(storage_class.path_for(memory_file))
+        started = time.perf_counter()
+        memory_data = storage.load()
+        loads.append((time.perf_counter() - started) * 1000)
+        entries = len(memory_data)
+        # Drop the set before the next load, as a switch to another file would.
+        del memory_data
+        started = time.perf_counter()
+        storage.tag_counts()
+        counts.append((time.perf_counter() - started) * 1000)
+        storage.close()
+    rss_after = peak_rss()
+    return {
+        "entries": entries,
+        "file_bytes": sum(size for _, _, size in storage.signature()),
+        "load": timings(loads),
+        "tag_counts": timings(counts),
+        "peak_rss_bytes": rss_after,
+        # The peak minus what importing the tool (numpy, pydantic) already took.
+        "load_rss_bytes": None if rss_before is None else rss_after - rss_before,
+    }
+
+
+def compare_size(module, backends: list, size: int, repeat: int, seed: int) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        for backend in backends:
+            memory_file = os.path.join(scratch, f"{backend}.json")
+            generate_memory_file(module, backend, memory_file, size, seed)
+            child = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--child",
+                    backend,
+                    memory_file,
+                    str(repeat),
+                ],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            results[backend] = json.loads(child.stdout)
+            print(f"Finished {backend} at {size} entries.", file=sys.stderr)
+    return results
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--child":
+        _, _, backend, memory_file, repeat = sys.argv
+        print(json.dumps(measure_file(backend, memory_file, int(repeat))))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes", default="10000,100000,1000000", help="Comma-separated sizes."
+    )
+    parser.add_argument(
+        "--backends", default=",".join(BACKENDS), help="Comma-separated backends."
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Loads per file.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON here instead of stdout.")
+    arguments = parser.parse_args()
+
+    module = load_tool_module()
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": arguments.repeat,
+        "seed": arguments.seed,
+        "results": {},
+    }
+    for size in (int(size) for size in arguments.sizes.split(",")):
+        report["results"][str(size)] = compare_size(
+            module,
+            arguments.backends.split(","),
+            size,
+            arguments.repeat,
+            arguments.seed,
+        )
+
+    output = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
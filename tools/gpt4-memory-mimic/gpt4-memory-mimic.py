@@ -3,83 +3,4916 @@ title: Memory Enhancement Tool for LLM Web UI
 author: https://github.com/mhioi
 version: 1.5.0
 license: MIT
+requirements: numpy
 """
 
 import os
+import re
 import json
+import io
+import logging
+import inspect
+import math
+import heapq
+import zlib
+import itertools
+import bisect
+import sqlite3
+import mmap
+import struct
+from collections import OrderedDict
 from typing import Callable, Any
 import asyncio
 import datetime
 from pydantic import BaseModel, Field
+import numpy as np
 import tarfile
 import socket
 import threading
-from http.server import SimpleHTTPRequestHandler
-from socketserver import TCPServer
+import gzip
+import hmac
+import hashlib
+import secrets
+import base64
+import time
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import functools
+import contextvars
+import multiprocessing
+import sys
+import weakref
+import errno
+import gc
+
+try:
+    import fcntl
+except ImportError:  # Windows: advisory locking is skipped
+    fcntl = None
+
+# Undo marker for a transaction that cleared every entry at once.
+_ALL_ENTRIES = object()
+
+# (id of the Tools instance, task) holding a memory session, so that the same
+# task can nest sessions without waiting for itself.
+_session_owner = contextvars.ContextVar("memory_session_owner", default=None)
+
+
+# A memory file name as tools accept it: a plain "<name>.json" inside the
+# store's directory, without separators, a leading dot or "..".
+_FILE_NAME = re.compile(r"[^/\\\0.][^/\\\0]{0,200}\.json")
+
+
+def _check_file_name(file_name: str) -> str:
+    """Return file_name if it names a memory file in a directory, else raise ValueError."""
+    if (
+        not isinstance(file_name, str)
+        or not _FILE_NAME.fullmatch(file_name)
+        or ".." in file_name
+    ):
+        raise ValueError(f"Invalid memory file name: {file_name!r}")
+    return file_name
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w", **kwargs):
+    """
+    Write a file through a temporary sibling that replaces it only once it is
+    complete, so a crash mid-write never leaves a truncated file behind.
+    """
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporary, mode, **kwargs) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+@contextmanager
+def file_lock(path: str):
+    """Hold an exclusive advisory lock on path; a no-op where fcntl is missing."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _file_identity(path: str):
+    """Inode, mtime and size of a file, or None when it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class _Span:
+    """A timed operation; reported to the sinks when it ends."""
+
+    __slots__ = ("telemetry", "name", "fields", "started")
+
+    def __init__(self, telemetry: "MemoryTelemetry", name: str, fields: dict):
+        self.telemetry = telemetry
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        record = {
+            "type": "span",
+            "name": self.name,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "ok": kind is None,
+        }
+        if kind is not None:
+            record["error"] = kind.__name__
+        record.update(self.fields)
+        self.telemetry.emit(record)
+        return False
+
+    def set(self, **fields):
+        """Attach fields known only once the operation is under way."""
+        self.fields.update(fields)
+
+
+class _NoSpan:
+    """Stands in for every span while telemetry is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class MemoryTelemetry:
+    """
+    Spans around tool, storage and event emitter calls, plus debug events, handed
+    to pluggable sinks (LoggingSink, JsonlSink, PrometheusSink).
+
+    Without sinks a span is a shared no-op object and log() returns at its first
+    check, so the instrumentation costs next to nothing when off. Text fields are
+    cut to max_payload characters: memos and user input never reach a sink whole.
+    """
+
+    def __init__(self, sinks: list = None, debug: bool = False, max_payload: int = 200):
+        self.sinks = list(sinks or [])
+        self.debug = debug
+        self.max_payload = max_payload
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sinks)
+
+    def configure(self, sinks: list, debug: bool, max_payload: int):
+        """Swap in new sinks, closing the ones that are replaced."""
+        previous, self.sinks = self.sinks, list(sinks)
+        self.debug = debug
+        self.max_payload = max_payload
+        for sink in previous:
+            sink.close()
+
+    def span(self, name: str, **fields):
+        if not self.sinks:
+            return _NO_SPAN
+        return _Span(self, name, fields)
+
+    def log(self, message: str, **fields):
+        """A debug event, dropped unless debug is on."""
+        if not (self.debug and self.sinks):
+            return
+        self.emit({"type": "event", "message": message, **fields})
+
+    def emit(self, record: dict):
+        record = {key: self._cap(value) for key, value in record.items()}
+        record["time"] = time.time()
+        for sink in self.sinks:
+            try:
+                sink.emit(record)
+            except Exception:
+                # A broken sink must never fail the call it observes.
+                continue
+
+    def _cap(self, value):
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        text = value if isinstance(value, str) else repr(value)
+        if len(text) > self.max_payload:
+            text = f"{text[: self.max_payload]}… ({len(text)} chars)"
+        return text
+
+
+class LoggingSink:
+    """Telemetry records as JSON on the "gpt4_memory_mimic" logger."""
+
+    def __init__(self, logger: logging.Logger = None):
+        self.logger = logger or logging.getLogger("gpt4_memory_mimic")
+
+    def emit(self, record: dict):
+        self.logger.info(json.dumps(record, ensure_ascii=False))
+
+    def close(self):
+        pass
+
+
+class JsonlSink:
+    """
+    Telemetry records appended to a JSONL file, which is rotated to "<path>.1"
+    once it grows past max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 16 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.file = None
+
+    def emit(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write(line)
+            self.file.flush()
+            if self.file.tell() > self.max_bytes:
+                self.file.close()
+                self.file = None
+                os.replace(self.path, self.path + ".1")
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class PrometheusSink:
+    """
+    Per-span call, error and duration counters, written in the Prometheus text
+    format to a file (e.g. for node_exporter's textfile collector) at most every
+    interval seconds. Debug events are only counted.
+    """
+
+    def __init__(self, path: str, interval: float = 15):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.spans = {}  # span name -> [calls, errors, seconds]
+        self.events = 0
+        self.written = 0.0
+
+    def emit(self, record: dict):
+        with self.lock:
+            if record["type"] == "span":
+                counters = self.spans.setdefault(record["name"], [0, 0, 0.0])
+                counters[0] += 1
+                counters[1] += not record["ok"]
+                counters[2] += record["duration_ms"] / 1000
+            else:
+                self.events += 1
+            if time.monotonic() - self.written >= self.interval:
+                self._write()
+
+    def render(self) -> str:
+        lines = []
+        for metric, position, description in (
+            ("memory_tool_calls_total", 0, "Completed operations."),
+            ("memory_tool_errors_total", 1, "Operations that raised."),
+            ("memory_tool_seconds_total", 2, "Time spent in operations."),
+        ):
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, counters in sorted(self.spans.items()):
+                lines.append(f'{metric}{{span="{name}"}} {counters[position]}')
+        lines.append("# HELP memory_tool_debug_events_total Debug events logged.")
+        lines.append("# TYPE memory_tool_debug_events_total counter")
+        lines.append(f"memory_tool_debug_events_total {self.events}")
+        return "\n".join(lines) + "\n"
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with atomic_write(self.path, encoding="utf-8") as file:
+            file.write(self.render())
+        self.written = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self._write()
+
+
+class MemoryTextIndex:
+    """In-process inverted index over the ``memo`` field with BM25 ranking."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, vocabulary: set = None):
+        self.k1 = k1
+        self.b = b
+        # Only keep postings for these terms; for a throwaway index that answers
+        # a single query.
+        self.vocabulary = vocabulary
+        self.clear()
+
+    @staticmethod
+    def tokenize(text: str) -> list:
+        return re.findall(r"\w+", text.lower())
+
+    def clear(self):
+        self.postings = {}  # term -> {memory index: term frequency}
+        self.doc_lengths = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def rebuild(self, memory_data: dict):
+        self.clear()
+        for index, entry in memory_data.items():
+            self.add(index, entry)
+
+    def add(self, index, entry: dict):
+        tokens = self.tokenize(entry.get("memo", ""))
+        counts = {}
+        for token in tokens:
+            if self.vocabulary is None or token in self.vocabulary:
+                counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            self.postings.setdefault(token, {})[index] = count
+        self.doc_lengths[index] = len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, index, entry: dict):
+        if index not in self.doc_lengths:
+            return
+        for token in set(self.tokenize(entry.get("memo", ""))):
+            posting = self.postings.get(token)
+            if posting is not None:
+                posting.pop(index, None)
+                if not posting:
+                    del self.postings[token]
+        self.total_length -= self.doc_lengths.pop(index)
+
+    def replace(self, index, previous: dict, entry: dict):
+        self.remove(index, previous)
+        self.add(index, entry)
+
+    def search(self, query: str, top_k: int = 5, where: Callable = None) -> list:
+        """
+        Rank entries against a query.
+
+        :param where: Optional predicate on the memory index to restrict the results.
+        :return: A list of (index, score) tuples, best match first.
+        """
+        doc_count = len(self.doc_lengths)
+        if not doc_count:
+            return []
+        average_length = self.total_length / doc_count or 1.0
+        scores = {}
+        for token in set(self.tokenize(query)):
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            df = len(posting)
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            for index, tf in posting.items():
+                norm = self.k1 * (
+                    1 - self.b + self.b * self.doc_lengths[index] / average_length
+                )
+                scores[index] = scores.get(index, 0.0) + idf * tf * (self.k1 + 1) / (
+                    tf + norm
+                )
+        if where is not None:
+            scores = {index: score for index, score in scores.items() if where(index)}
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+
+class MemoryVectorIndex:
+    """
+    Local semantic index: each memo is embedded by hashing its character n-grams
+    into a fixed-width float32 vector, and the vectors live in one contiguous
+    matrix so a query is a single matrix-vector product.
+
+    The matrix is saved next to the memory file and reused on load, so only
+    entries whose memo changed since the last save are embedded again.
+    """
+
+    def __init__(self, dimensions: int = 256, ngram_sizes: tuple = (3, 4)):
+        self.dimensions = dimensions
+        self.ngram_sizes = ngram_sizes
+        self.path = None
+        self.clear()
+
+    def embed(self, text: str):
+        padded = f" {' '.join(MemoryTextIndex.tokenize(text))} "
+        hashes = [
+            zlib.crc32(padded[i : i + n].encode("utf-8"))
+            for n in self.ngram_sizes
+            for i in range(len(padded) - n + 1)
+        ]
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        if hashes:
+            hashes = np.array(hashes, dtype=np.uint32)
+            # The top bit picks the sign so colliding n-grams tend to cancel out.
+            signs = np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)
+            np.add.at(vector, hashes % self.dimensions, signs)
+            norm = np.linalg.norm(vector)
+            if norm:
+                vector /= norm
+        return vector
+
+    @staticmethod
+    def checksum(entry: dict) -> int:
+        return zlib.crc32(entry.get("memo", "").encode("utf-8"))
+
+    def clear(self):
+        self.matrix = np.zeros((0, self.dimensions), dtype=np.float32)
+        self.checksums = np.zeros(0, dtype=np.uint32)
+        self.keys = []  # row -> memory index
+        self.rows = {}  # memory index -> row
+        self.dirty = True
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _reserve(self, size: int):
+        if size <= len(self.matrix):
+            return
+        capacity = max(size, 2 * len(self.matrix), 64)
+        matrix = np.zeros((capacity, self.dimensions), dtype=np.float32)
+        matrix[: len(self.keys)] = self.matrix[: len(self.keys)]
+        checksums = np.zeros(capacity, dtype=np.uint32)
+        checksums[: len(self.keys)] = self.checksums[: len(self.keys)]
+        self.matrix, self.checksums = matrix, checksums
+
+    def rebuild(self, memory_data: dict):
+        self.clear()
+        saved_rows = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with np.load(self.path) as saved:
+                    saved_vectors = saved["vectors"]
+                    saved_checksums = saved["checksums"]
+                    saved_keys = saved["keys"]
+                if saved_vectors.shape[1] == self.dimensions:
+                    saved_rows = {int(key): row for row, key in enumerate(saved_keys)}
+            except (OSError, ValueError, KeyError):
+                saved_rows = {}
+
+        self._reserve(len(memory_data))
+        reuse_from, reuse_to = [], []
+        for row, (index, entry) in enumerate(memory_data.items()):
+            checksum = self.checksum(entry)
+            saved_row = saved_rows.get(index)
+            if saved_row is not None and saved_checksums[saved_row] == checksum:
+                reuse_from.append(saved_row)
+                reuse_to.append(row)
+            else:
+                self.matrix[row] = self.embed(entry.get("memo", ""))
+            self.checksums[row] = checksum
+            self.keys.append(index)
+            self.rows[index] = row
+        if reuse_from:
+            self.matrix[reuse_to] = saved_vectors[reuse_from]
+        self.dirty = len(reuse_from) != len(memory_data) or len(saved_rows) != len(
+            memory_data
+        )
+
+    def add(self, index, entry: dict):
+        row = self.rows.get(index)
+        if row is None:
+            row = len(self.keys)
+            self._reserve(row + 1)
+            self.keys.append(index)
+            self.rows[index] = row
+        self.matrix[row] = self.embed(entry.get("memo", ""))
+        self.checksums[row] = self.checksum(entry)
+        self.dirty = True
+
+    def replace(self, index, previous: dict, entry: dict):
+        self.add(index, entry)
+
+    def remove(self, index, entry: dict):
+        row = self.rows.pop(index, None)
+        if row is None:
+            return
+        # Move the last row into the hole so the matrix stays contiguous.
+        last = len(self.keys) - 1
+        if row != last:
+            moved = self.keys[last]
+            self.matrix[row] = self.matrix[last]
+            self.checksums[row] = self.checksums[last]
+            self.keys[row] = moved
+            self.rows[moved] = row
+        self.keys.pop()
+        self.dirty = True
+
+    def save(self):
+        if not (self.path and self.dirty):
+            return
+        size = len(self.keys)
+        with atomic_write(self.path, "wb") as file:
+            np.savez(
+                file,
+                vectors=self.matrix[:size],
+                checksums=self.checksums[:size],
+                keys=np.array(self.keys, dtype=np.int64),
+            )
+        self.dirty = False
+
+    def search(self, query: str, top_k: int = 5, where: Callable = None) -> list:
+        """Return (index, cosine similarity) tuples for the closest memos."""
+        size = len(self.keys)
+        if not size or top_k <= 0:
+            return []
+        scores = self.matrix[:size] @ self.embed(query)
+        if where is None and top_k < size:
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+            order = candidates[np.argsort(-scores[candidates])]
+        else:
+            order = np.argsort(-scores)
+        results = []
+        for row in order:
+            index = self.keys[row]
+            if where is None or where(index):
+                results.append((index, float(scores[row])))
+                if len(results) == top_k:
+                    break
+        return results
+
+
+class MemoryTagIndex:
+    """Per-tag posting lists, so one category can be read without scanning the file."""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.buckets = {}  # tag -> {memory index: None}, kept in insertion order
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def rebuild(self, memory_data: dict):
+        self.clear()
+        for index, entry in memory_data.items():
+            self.add(index, entry)
+
+    def add(self, index, entry: dict):
+        self.buckets.setdefault(entry.get("tag", "others"), {})[index] = None
+
+    def remove(self, index, entry: dict):
+        tag = entry.get("tag", "others")
+        bucket = self.buckets.get(tag)
+        if bucket is not None:
+            bucket.pop(index, None)
+            if not bucket:
+                del self.buckets[tag]
+
+    def replace(self, index, previous: dict, entry: dict):
+        # Keep the position of entries whose tag did not change.
+        if previous.get("tag", "others") != entry.get("tag", "others"):
+            self.remove(index, previous)
+            self.add(index, entry)
+
+    def bucket(self, tag: str) -> dict:
+        return self.buckets.get(tag, {})
+
+    def counts(self) -> dict:
+        return {tag: len(bucket) for tag, bucket in self.buckets.items()}
+
+
+class MemoryOrderIndex:
+    """
+    Memory ids in ascending order, for stable cursor pagination and for the
+    1-based ordinals (first memory, second memory, ...) shown to the LLM.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ids = []  # sorted memory ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def rebuild(self, memory_data: dict):
+        self.ids = sorted(memory_data)
+
+    def add(self, index, entry: dict):
+        # New ids are always the largest, so this is an append in practice.
+        if not self.ids or index > self.ids[-1]:
+            self.ids.append(index)
+        else:
+            position = bisect.bisect_left(self.ids, index)
+            if position == len(self.ids) or self.ids[position] != index:
+                self.ids.insert(position, index)
+
+    def remove(self, index, entry: dict):
+        position = bisect.bisect_left(self.ids, index)
+        if position < len(self.ids) and self.ids[position] == index:
+            del self.ids[position]
+
+    def replace(self, index, previous: dict, entry: dict):
+        pass
+
+    def id_at(self, ordinal: int):
+        """The memory id at a 1-based ordinal, or None when out of range."""
+        if 1 <= ordinal <= len(self.ids):
+            return self.ids[ordinal - 1]
+        return None
+
+    def ordinal(self, index: int) -> int:
+        return bisect.bisect_left(self.ids, index) + 1
+
+    def after(self, cursor: int = None):
+        """Iterate over (ordinal, id) pairs for the ids after a cursor id."""
+        start = 0 if cursor is None else bisect.bisect_right(self.ids, cursor)
+        for offset, index in enumerate(
+            itertools.islice(self.ids, start, None), start + 1
+        ):
+            yield offset, index
+
+
+class MemoryTimeIndex:
+    """
+    Memory ids ordered by last_modified, parsed once into epoch seconds, for
+    "most recent" and time range queries in O(log n + k).
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.entries = []  # sorted (epoch seconds, memory index)
+        self.times = {}  # memory index -> epoch seconds
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    @staticmethod
+    def timestamp(text) -> int:
+        """A "%Y-%m-%d_%H:%M:%S" (or ISO) time in epoch seconds; 0 if malformed."""
+        try:
+            return int(
+                datetime.datetime.fromisoformat(str(text).replace("_", " ")).timestamp()
+            )
+        except ValueError:
+            return 0
+
+    def rebuild(self, memory_data: dict):
+        self.times = {
+            index: self.timestamp(entry.get("last_modified"))
+            for index, entry in memory_data.items()
+        }
+        self.entries = sorted((stamp, index) for index, stamp in self.times.items())
+
+    def add(self, index, entry: dict):
+        stamp = self.timestamp(entry.get("last_modified"))
+        self.times[index] = stamp
+        # Memories are mostly written with the current time: an append.
+        if not self.entries or (stamp, index) > self.entries[-1]:
+            self.entries.append((stamp, index))
+        else:
+            bisect.insort(self.entries, (stamp, index))
+
+    def remove(self, index, entry: dict):
+        stamp = self.times.pop(index, None)
+        if stamp is None:
+            return
+        position = bisect.bisect_left(self.entries, (stamp, index))
+        if position < len(self.entries) and self.entries[position] == (stamp, index):
+            del self.entries[position]
+
+    def replace(self, index, previous: dict, entry: dict):
+        self.remove(index, previous)
+        self.add(index, entry)
+
+    def latest(self, count: int) -> list:
+        """The memory indices of the count most recently changed memories, newest first."""
+        return [index for _, index in reversed(self.entries[-count:])] if count else []
+
+    def _span(self, start: int = None, end: int = None) -> tuple:
+        low = 0 if start is None else bisect.bisect_left(self.entries, (start,))
+        high = (
+            len(self.entries)
+            if end is None
+            else bisect.bisect_right(self.entries, (end, math.inf))
+        )
+        return low, max(low, high)
+
+    def count(self, start: int = None, end: int = None) -> int:
+        low, high = self._span(start, end)
+        return high - low
+
+    def between(self, start: int = None, end: int = None, last: int = None) -> list:
+        """
+        Memory indices changed within [start, end] epoch seconds, oldest first;
+        only the last (most recent) ones when last is given.
+        """
+        low, high = self._span(start, end)
+        if last is not None:
+            low = max(low, high - last)
+        return [index for _, index in self.entries[low:high]]
+
+
+class MemoryDuplicateIndex:
+    """
+    Near-duplicate lookup over the ``memo`` field.
+
+    Each memo is reduced to a MinHash signature of its character 4-gram
+    shingles, and the signature is cut into bands that key hash buckets (LSH
+    banding). A lookup only compares against memos sharing at least one band,
+    which for two memos with shingle Jaccard similarity s happens with
+    probability 1 - (1 - s**rows)**bands: about 0.99 at 0.6 and 0.02 at 0.1.
+    Candidates are then checked against their exact similarity.
+
+    Like the vectors, the signatures are saved next to the memory file and
+    reused on load for every memo that did not change since the last save.
+    """
+
+    def __init__(self, bands: int = 20, rows: int = 3, shingle_size: int = 4):
+        self.bands = bands
+        self.rows = rows
+        self.shingle_size = shingle_size
+        # Multiply-shift hash functions; odd multipliers keep them universal.
+        rng = np.random.default_rng(0x6D656D6F)
+        self.multipliers = rng.integers(
+            1, 2**63, bands * rows, dtype=np.uint64
+        ) | np.uint64(1)
+        self.increments = rng.integers(0, 2**63, bands * rows, dtype=np.uint64)
+        self._last_keys = (None, None)
+        self.path = None
+        self.clear()
+
+    def clear(self):
+        self.signatures = {}  # memory index -> band keys, None for an empty memo
+        self.buckets = {}  # band key -> {memory index: None}
+        self.checksums = {}  # memory index -> checksum of the memo it was built from
+        self.dirty = True
+
+    @staticmethod
+    def checksum(entry: dict) -> int:
+        return zlib.crc32(str(entry.get("memo", "")).encode("utf-8"))
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def shingles(self, text: str) -> set:
+        padded = f" {' '.join(MemoryTextIndex.tokenize(text))} "
+        n = self.shingle_size
+        return {
+            zlib.crc32(padded[i : i + n].encode("utf-8"))
+            for i in range(max(len(padded) - n + 1, 0))
+        }
+
+    def band_keys(self, text: str):
+        """The LSH bucket keys of a memo, or None when it has no words."""
+        # An insert looks its memo up and then adds it; hash it only once.
+        if self._last_keys[0] == text:
+            return self._last_keys[1]
+        shingles = self.shingles(text)
+        if not shingles:
+            return None
+        values = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        with np.errstate(over="ignore"):
+            hashed = (
+                self.multipliers[:, None] * values[None, :] + self.increments[:, None]
+            ) >> np.uint64(32)
+        keys = self._keys(hashed.min(axis=1).astype(np.uint32))
+        self._last_keys = (text, keys)
+        return keys
+
+    def _keys(self, signature) -> list:
+        """Cut a MinHash signature into its band keys."""
+        return [
+            (band, signature[band * self.rows : (band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+
+    def similarity(self, text: str, other: str) -> float:
+        """Jaccard similarity of the shingle sets of two memos."""
+        a, b = self.shingles(text), self.shingles(other)
+        if not a or not b:
+            return 0.0
+        return len(a & b) / len(a | b)
+
+    def _load_saved(self) -> dict:
+        """{memory index: (checksum, signature or None)} from the saved file."""
+        if not (self.path and os.path.exists(self.path)):
+            return {}
+        try:
+            with np.load(self.path) as saved:
+                shape = tuple(saved["shape"].tolist())
+                signatures = saved["signatures"]
+                empty = saved["empty"]
+                checksums = saved["checksums"].tolist()
+                keys = saved["keys"].tolist()
+        except (OSError, ValueError, KeyError):
+            return {}
+        if shape != (self.bands, self.rows, self.shingle_size):
+            return {}
+        return {
+            key: (checksum, None if is_empty else signature)
+            for key, checksum, is_empty, signature in zip(
+                keys, checksums, empty.tolist(), signatures
+            )
+        }
+
+    def rebuild(self, memory_data: dict):
+        self.clear()
+        saved = self._load_saved()
+        reused = 0
+        for index, entry in memory_data.items():
+            checksum = self.checksum(entry)
+            saved_row = saved.get(index)
+            if saved_row is not None and saved_row[0] == checksum:
+                signature = saved_row[1]
+                self._insert(
+                    index,
+                    checksum,
+                    None if signature is None else self._keys(signature),
+                )
+                reused += 1
+            else:
+                self.add(index, entry)
+        self.dirty = reused != len(memory_data) or len(saved) != len(memory_data)
+
+    def add(self, index, entry: dict):
+        keys = self.band_keys(str(entry.get("memo", "")))
+        self._insert(index, self.checksum(entry), keys)
+        self.dirty = True
+
+    def _insert(self, index, checksum: int, keys):
+        self.signatures[index] = keys
+        self.checksums[index] = checksum
+        for key in keys or ():
+            self.buckets.setdefault(key, {})[index] = None
+
+    def save(self):
+        if not (self.path and self.dirty):
+            return
+        indices = list(self.signatures)
+        signatures = np.zeros((len(indices), self.bands * self.rows), dtype=np.uint32)
+        empty = np.zeros(len(indices), dtype=bool)
+        for row, index in enumerate(indices):
+            keys = self.signatures[index]
+            if keys is None:
+                empty[row] = True
+            else:
+                # The band keys are the signature cut into pieces.
+                signatures[row] = np.frombuffer(
+                    b"".join(key for _, key in keys), dtype=np.uint32
+                )
+        with atomic_write(self.path, "wb") as file:
+            np.savez(
+                file,
+                shape=np.array([self.bands, self.rows, self.shingle_size]),
+                signatures=signatures,
+                empty=empty,
+                checksums=np.array(
+                    [self.checksums[index] for index in indices], dtype=np.uint32
+                ),
+                keys=np.array(indices, dtype=np.int64),
+            )
+        self.dirty = False
+
+    def remove(self, index, entry: dict):
+        self.checksums.pop(index, None)
+        if index in self.signatures:
+            self.dirty = True
+        for key in self.signatures.pop(index, None) or ():
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.pop(index, None)
+                if not bucket:
+                    del self.buckets[key]
+
+    def replace(self, index, previous: dict, entry: dict):
+        self.remove(index, previous)
+        self.add(index, entry)
+
+    def find(
+        self, memo: str, memory_data: dict, threshold: float, where: Callable = None
+    ) -> list:
+        """
+        (index, similarity) of the stored memos at least threshold similar to
+        memo, most similar first.
+
+        :param where: Optional predicate on the memory index to restrict the candidates.
+        """
+        candidates = {}
+        for key in self.band_keys(memo) or ():
+            candidates.update(self.buckets.get(key, {}))
+        matches = []
+        for index in candidates:
+            if where is not None and not where(index):
+                continue
+            score = self.similarity(memo, str(memory_data[index].get("memo", "")))
+            if score >= threshold:
+                matches.append((index, score))
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        return matches
+
+
+class MemoryRetentionIndex:
+    """
+    Byte size per memory for the capacity caps, and a lazily built min-heap of
+    eviction candidates.
+
+    Eviction keys only grow (a memory gets newer, is read again or more often),
+    so a stale heap entry is re-pushed with its current key when it surfaces
+    instead of keeping the heap exact on every change.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.sizes = {}  # memory index -> bytes of its JSON form
+        self.bytes = 0
+        self.heap = None
+        self.key = None
+        self.policy = None
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def rebuild(self, memory_data: dict):
+        self.clear()
+        for index, entry in memory_data.items():
+            self.add(index, entry)
+
+    def add(self, index, entry: dict):
+        size = len(json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+        self.sizes[index] = size
+        self.bytes += size
+        if self.heap is not None:
+            heapq.heappush(self.heap, (self.key(index), index))
+
+    def remove(self, index, entry: dict):
+        self.bytes -= self.sizes.pop(index, 0)
+
+    def replace(self, index, previous: dict, entry: dict):
+        # Keep the heap entry; its key is refreshed lazily in next_victim.
+        self.bytes -= self.sizes.pop(index, 0)
+        size = len(json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+        self.sizes[index] = size
+        self.bytes += size
+
+    def next_victim(self, policy: str, key: Callable, exclude=None):
+        """The memory index with the smallest eviction key, or None."""
+        if self.heap is None or self.policy != policy:
+            self.policy, self.key = policy, key
+            self.heap = [(key(index), index) for index in self.sizes]
+            heapq.heapify(self.heap)
+        skipped = []
+        victim = None
+        while self.heap:
+            old_key, index = heapq.heappop(self.heap)
+            if index not in self.sizes:
+                continue
+            current = key(index)
+            if current != old_key:
+                heapq.heappush(self.heap, (current, index))
+                continue
+            if index == exclude:
+                skipped.append((current, index))
+                continue
+            victim = index
+            break
+        for item in skipped:
+            heapq.heappush(self.heap, item)
+        return victim
+
+
+def _storage_span(method: Callable) -> Callable:
+    """
+    Run a storage method in a "storage.<name>" span. Traced methods it calls on
+    the same storage (compact -> save, a subclass calling super()) are part of
+    the outer span rather than counted again.
+    """
+    name = "storage." + method.__name__
+
+    @functools.wraps(method)
+    def traced(self, *args, **kwargs):
+        if self._in_span or not self.telemetry.sinks:
+            return method(self, *args, **kwargs)
+        self._in_span = True
+        try:
+            with self.telemetry.span(name, backend=type(self).__name__):
+                return method(self, *args, **kwargs)
+        finally:
+            self._in_span = False
+
+    return traced
+
+
+class MemoryStorage:
+    """
+    On-disk storage of one memory set.
+
+    MemoryFunctions keeps the parsed entries in memory and hands every batch of
+    mutation records to apply(); a backend only decides how those records reach
+    the disk. Entries are keyed by their int memory id. Ids are handed out by
+    allocate_id() and never reused, not even after the newest memory is deleted.
+    """
+
+    suffix = ".json"
+
+    # Methods that run in a telemetry span, in every backend.
+    _TRACED = ("load", "save", "apply", "compact", "changes")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls._TRACED:
+            if name in vars(cls):
+                setattr(cls, name, _storage_span(vars(cls)[name]))
+
+    def __init__(self, path: str, telemetry: MemoryTelemetry = None, **options):
+        self.path = path
+        self.telemetry = telemetry or MemoryTelemetry()
+        self._in_span = False
+        self._lock_file = None
+        self._lock_depth = 0
+        self._generation = None
+        self.next_id = 1
+
+    @classmethod
+    def path_for(cls, memory_file: str) -> str:
+        """Map a logical "<name>.json" memory file to this backend's file."""
+        return os.path.splitext(memory_file)[0] + cls.suffix
+
+    def paths(self) -> list:
+        """Every file on disk that belongs to this memory set."""
+        return [self.path, self.lock_path]
+
+    @property
+    def lock_path(self) -> str:
+        return self.path + ".lock"
+
+    @property
+    def is_locked(self) -> bool:
+        return self._lock_depth > 0
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold an exclusive advisory lock on the memory set, shared with every other
+        process (e.g. other uvicorn workers) using the same files. Re-entrant.
+        """
+        if self._lock_depth == 0 and fcntl is not None:
+            self._lock_file = open(self.lock_path, "a")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0 and self._lock_file is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                self._lock_file.close()
+                self._lock_file = None
+
+    def generation(self):
+        """A cheap token that changes whenever the stored data changes."""
+        return tuple(_file_identity(path) for path in self.paths())
+
+    def mark(self):
+        """Remember the current generation as the one memory_data reflects."""
+        self._generation = self.generation()
+
+    def changes(self):
+        """
+        Report what changed on disk since the last load or write of this process:
+        None when nothing did, "reload" when the set must be loaded again, or a
+        list of records that bring the loaded data up to date.
+        """
+        return None if self.generation() == self._generation else "reload"
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def signature(self) -> tuple:
+        """Modification time and size of every file, to notice outside edits."""
+        signature = []
+        for path in self.paths():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def pending(self) -> bool:
+        """Whether changes are waiting to be folded in by compact()."""
+        return False
+
+    def load(self) -> dict:
+        raise NotImplementedError
+
+    def allocate_id(self) -> int:
+        """Hand out the next memory id; it is persisted with its first put."""
+        index = self.next_id
+        self.next_id += 1
+        return index
+
+    def _advance(self, indices):
+        """Keep next_id past every id seen on disk."""
+        self.next_id = max(self.next_id, max(indices, default=0) + 1)
+
+    # What load() moves besides returning the data; see _read.
+    _LOAD_STATE = ("_generation", "next_id")
+
+    def _read(self) -> dict:
+        """
+        The stored memory set for a one-off lookup. Unlike load() it leaves alone
+        what changes() compares against, so the caller's memory_data is still
+        refreshed when another process writes.
+        """
+        state = [getattr(self, name) for name in self._LOAD_STATE]
+        try:
+            return self.load()
+        finally:
+            for name, value in zip(self._LOAD_STATE, state):
+                setattr(self, name, value)
+
+    def get(self, index):
+        return self._read().get(int(index))
+
+    def put(self, index, entry: dict):
+        self.apply([{"op": "put", "index": index, "entry": entry}])
+
+    def delete(self, index):
+        self.apply([{"op": "delete", "index": index}])
+
+    def scan(self, tag: str = None):
+        for index, entry in self._read().items():
+            if tag is None or entry.get("tag") == tag:
+                yield index, entry
+
+    def count(self) -> int:
+        return len(self._read())
+
+    def tag_counts(self) -> dict:
+        """{tag: number of memories}."""
+        counts = {}
+        for _, entry in self.scan():
+            counts[entry.get("tag")] = counts.get(entry.get("tag"), 0) + 1
+        return counts
+
+    def apply(self, records: list, memory_data: dict = None):
+        """Write a batch of put/delete/clear records as one unit."""
+        raise NotImplementedError
+
+    def save(self, memory_data: dict):
+        """Replace the stored memory set with memory_data."""
+        raise NotImplementedError
+
+    def compact(self, memory_data: dict, force: bool = False):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonFileStorage(MemoryStorage):
+    """
+    The memory set as one JSON file, optionally with an append-only journal.
+
+    In journal mode every mutation appends one record to a ".log" file next to
+    the JSON snapshot; the log is folded back into the snapshot once it grows past
+    compact_threshold bytes.
+    """
+
+    suffix = ".json"
+    _LOAD_STATE = MemoryStorage._LOAD_STATE + ("_journal_offset",)
+
+    def __init__(
+        self,
+        path: str,
+        telemetry: MemoryTelemetry = None,
+        journal: bool = True,
+        compact_threshold: int = 1024 * 1024,
+        **options,
+    ):
+        super().__init__(path, telemetry)
+        self.journal = journal
+        self.compact_threshold = compact_threshold
+        # How far into the journal memory_data reflects.
+        self._journal_offset = 0
+
+    @property
+    def journal_file(self) -> str:
+        return self.path + ".log"
+
+    def paths(self) -> list:
+        return [self.path, self.journal_file, self.lock_path]
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path) or os.path.exists(self.journal_file)
+
+    def pending(self) -> bool:
+        return os.path.exists(self.journal_file)
+
+    def generation(self):
+        return (_file_identity(self.path), _file_identity(self.journal_file))
+
+    def changes(self):
+        snapshot, journal = self.generation()
+        if (snapshot, journal) == self._generation:
+            return None
+        known_snapshot, known_journal = self._generation or (None, None)
+        if (
+            snapshot == known_snapshot
+            and journal is not None
+            and known_journal is not None
+            and journal[0] == known_journal[0]
+            and journal[2] >= self._journal_offset
+        ):
+            # Another process only appended to the journal: read just the tail.
+            records = self._read_journal(self._journal_offset)
+            self.mark()
+            return records
+        return "reload"
+
+    def load(self) -> dict:
+        memory_data = {}
+        generation = self.generation()
+        if os.path.exists(self.path):
+            self.telemetry.log("Loading memory", path=self.path)
+            memory_data, self.next_id = self._read_snapshot()
+            self._advance(memory_data)
+        else:
+            self.next_id = 1
+        self._journal_offset = 0
+        if os.path.exists(self.journal_file):
+            self.telemetry.log("Replaying journal", path=self.journal_file)
+            self._replay(memory_data, self._read_journal(0))
+        self._generation = generation
+        return memory_data
+
+    def _read_journal(self, offset: int) -> list:
+        """Read the complete journal records that start at or after offset."""
+        records = []
+        with open(self.journal_file, "rb") as file:
+            file.seek(offset)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # A crash in the middle of an append leaves a truncated last
+                    # record behind; everything before it is still valid.
+                    self.telemetry.log("Ignoring truncated journal record.")
+                    break
+                record = json.loads(line)
+                if record["op"] == "put":
+                    self._advance([int(record["index"])])
+                records.append(record)
+                offset += len(line)
+        self._journal_offset = offset
+        return records
+
+    def save(self, memory_data: dict):
+        self.telemetry.log("Saving memory", path=self.path)
+        with self.locked():
+            self._advance(memory_data)
+            self._write_snapshot(memory_data)
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            self._journal_offset = 0
+            self.mark()
+
+    def compact(self, memory_data: dict, force: bool = False):
+        """Fold the journal back into the JSON snapshot and truncate it."""
+        with self.locked():
+            if not (force or os.path.exists(self.journal_file)):
+                return
+            if self.changes() is not None:
+                # Another process wrote since memory_data was loaded; fold what
+                # is on disk rather than overwrite its changes.
+                memory_data = self.load()
+            self.telemetry.log("Compacting journal", path=self.path)
+            self.save(memory_data)
+
+    def apply(self, records: list, memory_data: dict = None):
+        if memory_data is None:
+            memory_data = self.load()
+            self._replay(memory_data, records)
+        # A clear makes the whole journal moot, so write a fresh snapshot instead.
+        if not self.journal or any(record["op"] == "clear" for record in records):
+            self.save(memory_data)
+            return
+        payload = "".join(
+            json.dumps(record, ensure_ascii=False) + "\n" for record in records
+        ).encode("utf-8")
+        with self.locked():
+            with open(self.journal_file, "a+b") as file:
+                start = self._drop_partial_record(file)
+                try:
+                    file.write(payload)
+                    file.flush()
+                    os.fsync(file.fileno())
+                except BaseException:
+                    # Never leave half of a batch behind in the journal.
+                    file.truncate(start)
+                    raise
+                size = file.tell()
+            self._journal_offset = size
+            self.mark()
+            if size > self.compact_threshold:
+                self.compact(memory_data)
+
+    @staticmethod
+    def _drop_partial_record(file) -> int:
+        """Cut a record left half-written by a crash so the next one starts clean."""
+        end = file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            step = min(4096, position)
+            file.seek(position - step)
+            chunk = file.read(step)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                position = position - step + newline + 1
+                break
+            position -= step
+        if position != end:
+            file.truncate(position)
+        file.seek(position)
+        return position
+
+    # Snapshot entry holding the id allocator; never part of memory_data.
+    _META_KEY = "_meta"
+
+    def _read_snapshot(self) -> tuple:
+        """Parse the snapshot file into (memory_data, next_id)."""
+        with open(self.path, "r", encoding="utf-8") as file:
+            snapshot = json.load(file)
+        meta = snapshot.pop(self._META_KEY, {})
+        memory_data = {int(index): entry for index, entry in snapshot.items()}
+        return memory_data, meta.get("next_id", 1)
+
+    def _write_snapshot(self, memory_data: dict):
+        snapshot = {self._META_KEY: {"next_id": self.next_id}, **memory_data}
+        with atomic_write(self.path, "w", encoding="utf-8") as file:
+            json.dump(snapshot, file, ensure_ascii=False, indent=4)
+
+    @staticmethod
+    def _replay(memory_data: dict, records: list):
+        for record in records:
+            if record["op"] == "put":
+                memory_data[int(record["index"])] = record["entry"]
+            elif record["op"] == "delete":
+                memory_data.pop(int(record["index"]), None)
+            elif record["op"] == "clear":
+                memory_data.clear()
+
+
+class SQLiteStorage(MemoryStorage):
+    """The memory set as an SQLite database in WAL mode, one row per entry."""
+
+    suffix = ".sqlite3"
+
+    def __init__(self, path: str, telemetry: MemoryTelemetry = None, **options):
+        super().__init__(path, telemetry)
+        self.connection = None
+
+    def paths(self) -> list:
+        return [self.path, self.path + "-wal", self.path + "-shm", self.lock_path]
+
+    def generation(self):
+        # Bumped by SQLite whenever another connection commits to the database.
+        return self._connect().execute("PRAGMA data_version").fetchone()[0]
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS memories (
+                    id INTEGER PRIMARY KEY,
+                    tag TEXT,
+                    memo TEXT,
+                    by TEXT,
+                    last_modified TEXT,
+                    extra TEXT
+                );
+                CREATE INDEX IF NOT EXISTS memories_tag ON memories (tag);
+                CREATE INDEX IF NOT EXISTS memories_last_modified
+                    ON memories (last_modified);
+                CREATE TABLE IF NOT EXISTS meta (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER
+                );
+                """)
+        return self.connection
+
+    @staticmethod
+    def _row(index, entry: dict) -> tuple:
+        extra = {
+            key: value
+            for key, value in entry.items()
+            if key not in ("tag", "memo", "by", "last_modified")
+        }
+        return (
+            int(index),
+            entry.get("tag"),
+            entry.get("memo"),
+            entry.get("by"),
+            entry.get("last_modified"),
+            json.dumps(extra, ensure_ascii=False) if extra else None,
+        )
+
+    @staticmethod
+    def _entry(row: tuple) -> tuple:
+        index, tag, memo, by, last_modified, extra = row
+        entry = {"tag": tag, "memo": memo, "by": by, "last_modified": last_modified}
+        if extra:
+            entry.update(json.loads(extra))
+        return index, entry
+
+    _COLUMNS = "id, tag, memo, by, last_modified, extra"
+
+    def load(self) -> dict:
+        self.telemetry.log("Loading memory", path=self.path)
+        rows = self._connect().execute(
+            f"SELECT {self._COLUMNS} FROM memories ORDER BY id"
+        )
+        memory_data = dict(self._entry(row) for row in rows)
+        row = (
+            self._connect()
+            .execute("SELECT value FROM meta WHERE name = 'next_id'")
+            .fetchone()
+        )
+        self.next_id = row[0] if row else 1
+        self._advance(memory_data)
+        self.mark()
+        return memory_data
+
+    def get(self, index):
+        row = (
+            self._connect()
+            .execute(
+                f"SELECT {self._COLUMNS} FROM memories WHERE id = ?", (int(index),)
+            )
+            .fetchone()
+        )
+        return self._entry(row)[1] if row else None
+
+    def scan(self, tag: str = None):
+        connection = self._connect()
+        if tag is None:
+            rows = connection.execute(
+                f"SELECT {self._COLUMNS} FROM memories ORDER BY id"
+            )
+        else:
+            rows = connection.execute(
+                f"SELECT {self._COLUMNS} FROM memories WHERE tag = ? ORDER BY id",
+                (tag,),
+            )
+        for row in rows:
+            yield self._entry(row)
+
+    def count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+
+    def tag_counts(self) -> dict:
+        rows = self._connect().execute(
+            "SELECT tag, COUNT(*) FROM memories GROUP BY tag"
+        )
+        return dict(rows.fetchall())
+
+    def apply(self, records: list, memory_data: dict = None):
+        connection = self._connect()
+        with connection:
+            for record in records:
+                if record["op"] == "put":
+                    connection.execute(
+                        f"INSERT OR REPLACE INTO memories ({self._COLUMNS}) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        self._row(record["index"], record["entry"]),
+                    )
+                elif record["op"] == "delete":
+                    connection.execute(
+                        "DELETE FROM memories WHERE id = ?", (int(record["index"]),)
+                    )
+                elif record["op"] == "clear":
+                    connection.execute("DELETE FROM memories")
+            self._advance(
+                int(record["index"]) for record in records if record["op"] == "put"
+            )
+            self._save_next_id(connection)
+        self.mark()
+
+    def save(self, memory_data: dict):
+        self.telemetry.log("Saving memory", path=self.path)
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM memories")
+            connection.executemany(
+                f"INSERT INTO memories ({self._COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                (self._row(index, entry) for index, entry in memory_data.items()),
+            )
+            self._advance(memory_data)
+            self._save_next_id(connection)
+        self.mark()
+
+    def _save_next_id(self, connection):
+        connection.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES ('next_id', ?)",
+            (self.next_id,),
+        )
+
+    def compact(self, memory_data: dict, force: bool = False):
+        if force and self.connection is not None:
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class BinaryMemoryReader:
+    """
+    Memory-mapped reader for the compact binary memory format.
+
+    Layout, little-endian:
+      header   magic "GMEM", version u16, 2 pad bytes, next_id i64,
+               entry count u32, string count u32
+      strings  u32 length + UTF-8, once per distinct tag and author
+      records  one fixed-size row per entry, sorted by id (see RECORD)
+      heap     u32 length + UTF-8 per memo, and per JSON blob of extra fields
+
+    Opening a file only parses the header and the string table; memos are
+    decoded when an entry is read.
+    """
+
+    MAGIC = b"GMEM"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHxxqII")
+    LENGTH = struct.Struct("<I")
+    RECORD = np.dtype(
+        [
+            ("id", "<i8"),
+            ("tag", "<u4"),
+            ("by", "<u4"),
+            ("time", "<i8"),  # last_modified as seconds since the epoch
+            ("memo", "<u8"),  # heap offset
+            ("extra", "<u8"),  # heap offset, or NO_EXTRA
+        ]
+    )
+    NONE = 0xFFFFFFFF  # string table position of a missing tag or author
+    NO_EXTRA = 0xFFFFFFFFFFFFFFFF
+    NO_TIME = np.iinfo(np.int64).min
+    FIELDS = ("tag", "memo", "by", "last_modified")
+    TIME_FORMAT = re.compile(r"\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}")
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.next_id, count, string_count = self.HEADER.unpack_from(
+                self._map
+            )
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError(f"{path} is not a binary memory file.")
+            offset = self.HEADER.size
+            self.strings = []
+            for _ in range(string_count):
+                text, offset = self._blob(offset)
+                self.strings.append(text)
+            self.records = np.frombuffer(
+                self._map, dtype=self.RECORD, count=count, offset=offset
+            )
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        # The record view holds a buffer export that has to go before the map.
+        self.records = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def _blob(self, offset: int) -> tuple:
+        (length,) = self.LENGTH.unpack_from(self._map, offset)
+        start = offset + self.LENGTH.size
+        return self._map[start : start + length].decode("utf-8"), start + length
+
+    def _string(self, position: int):
+        return None if position == self.NONE else self.strings[position]
+
+    def memo(self, row: int) -> str:
+        return self._blob(int(self.records["memo"][row]))[0]
+
+    def entry(self, row: int) -> dict:
+        record = self.records[row]
+        timestamp = record["time"]
+        entry = {
+            "tag": self._string(record["tag"]),
+            "memo": self.memo(row),
+            "by": self._string(record["by"]),
+            "last_modified": (
+                None if timestamp == self.NO_TIME else self.format_times([timestamp])[0]
+            ),
+        }
+        if record["extra"] != self.NO_EXTRA:
+            entry.update(json.loads(self._blob(int(record["extra"]))[0]))
+        return entry
+
+    def find(self, index: int):
+        """The row of a memory id, or None."""
+        row = int(np.searchsorted(self.records["id"], index))
+        if row < len(self.records) and self.records["id"][row] == index:
+            return row
+        return None
+
+    def rows(self, tag: str = None):
+        """Rows in id order, optionally only those with a tag."""
+        if tag is None:
+            return range(len(self.records))
+        if tag not in self.strings:
+            return []
+        return np.flatnonzero(self.records["tag"] == self.strings.index(tag))
+
+    def tag_counts(self) -> dict:
+        """{tag: number of entries}, from the record table alone."""
+        positions, counts = np.unique(self.records["tag"], return_counts=True)
+        return {
+            self._string(position): count
+            for position, count in zip(positions.tolist(), counts.tolist())
+        }
+
+    def read_all(self) -> dict:
+        """Decode every entry at once, for loading the whole memory set."""
+        records = self.records
+        names = dict(enumerate(self.strings))
+        names[self.NONE] = None
+        tags = [names[position] for position in records["tag"].tolist()]
+        authors = [names[position] for position in records["by"].tolist()]
+        times = self.format_times(records["time"])
+        blob, unpack = self._map, self.LENGTH.unpack_from
+        memory_data = {}
+        for index, tag, memo, by, stamp, extra in zip(
+            records["id"].tolist(),
+            tags,
+            records["memo"].tolist(),
+            authors,
+            times,
+            records["extra"].tolist(),
+        ):
+            (length,) = unpack(blob, memo)
+            entry = {
+                "tag": tag,
+                "memo": blob[memo + 4 : memo + 4 + length].decode("utf-8"),
+                "by": by,
+                "last_modified": stamp,
+            }
+            if extra != self.NO_EXTRA:
+                entry.update(json.loads(self._blob(extra)[0]))
+            memory_data[index] = entry
+        return memory_data
+
+    @classmethod
+    def format_times(cls, times) -> list:
+        times = np.asarray(times, dtype=np.int64)
+        missing = times == cls.NO_TIME
+        text = (
+            np.where(missing, 0, times)
+            .astype("datetime64[s]")
+            .astype(str)
+            .astype(object)
+        )
+        text[missing] = None
+        return [stamp and stamp.replace("T", "_") for stamp in text.tolist()]
+
+    @classmethod
+    def parse_times(cls, stamps: list) -> np.ndarray:
+        """Pack "%Y-%m-%d_%H:%M:%S" timestamps; anything else becomes NO_TIME."""
+        times = np.full(len(stamps), cls.NO_TIME, dtype=np.int64)
+        valid = [
+            row
+            for row, stamp in enumerate(stamps)
+            if isinstance(stamp, str) and cls.TIME_FORMAT.fullmatch(stamp)
+        ]
+        try:
+            times[valid] = np.array(
+                [stamps[row].replace("_", "T") for row in valid],
+                dtype="datetime64[s]",
+            ).astype(np.int64)
+        except ValueError:
+            for row in valid:
+                try:
+                    times[row] = np.datetime64(
+                        stamps[row].replace("_", "T"), "s"
+                    ).astype(np.int64)
+                except ValueError:
+                    pass
+        return times
+
+    @classmethod
+    def write(cls, file, memory_data: dict, next_id: int):
+        """Write memory_data to a binary file object in this format."""
+        indices = sorted(memory_data)
+        entries = [memory_data[index] for index in indices]
+        strings = {}
+        records = np.zeros(len(entries), dtype=cls.RECORD)
+        records["id"] = indices
+        stamps = [entry.get("last_modified") for entry in entries]
+        times = cls.parse_times(stamps)
+        records["time"] = times
+
+        heap = bytearray()
+
+        def intern(value):
+            if value is None:
+                return cls.NONE
+            return strings.setdefault(value, len(strings))
+
+        def store(text: str) -> int:
+            encoded = text.encode("utf-8")
+            offset = len(heap)
+            heap.extend(cls.LENGTH.pack(len(encoded)))
+            heap.extend(encoded)
+            return offset
+
+        tag_column, by_column, memo_column, extra_column = [], [], [], []
+        for entry, time in zip(entries, times.tolist()):
+            extra = {
+                key: value for key, value in entry.items() if key not in cls.FIELDS
+            }
+            for field, column in (("tag", tag_column), ("by", by_column)):
+                value = entry.get(field)
+                if value is not None and not isinstance(value, str):
+                    extra[field], value = value, None
+                column.append(intern(value))
+            memo = entry.get("memo")
+            if not isinstance(memo, str):
+                extra["memo"], memo = memo, ""
+            if time == cls.NO_TIME and entry.get("last_modified") is not None:
+                extra["last_modified"] = entry["last_modified"]
+            memo_column.append(store(memo))
+            extra_column.append(
+                store(json.dumps(extra, ensure_ascii=False)) if extra else None
+            )
+
+        header = bytearray()
+        for text in strings:
+            encoded = text.encode("utf-8")
+            header.extend(cls.LENGTH.pack(len(encoded)))
+            header.extend(encoded)
+        heap_start = cls.HEADER.size + len(header) + records.nbytes
+        records["tag"] = tag_column
+        records["by"] = by_column
+        records["memo"] = np.array(memo_column, dtype=np.uint64) + heap_start
+        records["extra"] = [
+            cls.NO_EXTRA if offset is None else offset + heap_start
+            for offset in extra_column
+        ]
+
+        file.write(
+            cls.HEADER.pack(cls.MAGIC, cls.VERSION, next_id, len(entries), len(strings))
+        )
+        file.write(header)
+        file.write(records.tobytes())
+        file.write(heap)
+
+
+class BinaryFileStorage(JsonFileStorage):
+    """
+    JsonFileStorage with the snapshot in the compact binary layout of
+    BinaryMemoryReader instead of JSON; the journal works the same way.
+
+    Lookups, tag scans and counts go through the memory-mapped reader and only
+    decode the entries they return, as long as no journal is pending. Loading the
+    set for MemoryFunctions always decodes all of it; the lazy reads serve the
+    stats of memory files that are not open, which need no memo at all.
+    """
+
+    suffix = ".mem"
+
+    def _read_snapshot(self) -> tuple:
+        reader = BinaryMemoryReader(self.path)
+        try:
+            return reader.read_all(), reader.next_id
+        finally:
+            reader.close()
+
+    def _write_snapshot(self, memory_data: dict):
+        with atomic_write(self.path, "wb") as file:
+            BinaryMemoryReader.write(file, memory_data, self.next_id)
+
+    @contextmanager
+    def _reader(self):
+        reader = BinaryMemoryReader(self.path)
+        try:
+            yield reader
+        finally:
+            reader.close()
+
+    def _lazy(self) -> bool:
+        return os.path.exists(self.path) and not self.pending()
+
+    def get(self, index):
+        if not self._lazy():
+            return super().get(index)
+        with self._reader() as reader:
+            row = reader.find(int(index))
+            return None if row is None else reader.entry(row)
+
+    def scan(self, tag: str = None):
+        if not self._lazy():
+            yield from super().scan(tag)
+            return
+        with self._reader() as reader:
+            for row in reader.rows(tag):
+                yield int(reader.records["id"][row]), reader.entry(row)
+
+    def count(self) -> int:
+        if not self._lazy():
+            return super().count()
+        with self._reader() as reader:
+            return len(reader)
+
+    def tag_counts(self) -> dict:
+        if not self._lazy():
+            return super().tag_counts()
+        with self._reader() as reader:
+            return reader.tag_counts()
+
+
+STORAGE_BACKENDS = {
+    "json": JsonFileStorage,
+    "binary": BinaryFileStorage,
+    "sqlite": SQLiteStorage,
+}
+
+
+def _other_storages(backend: str, memory_file: str, **options) -> list:
+    """
+    The files of a memory file kept by backends other than backend, i.e. a set
+    written before the STORAGE_BACKEND valve changed, newest first. Only looks
+    at the disk; nothing is created.
+    """
+    storages = []
+    for name, storage_class in STORAGE_BACKENDS.items():
+        if name == backend:
+            continue
+        storage = storage_class(storage_class.path_for(memory_file), **options)
+        if storage.exists():
+            storages.append(storage)
+    storages.sort(
+        key=lambda storage: max(
+            (mtime for _, mtime, _ in storage.signature()), default=0
+        ),
+        reverse=True,
+    )
+    return storages
+
+
+def _find_storage(backend: str, memory_file: str, **options) -> MemoryStorage:
+    """
+    The storage holding a memory file on disk without migrating or creating
+    anything: the backend's own file if there is one, else the newest file of
+    any other backend, else None.
+    """
+    storage_class = STORAGE_BACKENDS[backend]
+    storage = storage_class(storage_class.path_for(memory_file), **options)
+    if storage.exists():
+        return storage
+    others = _other_storages(backend, memory_file, **options)
+    return others[0] if others else None
+
+
+class MemoryEvictionLog:
+    """
+    Audit log of evicted memories in .evictions/<file name>.jsonl, one record
+    per memory with the full entry, so an eviction can be undone until its
+    grace period is over. Ids are never reused, so a memory is put back under
+    its old id.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = os.path.join(directory, ".evictions")
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.directory, file_name.removesuffix(".json") + ".jsonl")
+
+    def append(self, file_name: str, records: list):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(file_name)
+        with file_lock(path + ".lock"), open(path, "a", encoding="utf-8") as file:
+            for record in records:
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _read(self, file_name: str) -> list:
+        records = []
+        try:
+            with open(self._path(file_name), "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue  # torn last line
+        except FileNotFoundError:
+            pass
+        return records
+
+    def records(self, file_name: str, grace: float) -> list:
+        """The records of file_name that can still be undone, oldest first."""
+        cutoff = time.time() - grace
+        latest = {}
+        for record in self._read(file_name):
+            if record["evicted_at"] >= cutoff:
+                latest[record["id"]] = record
+        return list(latest.values())
+
+    def take(self, file_name: str, grace: float, ids: list = None) -> list:
+        """Remove and return the records to undo: all of them, or those in ids."""
+        path = self._path(file_name)
+        if not os.path.exists(path):
+            return []
+        with file_lock(path + ".lock"):
+            records = self.records(file_name, grace)
+            wanted = None if ids is None else {int(index) for index in ids}
+            taken = [r for r in records if wanted is None or r["id"] in wanted]
+            taken_ids = {record["id"] for record in taken}
+            self._rewrite(file_name, [r for r in records if r["id"] not in taken_ids])
+        return taken
+
+    def prune(self, file_name: str, grace: float):
+        """Drop the records whose grace period is over."""
+        path = self._path(file_name)
+        if not os.path.exists(path):
+            return
+        with file_lock(path + ".lock"):
+            records = self._read(file_name)
+            kept = self.records(file_name, grace)
+            if len(kept) != len(records):
+                self._rewrite(file_name, kept)
+
+    def _rewrite(self, file_name: str, records: list):
+        with atomic_write(self._path(file_name), "w", encoding="utf-8") as file:
+            for record in records:
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class MemorySetCache:
+    """
+    Bounded LRU of parsed memory files that are not currently active.
+
+    Each cached set keeps the signature of its files from when it was put
+    aside; a set whose files changed on disk since then is dropped and loaded
+    again. Sets with changes that were not folded into their main file yet are
+    compacted when they are evicted.
+    """
+
+    def __init__(self, max_files: int = 4, max_bytes: int = 64 * 1024 * 1024):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # memory file -> (state, signature, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, memory_file: str, state: dict) -> list:
+        """Cache a memory set and return the states evicted to make room."""
+        self.discard(memory_file)
+        signature = state["storage"].signature()
+        size = sum(file_size for _, _, file_size in signature)
+        self.entries[memory_file] = (state, signature, size)
+        self.bytes += size
+        evicted = []
+        while self.entries and (
+            len(self.entries) > self.max_files or self.bytes > self.max_bytes
+        ):
+            _, (old_state, _, old_size) = self.entries.popitem(last=False)
+            self.bytes -= old_size
+            self.evictions += 1
+            evicted.append(old_state)
+        return evicted
+
+    def take(self, memory_file: str):
+        """Remove and return the cached state for a memory file, if still current."""
+        cached = self.entries.pop(memory_file, None)
+        if cached is None:
+            self.misses += 1
+            return None
+        state, signature, size = cached
+        self.bytes -= size
+        if state["storage"].signature() != signature:
+            # Edited outside of this process; its on-disk files win.
+            state["storage"].close()
+            self.misses += 1
+            return None
+        self.hits += 1
+        return state
+
+    def peek(self, memory_file: str):
+        cached = self.entries.get(memory_file)
+        return cached[0] if cached else None
+
+    def discard(self, memory_file: str):
+        cached = self.entries.pop(memory_file, None)
+        if cached is not None:
+            self.bytes -= cached[2]
+            return cached[0]
+        return None
+
+    def update_signature(self, memory_file: str):
+        """Take note of this process' own writes to a cached set's files."""
+        state, _, size = self.entries[memory_file]
+        signature = state["storage"].signature()
+        new_size = sum(file_size for _, _, file_size in signature)
+        self.entries[memory_file] = (state, signature, new_size)
+        self.bytes += new_size - size
+
+    def drain(self) -> list:
+        states = [state for state, _, _ in self.entries.values()]
+        self.entries.clear()
+        self.bytes = 0
+        return states
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "cached_files": len(self.entries),
+            "cached_bytes": self.bytes,
+        }
+
+
+class MemorySnapshots:
+    """
+    Incremental, content-addressed snapshots of a memory directory.
+
+    Every memory file is cut into chunks of CHUNK_ENTRIES consecutive ids, and
+    each chunk is stored once in objects/ under the SHA-256 of its content, so
+    a snapshot only writes the chunks that changed since any earlier one. A
+    file whose on-disk signature matches the previous snapshot is not read at
+    all. A snapshot itself is a small JSON record in snapshots/ that points at
+    one manifest object (next_id and chunk list) per file.
+    """
+
+    CHUNK_ENTRIES = 256
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.objects = os.path.join(directory, "objects")
+        self.records = os.path.join(directory, "snapshots")
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def _put(self, content: bytes) -> tuple:
+        """Store an object; return its digest and whether it was new."""
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path, "wb") as file:
+            file.write(zlib.compress(content))
+        return digest, True
+
+    def _get(self, digest: str) -> bytes:
+        with open(self._object_path(digest), "rb") as file:
+            return zlib.decompress(file.read())
+
+    def list(self) -> list:
+        """Snapshot records, oldest first."""
+        if not os.path.isdir(self.records):
+            return []
+        return [
+            self.load(snapshot_id)
+            for snapshot_id in sorted(
+                name[: -len(".json")]
+                for name in os.listdir(self.records)
+                if name.endswith(".json")
+            )
+        ]
+
+    def load(self, snapshot_id: str) -> dict:
+        path = os.path.join(self.records, os.path.basename(snapshot_id) + ".json")
+        if not os.path.exists(path):
+            raise KeyError(f"Snapshot {snapshot_id} does not exist.")
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def take(self, sources: dict, label: str = "") -> dict:
+        """
+        Snapshot the given files, {file name: (signature, read)}, where read()
+        returns (memory_data, next_id) and is only called for changed files.
+        """
+        snapshots = self.list()
+        previous = snapshots[-1]["files"] if snapshots else {}
+        files, written = {}, 0
+        for file_name, (signature, read) in sources.items():
+            known = previous.get(file_name)
+            if known is not None and known["signature"] == signature:
+                files[file_name] = known
+                continue
+            memory_data, next_id = read()
+            chunks = []
+            for _, indices in itertools.groupby(
+                sorted(memory_data), key=lambda index: index // self.CHUNK_ENTRIES
+            ):
+                chunk = {str(index): memory_data[index] for index in indices}
+                digest, new = self._put(
+                    json.dumps(chunk, ensure_ascii=False).encode("utf-8")
+                )
+                chunks.append(digest)
+                written += new
+            manifest, new = self._put(
+                json.dumps({"next_id": next_id, "chunks": chunks}).encode("utf-8")
+            )
+            written += new
+            files[file_name] = {
+                "signature": signature,
+                "manifest": manifest,
+                "entries": len(memory_data),
+            }
+
+        snapshot_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        taken = {snapshot["id"] for snapshot in snapshots}
+        suffix = itertools.count(2)
+        while snapshot_id in taken:
+            snapshot_id = snapshot_id.split("+")[0] + f"+{next(suffix)}"
+        record = {
+            "id": snapshot_id,
+            "created": datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S"),
+            "label": label,
+            "files": files,
+            "objects_written": written,
+        }
+        os.makedirs(self.records, exist_ok=True)
+        path = os.path.join(self.records, snapshot_id + ".json")
+        with atomic_write(path, "w", encoding="utf-8") as file:
+            json.dump(record, file, ensure_ascii=False, indent=4)
+        return record
+
+    def read(self, record: dict, file_name: str) -> tuple:
+        """Return (memory_data, next_id) of a file as it was in a snapshot."""
+        if file_name not in record["files"]:
+            raise KeyError(f"{file_name} is not part of snapshot {record['id']}.")
+        manifest = json.loads(self._get(record["files"][file_name]["manifest"]))
+        memory_data = {}
+        for digest in manifest["chunks"]:
+            for index, entry in json.loads(self._get(digest)).items():
+                memory_data[int(index)] = entry
+        return memory_data, manifest["next_id"]
+
+
+class MemoryManifest:
+    """
+    Per-file stats of a memory directory (entry count, bytes, tag histogram,
+    last change) in .manifest/manifest.json, so listing files needs neither a
+    directory scan nor opening any memory file.
+
+    Writers record the stats of the file they just changed. Every listing
+    compares the recorded signature (mtime and size of each file on disk) of
+    every memory file, so one edited behind the manifest's back, even in place,
+    is re-read. The directory is only scanned for added and removed files when
+    its mtime differs from the one of the last scan.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, ".manifest", "manifest.json")
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {"directory_mtime": None, "files": {}}
+
+    def _write(self, manifest: dict):
+        # Rewritten in place under the lock: the manifest is only a cache of what
+        # is on disk, and a torn write just reads as empty and gets rebuilt.
+        with open(self.path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, ensure_ascii=False)
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with file_lock(self.path + ".lock"):
+            yield
+
+    def record(self, file_name: str, stats: dict):
+        with self._locked():
+            manifest = self._read()
+            manifest["files"][file_name] = stats
+            self._write(manifest)
+
+    def forget(self, file_name: str):
+        with self._locked():
+            manifest = self._read()
+            if manifest["files"].pop(file_name, None) is not None:
+                self._write(manifest)
+
+    def files(self, scan: Callable, signature: Callable, stats: Callable) -> dict:
+        """
+        Return {file name: stats}. scan() lists the memory files in the
+        directory, signature(name) tells whether a recorded file changed and
+        stats(name) reads a file that did.
+        """
+        with self._locked():
+            manifest = self._read()
+            mtime = os.stat(self.directory).st_mtime_ns
+            if manifest["directory_mtime"] == mtime:
+                # No file was added or removed since the last scan.
+                names = list(manifest["files"])
+            else:
+                names = scan()
+            files = {}
+            for file_name in names:
+                known = manifest["files"].get(file_name)
+                if known is not None and known["signature"] == signature(file_name):
+                    files[file_name] = known
+                else:
+                    files[file_name] = stats(file_name)
+            if manifest["directory_mtime"] != mtime or files != manifest["files"]:
+                self._write({"directory_mtime": mtime, "files": files})
+            return files
+
+
+class MemoryFunctions:
+    def __init__(
+        self,
+        memory_file="memory.json",
+        telemetry=None,
+        directory="memory_jsons",
+        journal=True,
+        compact_threshold=1024 * 1024,
+        backend="json",
+        cache_max_files=4,
+        cache_max_bytes=64 * 1024 * 1024,
+    ):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)  # Ensure the directory exists
+        self.memory_file = self._path(memory_file)
+        self.telemetry = telemetry or MemoryTelemetry()
+        # Options handed to the storage backend, see JsonFileStorage.
+        self.journal = journal
+        self.compact_threshold = compact_threshold
+        self.backend = backend if backend in STORAGE_BACKENDS else "json"
+        self._transaction = None
+        self.cache = MemorySetCache(cache_max_files, cache_max_bytes)
+        self.snapshots = MemorySnapshots(os.path.join(self.directory, ".snapshots"))
+        self.manifest = MemoryManifest(self.directory)
+        self._manifest_stale = False
+        # What add_to_memory does with a near-duplicate memo: "skip", "merge"
+        # into the existing memory, or "store" it anyway.
+        self.duplicate_policy = "store"
+        self.duplicate_threshold = 0.9
+        # Retention: caps per file (0 for none), TTL in seconds per tag, which
+        # memories go first when over a cap, and how long an eviction can be undone.
+        self.max_entries = 0
+        self.max_bytes = 0
+        self.tag_ttl = {}
+        self.eviction_policy = "oldest"
+        self.eviction_grace = 72 * 3600
+        self.evictions = MemoryEvictionLog(self.directory)
+        self._open_memory_set()
+        self.tag_options = ["personal", "work", "education", "life", "person", "others"]
+
+    # Everything that belongs to the active memory file; switch_memory_file
+    # parks these in the cache and restores them when switching back.
+    _SET_ATTRIBUTES = (
+        "memory_file",
+        "storage",
+        "memory_data",
+        "text_index",
+        "vector_index",
+        "tag_index",
+        "order_index",
+        "time_index",
+        "duplicate_index",
+        "retention_index",
+        "indexes",
+        "access",
+        "_evicted",
+    )
+
+    def _path(self, file_name: str) -> str:
+        """Path of a memory file in the directory; ValueError for a bad name."""
+        return os.path.join(self.directory, _check_file_name(file_name))
+
+    @property
+    def vectors_file(self) -> str:
+        return self.memory_file + ".vectors.npz"
+
+    @property
+    def minhash_file(self) -> str:
+        return self.memory_file + ".minhash.npz"
+
+    def _open_memory_set(self):
+        """Load self.memory_file from disk and build its indexes."""
+        # Secondary indexes kept in sync with memory_data on every mutation.
+        self.text_index = MemoryTextIndex()
+        self.vector_index = MemoryVectorIndex()
+        self.tag_index = MemoryTagIndex()
+        self.order_index = MemoryOrderIndex()
+        self.time_index = MemoryTimeIndex()
+        self.duplicate_index = MemoryDuplicateIndex()
+        self.retention_index = MemoryRetentionIndex()
+        # memory index -> [last read (epoch seconds), times read], in memory only.
+        self.access = {}
+        # Eviction records waiting for the write that persists their deletes.
+        self._evicted = []
+        # The indexes kept up to date. The duplicate and retention indexes join
+        # them on the first duplicate check or capped write; see _use_index.
+        self.indexes = [
+            self.text_index,
+            self.vector_index,
+            self.tag_index,
+            self.order_index,
+            self.time_index,
+        ]
+        self.storage = self._open_storage(self.memory_file)
+        self.memory_data = self.load_memory()
+        self._rebuild_indexes()
+
+    def _detach(self) -> dict:
+        return {name: getattr(self, name) for name in self._SET_ATTRIBUTES}
+
+    def _attach(self, state: dict):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @staticmethod
+    def _write_back(state: dict):
+        """Fold pending changes of a memory set into its files and close it."""
+        state["storage"].compact(state["memory_data"])
+        MemoryFunctions._save_sidecars(state["indexes"])
+        state["storage"].close()
+
+    def _open_storage(self, memory_file: str) -> MemoryStorage:
+        storage_class = STORAGE_BACKENDS[self.backend]
+        storage = storage_class(
+            storage_class.path_for(memory_file),
+            telemetry=self.telemetry,
+            journal=self.journal,
+            compact_threshold=self.compact_threshold,
+        )
+        others = _other_storages(self.backend, memory_file, telemetry=self.telemetry)
+        # Import a memory file written under another backend the first time
+        # this one opens it, and keep the original aside as "<file>.migrated".
+        # An empty file of our own does not count: earlier versions created
+        # one when merely reading a set that lived under another backend.
+        try:
+            if others and (not storage.exists() or storage.count() == 0):
+                source = others[0]
+                self.telemetry.log(
+                    "Migrating memory file", source=source.path, path=storage.path
+                )
+                memory_data = source.load()
+                storage.next_id = source.next_id
+                source.close()
+                storage.save(memory_data)
+                for path in source.paths():
+                    # Lock files stay put, as other processes may hold them.
+                    if path != source.lock_path and os.path.exists(path):
+                        os.replace(path, path + ".migrated")
+        finally:
+            for other in others:
+                other.close()
+        return storage
+
+    def list_memory_files(self) -> list:
+        """Logical names ("<name>.json") of the memory files in the directory."""
+        return sorted(self.memory_file_stats())
+
+    def memory_file_stats(self) -> dict:
+        """{file name: entries, bytes, tags, last_modified} from the manifest."""
+        self.flush_manifest()
+        return self.manifest.files(
+            self._scan_memory_files,
+            lambda file_name: self.export_signature([file_name]),
+            self._file_stats,
+        )
+
+    def _file_stats(
+        self, file_name: str, memory_data: dict = None, tags: dict = None
+    ) -> dict:
+        if tags is None and memory_data is None:
+            tags = self.read_tag_counts(file_name)
+        elif tags is None:
+            tags = {}
+            for entry in memory_data.values():
+                tags[entry.get("tag")] = tags.get(entry.get("tag"), 0) + 1
+        signature = self._file_signature(file_name)
+        changed = max((mtime for _, mtime, _ in signature), default=0)
+        return {
+            "signature": self.export_signature([file_name]),
+            "entries": sum(tags.values()),
+            "bytes": sum(size for _, _, size in signature),
+            "tags": tags,
+            "last_modified": datetime.datetime.fromtimestamp(changed / 1e9).strftime(
+                "%Y-%m-%d_%H:%M:%S"
+            ),
+        }
+
+    def _update_manifest(self):
+        """Note that the active file was written; see flush_manifest."""
+        self._manifest_stale = True
+
+    def flush_manifest(self):
+        """
+        Record the stats of the active file in the manifest if it was written
+        since the last flush. Done once per tool call rather than per write.
+        """
+        if not self._manifest_stale:
+            return
+        file_name = os.path.basename(self.memory_file)
+        self.manifest.record(
+            file_name,
+            self._file_stats(file_name, self.memory_data, self.tag_index.counts()),
+        )
+        self._manifest_stale = False
+
+    def _scan_memory_files(self) -> list:
+        # Files of other backends are listed too; they are imported when opened.
+        suffixes = [storage_class.suffix for storage_class in STORAGE_BACKENDS.values()]
+        names = set()
+        for file in os.listdir(self.directory):
+            # A set written only through its journal has no snapshot yet.
+            file = file.removesuffix(".log")
+            for suffix in suffixes:
+                if file.endswith(suffix):
+                    names.add(file[: -len(suffix)] + ".json")
+        return sorted(names)
+
+    def migrate_memory_files(self) -> list:
+        """Import every memory file kept by another backend into the configured one."""
+        migrated = []
+        for file_name in self._scan_memory_files():
+            memory_file = self._path(file_name)
+            if memory_file == self.memory_file or not _other_storages(
+                self.backend, memory_file
+            ):
+                continue
+            self._open_storage(memory_file).close()
+            migrated.append(file_name)
+        return migrated
+
+    def delete_memory_file(self, file_name: str):
+        """Remove every file on disk that belongs to a memory file."""
+        memory_file = self._path(file_name)
+        cached = self.cache.discard(memory_file)
+        if cached is not None:
+            cached["storage"].close()
+        paths = [memory_file + ".vectors.npz", memory_file + ".minhash.npz"]
+        for storage_class in STORAGE_BACKENDS.values():
+            for path in storage_class(storage_class.path_for(memory_file)).paths():
+                paths += [path, path + ".migrated"]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.manifest.forget(file_name)
+
+    def read_memory_file(self, file_name: str) -> tuple:
+        """
+        Return (memory_data, next_id) of any memory file, from memory when it is
+        the active or a cached set and from disk otherwise.
+        """
+        memory_file = self._path(file_name)
+        cached = self.cache.peek(memory_file)
+        if memory_file == self.memory_file:
+            return self.memory_data, self.storage.next_id
+        if cached is not None:
+            return cached["memory_data"], cached["storage"].next_id
+        return self._read_stored_file(file_name)
+
+    def _read_stored_file(self, file_name: str) -> tuple:
+        """(memory_data, next_id) of a memory file as it is on disk."""
+        # Read from whichever backend has the file; migrating or creating one
+        # is left to opening it.
+        memory_file = self._path(file_name)
+        storage = _find_storage(self.backend, memory_file, telemetry=self.telemetry)
+        if storage is None:
+            return {}, 1
+        try:
+            return storage.load(), storage.next_id
+        finally:
+            storage.close()
+
+    def read_tag_counts(self, file_name: str) -> dict:
+        """
+        {tag: memories} of any memory file. One that is not in memory is counted
+        through the backend, which for binary and SQLite files decodes no memo.
+        """
+        memory_file = self._path(file_name)
+        cached = self.cache.peek(memory_file)
+        if memory_file == self.memory_file:
+            return self.tag_index.counts()
+        if cached is not None:
+            return cached["tag_index"].counts()
+        storage = _find_storage(self.backend, memory_file, telemetry=self.telemetry)
+        if storage is None:
+            return {}
+        try:
+            return storage.tag_counts()
+        finally:
+            storage.close()
+
+    def export_memory_file(self, file_name: str, copy: dict = None) -> bytes:
+        """
+        Return a memory file as plain JSON, whatever the backend.
+
+        :param copy: From export_copy; the file is then exported from the copy,
+            or from disk, without touching the sets in memory.
+        """
+        if copy is None:
+            memory_data, _ = self.read_memory_file(file_name)
+        elif copy[file_name] is not None:
+            memory_data = copy[file_name]
+        else:
+            memory_data, _ = self._read_stored_file(file_name)
+        # In id order, so the same data always exports to the same bytes.
+        memory_data = dict(sorted(memory_data.items()))
+        return json.dumps(memory_data, ensure_ascii=False, indent=4).encode("utf-8")
+
+    def export_copy(self, file_names: list) -> dict:
+        """
+        {file name: memory_data or None} for exporting the given files once the
+        store lock is released, as a download does: a copy, taken now, of each
+        set in memory, and None for a file that is only on disk.
+        """
+        copy = {}
+        for file_name in file_names:
+            memory_file = self._path(file_name)
+            if memory_file == self.memory_file:
+                memory_data = self.memory_data
+            else:
+                cached = self.cache.peek(memory_file)
+                memory_data = None if cached is None else cached["memory_data"]
+            # Entries are replaced, never changed in place, so a shallow copy
+            # does not change with the set.
+            copy[file_name] = None if memory_data is None else dict(memory_data)
+        return copy
+
+    def _file_signature(self, file_name: str) -> tuple:
+        """(path, mtime_ns, size) of every file on disk behind a memory file."""
+        memory_file = self._path(file_name)
+        signature = ()
+        for storage_class in STORAGE_BACKENDS.values():
+            signature += storage_class(storage_class.path_for(memory_file)).signature()
+        return signature
+
+    def export_signature(self, file_names: list) -> str:
+        """A short hash that changes whenever one of the given files changes."""
+        signature = [self._file_signature(file_name) for file_name in file_names]
+        return hashlib.sha1(repr(signature).encode("utf-8")).hexdigest()[:16]
+
+    def snapshot(self, label: str = "") -> dict:
+        """Take an incremental snapshot of every memory file in the directory."""
+        sources = {
+            file_name: (
+                self.export_signature([file_name]),
+                functools.partial(self.read_memory_file, file_name),
+            )
+            for file_name in self.list_memory_files()
+        }
+        return self.snapshots.take(sources, label)
+
+    def restore_snapshot(self, snapshot_id: str, file_names: list = None) -> list:
+        """
+        Put memory files back the way they were in a snapshot; all of them when no
+        file_names are given. Ids handed out since are still never reused.
+        """
+        if self._transaction is not None:
+            raise RuntimeError("Cannot restore a snapshot inside a transaction.")
+        record = self.snapshots.load(snapshot_id)
+        restored = []
+        for file_name in file_names or list(record["files"]):
+            memory_data, next_id = self.snapshots.read(record, file_name)
+            memory_file = self._path(file_name)
+            if memory_file == self.memory_file:
+                with self._exclusive():
+                    self.storage.next_id = max(self.storage.next_id, next_id)
+                    self.memory_data = memory_data
+                    self._rebuild_indexes()
+                    self.save_memory()
+            else:
+                cached = self.cache.discard(memory_file)
+                if cached is not None:
+                    cached["storage"].close()
+                storage = self._open_storage(memory_file)
+                try:
+                    with storage.locked():
+                        if storage.exists():
+                            storage.load()
+                        storage.next_id = max(storage.next_id, next_id)
+                        storage.save(memory_data)
+                finally:
+                    storage.close()
+                self.manifest.record(
+                    file_name, self._file_stats(file_name, memory_data)
+                )
+            restored.append(file_name)
+        self.telemetry.log(
+            "Restored from snapshot", files=restored, snapshot=snapshot_id
+        )
+        return restored
+
+    def stream_tarball(self, file_names: list, mtime: int = None, copy: dict = None):
+        """
+        Yield a .tar.gz of the JSON exports of the given memory files, chunk by
+        chunk as it is compressed; only one export is held in memory at a time.
+
+        With a fixed mtime, unchanged files always produce the same bytes, which
+        lets an interrupted download resume with a range request. copy is as
+        for export_memory_file.
+        """
+        if mtime is None:
+            mtime = int(time.time())
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=mtime) as compressed:
+            with tarfile.open(fileobj=compressed, mode="w|") as tar:
+                for file_name in file_names:
+                    content = self.export_memory_file(file_name, copy)
+                    info = tarfile.TarInfo(name=file_name)
+                    info.size = len(content)
+                    info.mtime = mtime
+                    tar.addfile(info, io.BytesIO(content))
+                    del content
+                    yield self._drain(buffer)
+        yield self._drain(buffer)
+
+    @staticmethod
+    def _drain(buffer: io.BytesIO) -> bytes:
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    def close(self):
+        """Write back the active and every cached memory set."""
+        self.flush_manifest()
+        for state in self.cache.drain():
+            self._write_back(state)
+        self._write_back(self._detach())
+
+    def cache_stats(self) -> dict:
+        return self.cache.stats()
+
+    def search_loaded_memory_files(self, query: str, top_k: int = 5) -> tuple:
+        """
+        Search the active and every cached memory set with their own indexes.
+
+        :return: ([(file name, 1-based index, entry, score)], [names of the other
+                 non-empty memory files, to be searched from disk]).
+        """
+        hits = []
+        loaded = set()
+        sets = [self._detach()] + [
+            self.cache.peek(memory_file) for memory_file in list(self.cache.entries)
+        ]
+        for state in sets:
+            file_name = os.path.basename(state["memory_file"])
+            loaded.add(file_name)
+            for index, score in state["text_index"].search(query, top_k):
+                ordinal = state["order_index"].ordinal(index)
+                hits.append((file_name, ordinal, state["memory_data"][index], score))
+        others = [
+            file_name
+            for file_name, stats in self.memory_file_stats().items()
+            if file_name not in loaded and stats.get("entries")
+        ]
+        return hits, others
+
+    def loaded_memory_files(self) -> list:
+        """Names of the active and every cached memory set."""
+        return [os.path.basename(self.memory_file)] + [
+            os.path.basename(memory_file) for memory_file in self.cache.entries
+        ]
+
+    def maintain(self, file_name: str) -> dict:
+        """
+        Housekeeping for one loaded memory set: rebuild any search index that
+        drifted from the data, fold a pending journal into the main file and
+        save a changed vector sidecar. Returns what was done.
+        """
+        memory_file = self._path(file_name)
+        report = {"file": file_name, "rebuilt": [], "compacted": False}
+        if memory_file == self.memory_file:
+            with self._exclusive():
+                report["evicted"] = self.enforce_retention()
+                for search_index in self.indexes:
+                    if len(search_index) != len(self.memory_data):
+                        search_index.rebuild(self.memory_data)
+                        report["rebuilt"].append(type(search_index).__name__)
+                if self.storage.pending():
+                    self.storage.compact(self.memory_data)
+                    report["compacted"] = True
+                self._save_indexes()
+                self._update_manifest()
+            return report
+        state = self.cache.peek(memory_file)
+        if state is None or not state["storage"].pending():
+            return report
+        if state["storage"].signature() != self.cache.entries[memory_file][1]:
+            # Changed by another process; leave it to be reloaded on switch.
+            self.cache.discard(memory_file)
+            state["storage"].close()
+            report["evicted"] = True
+        else:
+            state["storage"].compact(state["memory_data"])
+            state["vector_index"].save()
+            self.cache.update_signature(memory_file)
+            report["compacted"] = True
+        return report
+
+    def switch_memory_file(self, new_file: str):
+        """Switch and initialize operations on a new memory file in designated directory."""
+        if self._transaction is not None:
+            raise RuntimeError("Cannot switch memory files inside a transaction.")
+        self.flush_manifest()
+        # Park the outgoing set in the cache instead of dropping it; switching
+        # back to it later then costs nothing unless its files changed on disk.
+        for state in self.cache.put(self.memory_file, self._detach()):
+            self._write_back(state)
+        self.memory_file = self._path(new_file)
+        state = self.cache.take(self.memory_file)
+        if state is not None:
+            self._attach(state)
+        else:
+            self._open_memory_set()
+        self.telemetry.log("Switched memory file", path=self.memory_file)
+
+    @contextmanager
+    def _exclusive(self):
+        """
+        Lock the memory file against other processes for a read-modify-write and
+        catch up with whatever they wrote before it.
+        """
+        outermost = not self.storage.is_locked
+        with self.storage.locked():
+            if outermost:
+                self.refresh()
+            yield
+
+    def refresh(self) -> bool:
+        """
+        Pick up changes other processes made to the memory file. Cheap when there
+        are none; returns whether anything was reloaded.
+        """
+        changes = self.storage.changes()
+        if changes is None:
+            return False
+        if changes == "reload":
+            self.telemetry.log(
+                "Reloading memory file changed by another process",
+                path=self.memory_file,
+            )
+            self.memory_data = self.load_memory()
+            self._rebuild_indexes()
+            return True
+        for record in changes:
+            if record["op"] == "clear":
+                self.memory_data.clear()
+                for search_index in self.indexes:
+                    search_index.clear()
+                continue
+            index = int(record["index"])
+            if record["op"] == "put":
+                self._store_entry(index, record["entry"])
+            elif index in self.memory_data:
+                self._drop_entry(index)
+        return True
+
+    def memory_id(self, index):
+        """
+        Resolve a 1-based index as shown to the LLM (the position in id order) to
+        the stable memory id, or None when there is no such memory.
+        """
+        try:
+            return self.order_index.id_at(int(index))
+        except (TypeError, ValueError):
+            return None
+
+    def ordinal(self, memory_id: int) -> int:
+        """The 1-based index shown to the LLM for a memory id."""
+        return self.order_index.ordinal(memory_id)
+
+    def reindex_memory(self):
+        with self._exclusive():
+            return self._reindex_memory()
+
+    def _reindex_memory(self):
+        self.telemetry.log("Reindexing memory entries.")
+
+        # Ids are stable and the 1-based indices come from the order index, so
+        # there is nothing to renumber; rebuild the search indexes and fold
+        # pending changes into the memory file.
+        self._rebuild_indexes()
+        self.storage.compact(self.memory_data, force=True)
+        self._save_indexes()
+        self._update_manifest()
+
+        return "Memory reindexed successfully."
+
+    def delete_memory_by_index(self, index: int):
+        with self._exclusive():
+            return self._delete_memory_by_index(index)
+
+    def _delete_memory_by_index(self, index: int):
+        memory_id = self.memory_id(index)
+        if memory_id is not None:
+            self._remove_entry(memory_id)
+            self._persist([{"op": "delete", "index": memory_id}])
+            return f"Memory index {index} deleted successfully."
+        else:
+            return f"Memory index {index} does not exist."
+
+    def update_memory_by_index(self, index: int, tag: str, memo: str, by: str):
+        with self._exclusive():
+            return self._update_memory_by_index(index, tag, memo, by)
+
+    def _update_memory_by_index(self, index: int, tag: str, memo: str, by: str):
+        memory_id = self.memory_id(index)
+        if memory_id is not None:
+            if tag not in self.tag_options:
+                tag = "others"
+
+            # Update the entry
+            entry = dict(self.memory_data[memory_id])
+            entry["tag"] = tag
+            entry["memo"] = memo
+            entry["by"] = by
+            entry["last_modified"] = datetime.datetime.now().strftime(
+                "%Y-%m-%d_%H:%M:%S"
+            )
+            self._set_entry(memory_id, entry)
+            self._persist([{"op": "put", "index": memory_id, "entry": entry}])
+            return f"Memory index {index} updated successfully."
+        else:
+            return f"Memory index {index} does not exist."
+
+    @contextmanager
+    def transaction(self):
+        """
+        Apply several mutations in memory and write them to disk once, at commit.
+
+        If the commit fails, every mutation made inside the block is undone and the
+        exception is re-raised. Nested transactions join the outermost one; one
+        that fails is undone on its own and the outer one carries on.
+        """
+        if self._transaction is not None:
+            undo, records = self._transaction["undo"], self._transaction["records"]
+            savepoint = (len(undo), len(records), len(self._evicted))
+            try:
+                yield
+            except BaseException:
+                self._rollback(undo[savepoint[0] :])
+                del undo[savepoint[0] :]
+                del records[savepoint[1] :]
+                del self._evicted[savepoint[2] :]
+                raise
+            return
+
+        with self._exclusive():
+            self._transaction = {"records": [], "undo": []}
+            try:
+                yield
+                records = self._transaction["records"]
+                if records:
+                    self._write(records)
+            except BaseException:
+                self._rollback(self._transaction["undo"])
+                self._evicted = []
+                raise
+            finally:
+                self._transaction = None
+
+    def _set_entry(self, index, entry: dict):
+        self._remember(index)
+        self._store_entry(index, entry)
+
+    def _remove_entry(self, index):
+        self._remember(index)
+        self._drop_entry(index)
+
+    def _store_entry(self, index, entry: dict):
+        previous = self.memory_data.get(index)
+        self.memory_data[index] = entry
+        for search_index in self.indexes:
+            if previous is not None:
+                search_index.replace(index, previous, entry)
+            else:
+                search_index.add(index, entry)
+
+    def _drop_entry(self, index):
+        self.access.pop(index, None)
+        entry = self.memory_data.pop(index)
+        for search_index in self.indexes:
+            search_index.remove(index, entry)
+
+    def _rebuild_indexes(self):
+        self.vector_index.path = self.vectors_file
+        self.duplicate_index.path = self.minhash_file
+        for search_index in self.indexes:
+            search_index.rebuild(self.memory_data)
+
+    def _save_indexes(self):
+        """Write the index files kept next to the memory file, if they changed."""
+        self._save_sidecars(self.indexes)
+
+    @staticmethod
+    def _save_sidecars(indexes: list):
+        # Only indexes that are built: an unbuilt one would overwrite its file
+        # with an empty index.
+        for search_index in indexes:
+            if hasattr(search_index, "save"):
+                search_index.save()
+
+    def _use_index(self, search_index):
+        """
+        Build an index that is only kept up to date once something needs it,
+        so a memory set never checked for duplicates or capped does not hash
+        or size every memo.
+        """
+        if search_index not in self.indexes:
+            search_index.rebuild(self.memory_data)
+            self.indexes.append(search_index)
+        return search_index
+
+    def _remember(self, index):
+        """Record the current value of an entry so a failed transaction can restore it."""
+        if self._transaction is not None:
+            self._transaction["undo"].append((index, self.memory_data.get(index)))
+
+    def _rollback(self, undo: list):
+        self.telemetry.log("Rolling back memory changes", changes=len(undo))
+        for index, previous in reversed(undo):
+            if index is _ALL_ENTRIES:
+                self.memory_data.clear()
+                self.memory_data.update(previous)
+                self._rebuild_indexes()
+            elif previous is None:
+                if index in self.memory_data:
+                    self._drop_entry(index)
+            else:
+                self._store_entry(index, previous)
+
+    def load_memory(self):
+        return self.storage.load()
+
+    def save_memory(self):
+        self.storage.save(self.memory_data)
+        self._save_indexes()
+        self._update_manifest()
+
+    def compact(self, force: bool = False):
+        """Let the storage fold pending changes into its main file."""
+        with self._exclusive():
+            self.storage.compact(self.memory_data, force)
+            self._save_indexes()
+            self._update_manifest()
+
+    def _persist(self, records: list):
+        """Persist mutation records now, or at commit when inside a transaction."""
+        if self._transaction is not None:
+            self._transaction["records"].extend(records)
+        else:
+            self._write(records)
+
+    def _write(self, records: list):
+        self.storage.apply(records, self.memory_data)
+        self._update_manifest()
+        if self._evicted:
+            # Logged only once the deletes are on disk.
+            self.evictions.append(os.path.basename(self.memory_file), self._evicted)
+            self._evicted = []
+
+    def add_to_memory(self, tag: str, memo: str, by: str) -> tuple:
+        with self._exclusive():
+            return self._add_to_memory(tag, memo, by)
+
+    def _add_to_memory(self, tag: str, memo: str, by: str) -> tuple:
+        """
+        Store a memo unless duplicate_policy says otherwise.
+
+        :return: (memory id, "added" | "skipped" | "merged"); for the latter two
+                 the id is that of the existing near-duplicate.
+        """
+        if tag not in self.tag_options:
+            tag = "others"
+
+        if self.duplicate_policy in ("skip", "merge"):
+            duplicates = self.find_duplicates(memo)
+            if duplicates:
+                index = duplicates[0][0]
+                if self.duplicate_policy == "skip":
+                    return index, "skipped"
+                self._merge_into(index, {"tag": tag, "memo": memo, "by": by})
+                return index, "merged"
+
+        index = self.storage.allocate_id()
+        entry = {
+            "tag": tag,
+            "memo": memo,
+            "by": by,
+            "last_modified": datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S"),
+        }
+        self._set_entry(index, entry)
+        self._persist([{"op": "put", "index": index, "entry": entry}])
+        self._enforce_capacity(exclude=index)
+        return index, "added"
+
+    def find_duplicates(self, memo: str, where: Callable = None) -> list:
+        """(memory id, similarity) of the stored near-duplicates of a memo."""
+        return self._use_index(self.duplicate_index).find(
+            memo, self.memory_data, self.duplicate_threshold, where
+        )
+
+    def _merge_into(self, index, other: dict):
+        """
+        Fold a newer near-duplicate into an existing memory. The newer wording
+        wins, as it is usually a correction ("is 6 years old" after "is 5 years
+        old"); so do its author and time, and its tag unless that is "others".
+        """
+        entry = dict(self.memory_data[index])
+        entry["memo"] = other.get("memo", entry.get("memo"))
+        if other.get("tag") in self.tag_options and other.get("tag") != "others":
+            entry["tag"] = other["tag"]
+        entry["by"] = other.get("by", entry.get("by"))
+        entry["last_modified"] = other.get(
+            "last_modified", datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+        )
+        self._set_entry(index, entry)
+        self._persist([{"op": "put", "index": index, "entry": entry}])
+
+    def deduplicate(self, dry_run: bool = False) -> list:
+        """
+        Remove the near-duplicates already stored in the active file.
+
+        Memories are visited from the most recently changed one back and each is
+        compared with the newer memories kept so far, so of every group of
+        near-duplicates the newest survives: an older one is usually what a
+        later memo corrected. All changes are written at once.
+
+        :return: (kept id, removed id, similarity) per removed memory.
+        """
+        with self.transaction():
+            removed = []
+            kept_ids = set()
+            for _, index in reversed(list(self.time_index.entries)):
+                entry = self.memory_data[index]
+                duplicates = self.find_duplicates(
+                    str(entry.get("memo", "")), kept_ids.__contains__
+                )
+                if not duplicates:
+                    kept_ids.add(index)
+                    continue
+                kept, score = duplicates[0]
+                removed.append((kept, index, score))
+                if dry_run:
+                    continue
+                self._remove_entry(index)
+                self._persist([{"op": "delete", "index": index}])
+            return removed
+
+    # Other methods remain unchanged...
+    def retrieve_from_memory(self, key: str):
+        self.telemetry.log("Retrieving from memory", key=key)
+        return self.memory_data.get(key, None)
+
+    def process_input_for_memory(self, input_text: str):
+        return {"timestamp": str(datetime.datetime.now()), "input": input_text}
+
+    def search_memories(
+        self, query: str, top_k: int = 5, tag: str = None, mode: str = "keyword"
+    ) -> list:
+        """
+        Return the best matching entries for a query as (index, entry, score).
+
+        mode is "keyword" for BM25 over the memo words or "semantic" for cosine
+        similarity over the local n-gram embeddings, which also finds rephrasings.
+        """
+        where = None
+        if tag is not None:
+            where = self.tag_index.bucket(tag).__contains__
+        search_index = self.vector_index if mode == "semantic" else self.text_index
+        results = search_index.search(query, top_k, where)
+        self._touch(index for index, _ in results)
+        return [(index, self.memory_data[index], score) for index, score in results]
+
+    def recall_by_tag(self, tags: list, limit: int = 20, offset: int = 0) -> list:
+        """Return (index, entry) pairs from the given tag buckets, in bucket order."""
+        indices = itertools.chain.from_iterable(
+            self.tag_index.bucket(tag) for tag in dict.fromkeys(tags)
+        )
+        page = list(itertools.islice(indices, offset, offset + limit))
+        self._touch(page)
+        return [(index, self.memory_data[index]) for index in page]
+
+    def recent_memories(self, count: int) -> list:
+        """(memory id, entry) of the count most recently changed memories, newest first."""
+        indices = self.time_index.latest(count)
+        self._touch(indices)
+        return [(index, self.memory_data[index]) for index in indices]
+
+    def memories_between(
+        self, start: int = None, end: int = None, limit: int = None
+    ) -> tuple:
+        """
+        (number of memories changed within [start, end] epoch seconds, (memory id,
+        entry) of the last limit of them, oldest first).
+        """
+        indices = self.time_index.between(start, end, limit)
+        self._touch(indices)
+        total = self.time_index.count(start, end)
+        return total, [(index, self.memory_data[index]) for index in indices]
+
+    def page_memories(self, cursor: int = None):
+        """
+        Iterate over (1-based index, memory id, entry) in id order after a cursor,
+        which is the memory id of the last entry of the previous page.
+        """
+        for ordinal, index in self.order_index.after(cursor):
+            self._touch((index,))
+            yield ordinal, index, self.memory_data[index]
+
+    def _touch(self, indices):
+        """Count a read of these memories for the "lru" and "relevance" policies."""
+        now = time.time()
+        for index in indices:
+            access = self.access.setdefault(index, [now, 0])
+            access[0] = now
+            access[1] += 1
+
+    def _eviction_key(self, policy: str) -> Callable:
+        """Sort key of a memory index; the smallest one is evicted first."""
+        if policy == "lru":
+            return lambda index: (
+                self.access.get(index, (None,))[0] or self.time_index.times[index]
+            )
+        if policy == "relevance":
+            return lambda index: (
+                self.access.get(index, (0, 0))[1],
+                self.time_index.times[index],
+            )
+        return self.time_index.times.__getitem__
+
+    def _evict(self, index, reason: str):
+        entry = self.memory_data[index]
+        self._remove_entry(index)
+        # Queued before the delete is persisted, so the _write that puts the
+        # delete on disk (now, or at commit) also logs it under this set's file.
+        self._evicted.append(
+            {"id": index, "entry": entry, "reason": reason, "evicted_at": time.time()}
+        )
+        self._persist([{"op": "delete", "index": index}])
+        self.telemetry.log("Evicted memory", index=index, reason=reason)
+
+    def _enforce_capacity(self, exclude=None) -> int:
+        """Evict memories while the file is over a cap, never the one in exclude."""
+        if not (self.max_entries or self.max_bytes):
+            return 0
+        retention_index = self._use_index(self.retention_index)
+        policy = self.eviction_policy
+        if policy not in ("oldest", "lru", "relevance"):
+            policy = "oldest"
+        key = self._eviction_key(policy)
+        evicted = 0
+        while (self.max_entries and len(self.memory_data) > self.max_entries) or (
+            self.max_bytes and retention_index.bytes > self.max_bytes
+        ):
+            index = retention_index.next_victim(policy, key, exclude)
+            if index is None:
+                break
+            reason = "max_entries"
+            if not (self.max_entries and len(self.memory_data) > self.max_entries):
+                reason = "max_bytes"
+            self._evict(index, f"{reason} ({policy})")
+            evicted += 1
+        return evicted
+
+    def enforce_retention(self) -> int:
+        """Evict expired memories per tag_ttl, then enforce the caps."""
+        with self.transaction():
+            now = time.time()
+            evicted = 0
+            for tag, ttl in self.tag_ttl.items():
+                if ttl <= 0:
+                    continue
+                for index in self.time_index.between(None, now - ttl):
+                    if self.memory_data[index].get("tag") == tag:
+                        self._evict(index, f"ttl ({tag})")
+                        evicted += 1
+            evicted += self._enforce_capacity()
+        self.evictions.prune(os.path.basename(self.memory_file), self.eviction_grace)
+        return evicted
+
+    def evicted_memories(self) -> list:
+        """Eviction records of the active file that can still be undone."""
+        return self.evictions.records(
+            os.path.basename(self.memory_file), self.eviction_grace
+        )
+
+    def restore_evicted(self, ids: list = None) -> list:
+        """
+        Put evicted memories back under their old ids: all that can still be
+        undone, or those in ids. Restoring does not evict anything in turn.
+        """
+        file_name = os.path.basename(self.memory_file)
+        records = self.evictions.records(file_name, self.eviction_grace)
+        if ids is not None:
+            wanted = {int(index) for index in ids}
+            records = [record for record in records if record["id"] in wanted]
+        restored = []
+        with self.transaction():
+            for record in records:
+                index = int(record["id"])
+                if index in self.memory_data:
+                    continue
+                self._set_entry(index, record["entry"])
+                self._persist([{"op": "put", "index": index, "entry": record["entry"]}])
+                restored.append(index)
+        # Dropped from the log only once the memories are back on disk.
+        self.evictions.take(
+            file_name, self.eviction_grace, [record["id"] for record in records]
+        )
+        return restored
+
+    def tag_counts(self) -> dict:
+        return self.tag_index.counts()
+
+    def get_all_memories(self) -> dict:
+        self.telemetry.log("Retrieving all memories.")
+        return self.memory_data
+
+    def clear_memory(self):
+        with self._exclusive():
+            return self._clear_memory()
+
+    def _clear_memory(self):
+        self.telemetry.log("Clearing all memory entries.")
+        if self._transaction is not None:
+            self._transaction["undo"].append((_ALL_ENTRIES, dict(self.memory_data)))
+        self.memory_data.clear()
+        self.access.clear()
+        for search_index in self.indexes:
+            search_index.clear()
+        self._persist([{"op": "clear"}])
+        return "ALL MEMORIES CLEARED!"
+
+
+def _search_memory_file(backend: str, memory_file: str, query: str, top_k: int) -> list:
+    """
+    Worker of search_all_memory_files for a memory file that is not in memory:
+    load it, rank it with a throwaway BM25 index and return its top_k as
+    (1-based index, entry, score). Only reads; a file kept by another backend
+    that was not migrated yet is read as it is.
+    """
+    storage = _find_storage(backend, memory_file)
+    if storage is None:
+        return []
+    try:
+        memory_data = storage.load()
+    finally:
+        storage.close()
+    text_index = MemoryTextIndex(vocabulary=set(MemoryTextIndex.tokenize(query)))
+    text_index.rebuild(memory_data)
+    ids = sorted(memory_data)
+    return [
+        (bisect.bisect_left(ids, index) + 1, memory_data[index], score)
+        for index, score in text_index.search(query, top_k)
+    ]
+
+
+# Run by every search worker before its first task. Open WebUI loads a tool
+# under a module name that a fresh interpreter cannot import, so the worker
+# loads this file under that same name, where the pickled reference to
+# _search_memory_file then resolves.
+_SEARCH_WORKER_BOOTSTRAP = """
+import sys, importlib.util
+spec = importlib.util.spec_from_file_location(name, path)
+module = importlib.util.module_from_spec(spec)
+sys.modules[name] = module
+spec.loader.exec_module(module)
+"""
+
+
+class MemoryIO:
+    """
+    Runs blocking memory file work on a bounded thread pool so the event loop
+    keeps serving other requests, with one asyncio lock per key to keep writes
+    to the same memory store in order.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers), thread_name_prefix="memory-io"
+        )
+        self.locks = {}
+
+    def lock(self, key: str) -> asyncio.Lock:
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        return lock
+
+    def forget(self, key: str):
+        """Drop the lock of key unless it is held; lock(key) makes a new one."""
+        lock = self.locks.get(key)
+        if lock is not None and not lock.locked():
+            del self.locks[key]
+
+    async def run(self, function: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs)
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class MemoryStores:
+    """
+    Working set of memory stores, one per user: opened on first use and closed
+    again, least recently used first, once more than max_open are open or one
+    has been idle for idle_seconds. A store in use by a tool call is never
+    closed; one replaced while in use is closed when that call ends.
+
+    Opening a store reads from disk, so it happens outside the shared lock and
+    only serializes callers of the same user. Nothing is kept per key once its
+    store is closed.
+    """
+
+    def __init__(self, max_open: int = 64, idle_seconds: float = 1800):
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self.stores = OrderedDict()  # key -> MemoryFunctions, least recently used first
+        self.used = {}  # key -> time.monotonic() of the last use
+        self.pins = {}  # id(MemoryFunctions) -> tool calls using it
+        self.retired = []
+        self.lock = threading.Lock()
+        # key -> [threading.Lock, callers in acquire()], only while opening.
+        self.opening = {}
+
+    def acquire(self, key, open_store: Callable, touch: bool = True) -> MemoryFunctions:
+        """
+        The store for key, opened with open_store(key) if needed, pinned.
+
+        :param touch: Count this as a use. Housekeeping passes False, so it
+            keeps neither an idle store open nor its place in the LRU order.
+        """
+        with self.lock:
+            opening = self.opening.get(key)
+            if opening is None:
+                opening = self.opening[key] = [threading.Lock(), 0]
+            opening[1] += 1
+        try:
+            with opening[0]:
+                with self.lock:
+                    # Looked up and pinned in one go, so _collect cannot close
+                    # it in between.
+                    memory = self.stores.get(key)
+                    if memory is not None:
+                        return self._pin(key, memory, touch)
+                memory = open_store(key)
+                with self.lock:
+                    return self._pin(key, memory, True)
+        finally:
+            with self.lock:
+                opening[1] -= 1
+                if not opening[1]:
+                    del self.opening[key]
+
+    def _pin(self, key, memory: MemoryFunctions, touch: bool) -> MemoryFunctions:
+        self.stores[key] = memory
+        if touch:
+            self.stores.move_to_end(key)
+            self.used[key] = time.monotonic()
+        self.pins[id(memory)] = self.pins.get(id(memory), 0) + 1
+        return memory
+
+    def release(self, memory: MemoryFunctions) -> list:
+        """Unpin a store; returns the stores that should now be closed."""
+        with self.lock:
+            pins = self.pins.pop(id(memory), 1) - 1
+            if pins:
+                self.pins[id(memory)] = pins
+            return self._collect()
+
+    def collect(self) -> list:
+        with self.lock:
+            return self._collect()
+
+    def _collect(self) -> list:
+        closing = []
+        now = time.monotonic()
+        for key in list(self.stores):
+            memory = self.stores[key]
+            if id(memory) in self.pins:
+                continue
+            over = len(self.stores) > max(self.max_open, 1)
+            idle = self.idle_seconds and now - self.used[key] > self.idle_seconds
+            if over or idle:
+                del self.stores[key]
+                del self.used[key]
+                closing.append(memory)
+        retired = [memory for memory in self.retired if id(memory) in self.pins]
+        closing.extend(memory for memory in self.retired if id(memory) not in self.pins)
+        self.retired = retired
+        return closing
+
+    def retire_all(self) -> list:
+        """Forget every store, e.g. after a storage setting changed."""
+        with self.lock:
+            self.retired.extend(self.stores.values())
+            self.stores.clear()
+            self.used.clear()
+            return self._collect()
+
+    def keys(self) -> list:
+        with self.lock:
+            return list(self.stores)
+
+    def __len__(self) -> int:
+        return len(self.stores)
+
+
+class MemoryDownloadServer:
+    """
+    One long-lived asyncio HTTP server for every download link of a Tools
+    instance.
+
+    A link is /<token>/<file name>; the token names a registered download, its
+    expiry time and an HMAC over both, so links cannot be forged or extended.
+    Bodies are produced on the I/O pool while they are sent: without a Range
+    header as a chunked stream, with one as a 206 slice of the same bytes.
+    """
+
+    chunk_size = 64 * 1024
+    STATUS = {
+        200: "OK",
+        206: "Partial Content",
+        400: "Bad Request",
+        404: "Not Found",
+        405: "Method Not Allowed",
+        416: "Range Not Satisfiable",
+    }
+
+    def __init__(
+        self,
+        io: "MemoryIO",
+        port: int = 0,
+        ttl: int = 600,
+        single_use: bool = False,
+        telemetry: MemoryTelemetry = None,
+    ):
+        self.io = io
+        self.port = port
+        self.ttl = ttl
+        self.single_use = single_use
+        self.telemetry = telemetry or MemoryTelemetry()
+        self.key = secrets.token_bytes(32)
+        self.downloads = {}  # download id -> dict, see register()
+        self.server = None
+
+    async def start(self):
+        if self.server is None:
+            try:
+                self.server = await asyncio.start_server(self._handle, "", self.port)
+            except OSError as e:
+                if e.errno != errno.EADDRINUSE or not self.port:
+                    raise
+                # Most likely held by the server of a Tools instance a reload
+                # replaced and the garbage collector has not got to yet;
+                # collecting it lets its finalizer close the socket.
+                gc.collect()
+                await asyncio.sleep(0)
+                self.server = await asyncio.start_server(self._handle, "", self.port)
+            self.telemetry.log("Download server listening", address=self.address)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def shutdown(self):
+        """Stop listening without waiting; safe from any thread, see Tools."""
+        server, self.server = self.server, None
+        if server is None:
+            return
+        try:
+            server.get_loop().call_soon_threadsafe(server.close)
+        except RuntimeError:
+            # The event loop is closed already, e.g. at interpreter exit.
+            server.close()
+
+    @property
+    def address(self) -> tuple:
+        # Listening on every interface opens an IPv4 and an IPv6 socket.
+        sockets = sorted(
+            self.server.sockets, key=lambda sock: sock.family != socket.AF_INET
+        )
+        return sockets[0].getsockname()[:2]
+
+    def register(self, file_name: str, chunks: Callable, etag: Callable) -> str:
+        """
+        Publish a download and return its path.
+
+        chunks() returns an iterator over the body and must produce the same
+        bytes for as long as etag() returns the same value.
+        """
+        self._expire()
+        download_id = secrets.token_urlsafe(12)
+        expires = int(time.time()) + self.ttl
+        self.downloads[download_id] = {
+            "file_name": file_name,
+            "chunks": chunks,
+            "etag": etag,
+            "expires": expires,
+            "size": None,  # (etag, size) once a range request needed it
+        }
+        payload = f"{download_id}.{expires}"
+        return f"/{payload}.{self._sign(payload)}/{file_name}"
+
+    def _sign(self, payload: str) -> str:
+        digest = hmac.new(self.key, payload.encode("utf-8"), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:18]).decode("ascii")
+
+    def _expire(self):
+        now = time.time()
+        for download_id in [
+            key for key, value in self.downloads.items() if value["expires"] < now
+        ]:
+            del self.downloads[download_id]
+
+    def _resolve(self, target: str):
+        """The (id, download) a request path points at, or None."""
+        token = target.split("?", 1)[0].lstrip("/").split("/", 1)[0]
+        payload, _, signature = token.rpartition(".")
+        download_id, _, expires = payload.partition(".")
+        if not hmac.compare_digest(self._sign(payload), signature):
+            return None
+        if not expires.isdigit() or int(expires) < time.time():
+            return None
+        download = self.downloads.get(download_id)
+        return (download_id, download) if download is not None else None
+
+    @staticmethod
+    def _parse_range(header: str, size: int):
+        """
+        Return (start, end) for a single "bytes=" range, "unsatisfiable", or None
+        when the header asks for something else and the full body is sent.
+        """
+        unit, _, spec = header.partition("=")
+        if unit.strip() != "bytes" or "," in spec:
+            return None
+        first, _, last = spec.strip().partition("-")
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+            else:
+                start, end = max(size - int(last), 0), size - 1
+        except ValueError:
+            return None
+        if start >= size or start > end:
+            return "unsatisfiable"
+        return start, min(end, size - 1)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 30)
+            lines = request.decode("latin-1").split("\r\n")
+            method, target, _ = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                if name:
+                    headers[name.strip().lower()] = value.strip()
+            await self._respond(method, target, headers, writer)
+        except (asyncio.LimitOverrunError, ValueError):
+            await self._send_head(writer, 400)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _send_head(self, writer, status: int, headers: dict = None):
+        lines = [f"HTTP/1.1 {status} {self.STATUS[status]}", "Connection: close"]
+        if headers is None:
+            headers = {"Content-Length": "0"}
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def _respond(self, method: str, target: str, headers: dict, writer):
+        if method not in ("GET", "HEAD"):
+            await self._send_head(writer, 405, {"Allow": "GET, HEAD"})
+            return
+        resolved = self._resolve(target)
+        if resolved is None:
+            await self._send_head(writer, 404)
+            return
+        download_id, download = resolved
+
+        etag = '"' + await self.io.run(download["etag"]) + '"'
+        head = {
+            "Content-Type": "application/octet-stream",
+            "Content-Disposition": f'attachment; filename="{download["file_name"]}"',
+            "Accept-Ranges": "bytes",
+            "ETag": etag,
+        }
+        span = None
+        if "range" in headers and headers.get("if-range", etag) == etag:
+            size = await self._size(download, etag)
+            span = self._parse_range(headers["range"], size)
+            if span == "unsatisfiable":
+                await self._send_head(writer, 416, {"Content-Range": f"bytes */{size}"})
+                return
+        if span is None:
+            status, start, end = 200, 0, None
+            head["Transfer-Encoding"] = "chunked"
+        else:
+            status, (start, end) = 206, span
+            head["Content-Length"] = str(end - start + 1)
+            head["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await self._send_head(writer, status, head)
+        if method == "HEAD":
+            return
+
+        complete = await self._send_body(writer, download, start, end)
+        if complete and self.single_use:
+            self.downloads.pop(download_id, None)
+        self.telemetry.log(
+            "Served download",
+            file=download["file_name"],
+            status=status,
+            complete=complete,
+        )
+
+    async def _size(self, download: dict, etag: str) -> int:
+        if download["size"] is None or download["size"][0] != etag:
+            size = await self.io.run(
+                lambda: sum(len(chunk) for chunk in download["chunks"]())
+            )
+            download["size"] = (etag, size)
+        return download["size"][1]
+
+    async def _send_body(self, writer, download: dict, start: int, end: int) -> bool:
+        """Stream bytes start..end (or everything when end is None, chunked)."""
+        chunks = iter(download["chunks"]())
+        position = 0
+        try:
+            while end is None or position <= end:
+                chunk = await self.io.run(next, chunks, None)
+                if chunk is None:
+                    break
+                chunk_start, position = position, position + len(chunk)
+                if position <= start:
+                    continue
+                piece = chunk[max(start - chunk_start, 0) :]
+                if end is not None:
+                    piece = piece[: end - max(start, chunk_start) + 1]
+                for offset in range(0, len(piece), self.chunk_size):
+                    part = piece[offset : offset + self.chunk_size]
+                    if end is None:
+                        part = b"%x\r\n%s\r\n" % (len(part), part)
+                    writer.write(part)
+                    await writer.drain()
+            if end is None:
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+            return True
+        finally:
+            await self.io.run(getattr(chunks, "close", lambda: None))
+
+
+class EventEmitter:
+    def __init__(self, event_emitter: Callable[[dict], Any] = None):
+        self.event_emitter = event_emitter
+
+    async def emit(self, description="Unknown state", status="in_progress", done=False):
+        if self.event_emitter:
+            await self.event_emitter(
+                {
+                    "type": "status",
+                    "data": {
+                        "status": status,
+                        "description": description,
+                        "done": done,
+                    },
+                }
+            )
+
+
+class Tools:
+    class Valves(BaseModel):
+        USE_MEMORY: bool = Field(
+            default=True, description="Enable or disable memory usage."
+        )
+        MEMORY_REFRESH_INTERVAL: int = Field(
+            default=60,
+            description="Minutes between background maintenance passes (journal compaction, index checks, stats); 0 disables them.",
+        )
+        DEBUG: bool = Field(
+            default=False,
+            description="Log debug events, with memo text cut to TELEMETRY_MAX_PAYLOAD characters, to the telemetry sinks (the Python logger when none is set).",
+        )
+        TELEMETRY_SINKS: str = Field(
+            default="",
+            description='Where to report the timing of every tool, storage and event emitter call, comma-separated: "logging", "jsonl" (memory_jsons/.telemetry/events.jsonl) and "prometheus" (counters in memory_jsons/.telemetry/metrics.prom). Empty turns it off.',
+        )
+        TELEMETRY_MAX_PAYLOAD: int = Field(
+            default=200,
+            description="Characters of a memo or other text kept in a telemetry record.",
+        )
+        RECALL_MAX_CHARS: int = Field(
+            default=16000,
+            description="Upper bound on the characters returned by one recall_memories call; 0 disables it.",
+        )
+        JOURNAL_MODE: bool = Field(
+            default=True,
+            description="Append each change to a journal instead of rewriting the whole memory file.",
+        )
+        JOURNAL_COMPACT_BYTES: int = Field(
+            default=1024 * 1024,
+            description="Journal size in bytes after which it is folded back into the memory file.",
+        )
+
+        STORAGE_BACKEND: str = Field(
+            default="json",
+            description='Storage engine for memory files: "json", "binary" (compact, memory-mapped) or "sqlite". Existing JSON files are imported when first opened.',
+        )
+
+        MEMORY_CACHE_MAX_FILES: int = Field(
+            default=4,
+            description="How many recently used memory files stay parsed in memory after switching away.",
+        )
+        MEMORY_CACHE_MAX_BYTES: int = Field(
+            default=64 * 1024 * 1024,
+            description="Upper bound on the on-disk size of the memory files kept parsed in memory.",
+        )
+
+        IO_THREADS: int = Field(
+            default=4,
+            description="Number of background threads used for memory file reads and writes.",
+        )
+
+        SNAPSHOT_BEFORE_DESTRUCTIVE: bool = Field(
+            default=True,
+            description="Take an incremental snapshot before clearing memories, deleting a memory file or restoring a snapshot.",
+        )
+
+        DUPLICATE_POLICY: str = Field(
+            default="store",
+            description='What to do with a new memo that nearly repeats a stored one: "store" it anyway, "merge" it into the stored memory (the new wording replaces the old) or "skip" it. Corrections such as a changed date or number look like near-duplicates, so "skip" can lose them.',
+        )
+        DUPLICATE_THRESHOLD: float = Field(
+            default=0.9,
+            description="Similarity (0-1, over character 4-grams) from which two memos count as near-duplicates.",
+        )
+
+        MEMORY_MAX_ENTRIES: int = Field(
+            default=0,
+            description="Maximum number of memories per memory file; adding past it evicts per EVICTION_POLICY. 0 means no limit.",
+        )
+        MEMORY_MAX_BYTES: int = Field(
+            default=0,
+            description="Maximum size of the memories of one memory file in bytes. 0 means no limit.",
+        )
+        MEMORY_TAG_TTL_DAYS: str = Field(
+            default="",
+            description='Days after their last change that memories of a tag expire, e.g. "work=30, others=90". Checked by the background maintenance.',
+        )
+        EVICTION_POLICY: str = Field(
+            default="oldest",
+            description='Which memories go first when a file is over its limit: "oldest" (last change), "lru" (last read) or "relevance" (least often read).',
+        )
+        EVICTION_UNDO_HOURS: int = Field(
+            default=72,
+            description="Hours during which an evicted memory can be restored with undo_memory_eviction.",
+        )
+
+        SEARCH_PROCESSES: int = Field(
+            default=4,
+            description="Worker processes used by search_all_memory_files for memory files that are not loaded; 0 searches them on the I/O threads.",
+        )
+
+        PER_USER_MEMORY: bool = Field(
+            default=False,
+            description="Give every Open WebUI user their own memory files in memory_jsons/users/<user id>/; off, all users share memory_jsons/. Files already in memory_jsons/ are not moved, so users no longer see them once this is on.",
+        )
+        MAX_OPEN_USERS: int = Field(
+            default=64,
+            description="How many users' memory stores stay open at once; the least recently used one is closed first.",
+        )
+        USER_IDLE_MINUTES: int = Field(
+            default=30,
+            description="Minutes without a tool call after which a user's memory store is closed; 0 keeps it open.",
+        )
+
+        DOWNLOAD_PORT: int = Field(
+            default=0,
+            description="Port of the download server; 0 picks a free port.",
+        )
+        DOWNLOAD_BASE_URL: str = Field(
+            default="",
+            description="Start of the download links as users' browsers reach the download server, e.g. https://memory.example.com behind a reverse proxy; empty uses http://localhost:<port>.",
+        )
+        DOWNLOAD_LINK_TTL: int = Field(
+            default=600,
+            description="Seconds a download link stays valid.",
+        )
+        DOWNLOAD_SINGLE_USE: bool = Field(
+            default=False,
+            description="Expire a download link as soon as it has been downloaded once.",
+        )
+
+    def __init__(self):
+        self.valves = self.Valves()
+        self._stores = MemoryStores()
+        self._settings_lock = threading.Lock()
+        self._memory_settings = None
+        self.telemetry = MemoryTelemetry()
+        self._telemetry_settings = None
+        self._io = None
+        self._downloads = None
+        self._search_pool = None  # (ProcessPoolExecutor, SEARCH_PROCESSES)
+        self._maintenance = None
+        self._maintenance_stats = {"runs": 0, "last_run": None, "last_duration": 0.0}
+        # Store key -> maintenance counters and last report of that store.
+        self._store_maintenance = {}
+        # (user id, operation, target) -> when a destructive call asked for
+        # confirmation; see _confirmation_pending.
+        self._confirmations = {}
+        # Open WebUI replaces the Tools instance when the tool is reloaded or its
+        # code changes. Everything an instance holds is released together with
+        # it (and at exit); each resource gets its finalizer when it is created.
+        weakref.finalize(self, self._close_all_stores, self._stores)
+
+    @staticmethod
+    def _close_all_stores(stores: "MemoryStores"):
+        for memory in stores.retire_all():
+            try:
+                Tools._close_store(memory)
+            except Exception as e:
+                logging.getLogger("gpt4_memory_mimic").warning(
+                    "Closing memory store %s failed: %s", memory.directory, e
+                )
+
+    @staticmethod
+    def _cancel_task(task: asyncio.Task):
+        """Cancel a task from whatever thread the garbage collector runs in."""
+        try:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+        except RuntimeError:
+            pass  # Its event loop is closed, so the task is not running anymore.
+
+    def _configure_telemetry(self):
+        """Set up the telemetry sinks from the valves, once per change."""
+        settings = (
+            self.valves.TELEMETRY_SINKS,
+            self.valves.DEBUG,
+            self.valves.TELEMETRY_MAX_PAYLOAD,
+        )
+        if settings == self._telemetry_settings:
+            return
+        self._telemetry_settings = settings
+        names = {name.strip() for name in self.valves.TELEMETRY_SINKS.split(",")}
+        if self.valves.DEBUG and not names - {""}:
+            names = {"logging"}
+        directory = os.path.join("memory_jsons", ".telemetry")
+        sinks = []
+        if "logging" in names:
+            sinks.append(LoggingSink())
+        if "jsonl" in names:
+            sinks.append(JsonlSink(os.path.join(directory, "events.jsonl")))
+        if "prometheus" in names:
+            sinks.append(PrometheusSink(os.path.join(directory, "metrics.prom")))
+        self.telemetry.configure(
+            sinks, self.valves.DEBUG, self.valves.TELEMETRY_MAX_PAYLOAD
+        )
+
+    @property
+    def io(self) -> MemoryIO:
+        if self._io is None:
+            self._io = MemoryIO(self.valves.IO_THREADS)
+            weakref.finalize(self, self._io.shutdown)
+        return self._io
+
+    async def _download_server(self) -> MemoryDownloadServer:
+        """The shared download server, restarted when its port valve changes."""
+        if self._downloads is not None and (
+            self._downloads.port != self.valves.DOWNLOAD_PORT
+        ):
+            await self._downloads.close()
+            self._downloads = None
+        if self._downloads is None:
+            self._downloads = MemoryDownloadServer(self.io, self.valves.DOWNLOAD_PORT)
+            weakref.finalize(self, self._downloads.shutdown)
+        self._downloads.ttl = self.valves.DOWNLOAD_LINK_TTL
+        self._downloads.single_use = self.valves.DOWNLOAD_SINGLE_USE
+        self._downloads.telemetry = self.telemetry
+        await self._downloads.start()
+        return self._downloads
+
+    def _download_url(self, server: MemoryDownloadServer) -> str:
+        """Where users reach the download server, from DOWNLOAD_BASE_URL if set."""
+        base_url = self.valves.DOWNLOAD_BASE_URL.strip().rstrip("/")
+        if base_url:
+            return base_url
+        ip, port = server.address
+        # The server listens on every interface, whose wildcard address is no
+        # use in a link.
+        if ip in ("0.0.0.0", "::"):
+            host = "localhost"
+        else:
+            host = f"[{ip}]" if ":" in ip else ip
+        return f"http://{host}:{port}"
+
+    @property
+    def memory(self) -> MemoryFunctions:
+        """The shared memory store, for code outside a tool call."""
+        memory = self._open_memory(None)
+        for closing in self._stores.release(memory):
+            self._close_store(closing)
+        return memory
+
+    def _user_key(self, __user__: dict = None):
+        """Key of the caller's memory store: the user id, None for the shared one."""
+        if not self.valves.PER_USER_MEMORY or not __user__ or not __user__.get("id"):
+            return None
+        user_id = str(__user__["id"])
+        if re.fullmatch(r"[A-Za-z0-9_-]{1,64}", user_id):
+            return user_id
+        # Anything else (dots, separators, long ids) is hashed, so that no id can
+        # point outside memory_jsons/users/ and no two ids share a directory.
+        return "id-" + hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:32]
+
+    def _open_memory(self, key, touch: bool = True) -> MemoryFunctions:
+        """Open (or reuse) and pin the store for key; see MemoryStores."""
+        # Open WebUI assigns the stored valves after __init__, so storage settings
+        # are applied here, on first use and whenever they change.
+        settings = (
+            self.valves.STORAGE_BACKEND,
+            self.valves.JOURNAL_MODE,
+            self.valves.JOURNAL_COMPACT_BYTES,
+        )
+        with self._settings_lock:
+            if self._memory_settings != settings:
+                for memory in self._stores.retire_all():
+                    self._close_store(memory)
+                self._memory_settings = settings
+        self._stores.max_open = self.valves.MAX_OPEN_USERS
+        self._stores.idle_seconds = self.valves.USER_IDLE_MINUTES * 60
+        memory = self._stores.acquire(key, self._new_memory, touch)
+        memory.duplicate_policy = self.valves.DUPLICATE_POLICY
+        memory.duplicate_threshold = self.valves.DUPLICATE_THRESHOLD
+        memory.max_entries = self.valves.MEMORY_MAX_ENTRIES
+        memory.max_bytes = self.valves.MEMORY_MAX_BYTES
+        memory.tag_ttl = self._tag_ttl(self.valves.MEMORY_TAG_TTL_DAYS)
+        memory.eviction_policy = self.valves.EVICTION_POLICY
+        memory.eviction_grace = self.valves.EVICTION_UNDO_HOURS * 3600
+        memory.cache.max_files = self.valves.MEMORY_CACHE_MAX_FILES
+        memory.cache.max_bytes = self.valves.MEMORY_CACHE_MAX_BYTES
+        return memory
+
+    def _new_memory(self, key) -> MemoryFunctions:
+        directory = "memory_jsons"
+        if key is not None:
+            directory = os.path.join(directory, "users", key)
+        return MemoryFunctions(
+            memory_file=self._active_file(directory),
+            directory=directory,
+            telemetry=self.telemetry,
+            journal=self.valves.JOURNAL_MODE,
+            compact_threshold=self.valves.JOURNAL_COMPACT_BYTES,
+            backend=self.valves.STORAGE_BACKEND,
+        )
+
+    @staticmethod
+    def _active_file(directory: str) -> str:
+        """The memory file a store was left on when it was last closed."""
+        try:
+            with open(os.path.join(directory, ".active"), encoding="utf-8") as file:
+                return _check_file_name(file.read().strip())
+        except (OSError, ValueError):
+            return "memory.json"
+
+    @staticmethod
+    def _close_store(memory: MemoryFunctions):
+        """Close a store, noting its active file in ".active" to reopen it there."""
+        path = os.path.join(memory.directory, ".active")
+        active = os.path.basename(memory.memory_file)
+        try:
+            if active != "memory.json":
+                with atomic_write(path, encoding="utf-8") as file:
+                    file.write(active)
+            elif os.path.exists(path):
+                os.remove(path)
+        finally:
+            memory.close()
+
+    async def _close_stores(self, stores: list):
+        for memory in stores:
+            await self.io.run(self._close_store, memory)
+            self.io.forget(memory.directory)
+
+    @staticmethod
+    def _tag_ttl(setting: str) -> dict:
+        """Parse "tag=days, ..." into {tag: seconds}, skipping malformed parts."""
+        ttl = {}
+        for part in setting.split(","):
+            tag, _, days = part.partition("=")
+            try:
+                ttl[tag.strip()] = float(days) * 86400
+            except ValueError:
+                continue
+        return ttl
+
+    def _memory_session(self, __user__: dict = None):
+        """Hold the calling user's memory store for the duration of a tool call."""
+        return self._store_session(self._user_key(__user__))
+
+    @asynccontextmanager
+    async def _store_session(self, key, touch: bool = True):
+        """
+        Hold the lock of one memory store for the duration of a tool call.
+
+        Opening the store may read from disk, so it happens on the I/O pool; any
+        other blocking work inside the session should go through self.io.run.
+        Stores of different users have separate locks. With touch False (for
+        maintenance) the session does not count as a use of the store.
+        """
+        self._ensure_maintenance()
+        held = _session_owner.get()
+        if held is not None and held[:2] == (id(self), asyncio.current_task()):
+            # Nested in a session this task already holds (see _run_batch).
+            yield held[2]
+            return
+        memory = await self.io.run(self._open_memory, key, touch)
+        try:
+            async with self.io.lock(memory.directory):
+                # Other workers may have written to the file since the last call.
+                await self.io.run(memory.refresh)
+                token = _session_owner.set((id(self), asyncio.current_task(), memory))
+                try:
+                    yield memory
+                finally:
+                    _session_owner.reset(token)
+                    await self.io.run(memory.flush_manifest)
+        finally:
+            await self._close_stores(self._stores.release(memory))
+
+    # Seconds between checks whether MEMORY_REFRESH_INTERVAL has elapsed.
+    maintenance_tick = 60
+
+    def _ensure_maintenance(self):
+        """Start the background maintenance task on the running event loop."""
+        if self._maintenance is not None and not self._maintenance.done():
+            return
+        self._maintenance = asyncio.get_running_loop().create_task(
+            self._maintenance_loop(weakref.ref(self))
+        )
+        # Stop the task together with the instance it belongs to; see __init__.
+        weakref.finalize(self, self._cancel_task, self._maintenance)
+
+    @staticmethod
+    async def _maintenance_loop(tools_ref: weakref.ref):
+        """
+        Run _run_maintenance every MEMORY_REFRESH_INTERVAL minutes. Only a weak
+        reference to the instance is held in between, so the loop never keeps a
+        replaced instance alive.
+        """
+        last_run = time.monotonic()
+        while True:
+            tools = tools_ref()
+            if tools is None:
+                return
+            tick = tools.maintenance_tick
+            interval = tools.valves.MEMORY_REFRESH_INTERVAL * 60
+            if interval > 0 and time.monotonic() - last_run >= interval:
+                tools._configure_telemetry()
+                try:
+                    with tools.telemetry.span("maintenance"):
+                        await tools._run_maintenance()
+                except Exception as e:
+                    tools.telemetry.log("Memory maintenance failed", error=e)
+                last_run = time.monotonic()
+            del tools
+            await asyncio.sleep(tick)
+
+    async def _run_maintenance(self):
+        """
+        Close the stores that have been idle too long, then one maintenance
+        pass over the others. Closing a store writes it back anyway, and the
+        pass does not count as a use, so it never keeps an idle store open.
+        """
+        started = time.monotonic()
+        await self._close_stores(self._stores.collect())
+        for key in self._stores.keys():
+            await self._maintain_store(key, touch=False)
+        open_keys = set(self._stores.keys())
+        for key in list(self._store_maintenance):
+            if key not in open_keys:
+                del self._store_maintenance[key]
+
+        stats = self._maintenance_stats
+        stats["runs"] += 1
+        stats["last_run"] = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+        stats["last_duration"] = round(time.monotonic() - started, 3)
+
+    async def _maintain_store(self, key, touch: bool = True) -> list:
+        """
+        Run maintain() on every loaded memory set of one store and add up what
+        was done. Each set is handled in its own session so tool calls get the
+        lock in between.
+        """
+        reports = []
+        async with self._store_session(key, touch) as memory:
+            file_names = memory.loaded_memory_files()
+        for file_name in file_names:
+            async with self._store_session(key, touch) as memory:
+                reports.append(await self.io.run(memory.maintain, file_name))
+            await asyncio.sleep(0)
+        counters = self._store_maintenance.setdefault(
+            key, {"compactions": 0, "rebuilt_indexes": 0, "evictions": 0}
+        )
+        counters["compactions"] += sum(report["compacted"] for report in reports)
+        counters["rebuilt_indexes"] += sum(len(report["rebuilt"]) for report in reports)
+        counters["evictions"] += sum(report.get("evicted", 0) for report in reports)
+        counters["last_report"] = reports
+        self.telemetry.log("Memory maintenance", store=key, reports=reports)
+        return reports
+
+    def _confirmation_pending(self, __user__: dict, *operation) -> bool:
+        """
+        Whether this user asked for this operation (on this target) within
+        confirmation_ttl seconds; the request is used up either way. The second
+        call then goes ahead if it confirms and aborts if it does not.
+        """
+        user_id = (__user__ or {}).get("id")
+        requested = self._confirmations.pop((user_id, *operation), None)
+        now = time.monotonic()
+        for key, when in list(self._confirmations.items()):
+            if now - when > self.confirmation_ttl:
+                del self._confirmations[key]
+        return requested is not None and now - requested <= self.confirmation_ttl
+
+    def _request_confirmation(self, __user__: dict, *operation):
+        user_id = (__user__ or {}).get("id")
+        self._confirmations[(user_id, *operation)] = time.monotonic()
+
+    # Seconds a destructive call waits for the call that confirms it.
+    confirmation_ttl = 600
+
+    @staticmethod
+    def _duplicate_message(memory: MemoryFunctions, memory_id: int, action: str):
+        index = memory.ordinal(memory_id)
+        if action == "merged":
+            return f"merged into the near-duplicate memory #{index}."
+        return f"not added, memory #{index} already says nearly the same."
+
+    async def handle_input(
+        self,
+        input_text: str,
+        tag: str,
+        user_wants_to_add: bool,
+        llm_wants_to_add: bool,
+        by: str,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        AUTOMATICALLY Summarize user input and enhance responses using memory data.
+
+        :params input_text: The TEXT .
+        :returns: The response considering memory data.
+        """
+        emitter = EventEmitter(__event_emitter__)
+
+        self.telemetry.log("Handling input", text=input_text)
+
+        await emitter.emit(f"Analyzing input for memory: {input_text}")
+
+        if self.valves.USE_MEMORY:
+            async with self._memory_session(__user__) as memory:
+                # Assume 'by' is determined outside and 'tag' is selected by LLM
+                if tag not in memory.tag_options:
+                    tag = "others"
+
+                if user_wants_to_add:
+                    await emitter.emit(
+                        description=f"User requested to add to memory with tag {tag}",
+                        status="memory_update",
+                        done=False,
+                    )
+                    added = await self.io.run(
+                        memory.add_to_memory, tag, input_text, "user"
+                    )
+                    if added[1] != "added":
+                        return self._duplicate_message(memory, *added)
+                    return "added to memory by user's request!"
+                elif llm_wants_to_add:
+                    await emitter.emit(
+                        description=f"LLM added to memory with tag {tag}",
+                        status="memory_update",
+                        done=False,
+                    )
+                    added = await self.io.run(
+                        memory.add_to_memory, tag, input_text, "LLM"
+                    )
+                    if added[1] != "added":
+                        return self._duplicate_message(memory, *added)
+                    return "added to memory by LLM's request!"
+
+        # The remaining logic stays the same.
+
+    async def recall_memories(
+        self,
+        limit: int = None,
+        cursor: str = None,
+        max_tokens: int = None,
+        max_chars: int = None,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Retrieve stored memories in current file page by page and provide them to the user.
+
+        :param limit: Optional maximum number of memories to return.
+        :param cursor: The cursor returned by a previous call, to continue reading where it stopped.
+        :param max_tokens: Optional token budget for the returned memories.
+        :param max_chars: Optional character budget for the returned memories.
+        :return: One memory per line, plus a cursor when more memories are available.
+        """
+        emitter = EventEmitter(__event_emitter__)
+        await emitter.emit("Retrieving stored memories.", status="recall_in_progress")
+
+        # Never hand back more than the configured budget, whatever was asked for.
+        budget = self.valves.RECALL_MAX_CHARS or None
+        for requested in (max_chars, max_tokens and max_tokens * 4):
+            if requested:
+                budget = min(budget, requested) if budget else requested
+
+        # A cursor is the id of the last memory of the previous page.
+        cursor = str(cursor).strip() if cursor is not None else ""
+        try:
+            limit = None if limit is None else int(limit)
+        except (TypeError, ValueError):
+            limit = 0
+        if limit is not None and limit < 1:
+            message = "Invalid limit: it must be a whole number of at least 1."
+            status = "invalid_limit"
+        elif cursor and not (cursor.isascii() and cursor.isdigit()):
+            message = (
+                f"Invalid cursor {cursor!r}: pass the cursor returned by the previous "
+                "recall_memories call, or none to start from the beginning."
+            )
+            status = "invalid_cursor"
+        else:
+            message = None
+        if message is not None:
+            self.telemetry.log(message)
+            await emitter.emit(description=message, status=status, done=True)
+            return message
+
+        lines, used, last_id, has_more = [], 0, None, False
+        start = int(cursor) if cursor else None
+        async with self._memory_session(__user__) as memory:
+            if not memory.get_all_memories():
+                message = "No memory stored."
+                self.telemetry.log(message)
+                await emitter.emit(
+                    description=message,
+                    status="recall_complete",
+                    done=True,
+                )
+                return json.dumps({"message": message}, ensure_ascii=False)
+
+            for index, memory_id, entry in memory.page_memories(start):
+                if limit is not None and len(lines) >= limit:
+                    has_more = True
+                    break
+                memo = str(entry.get("memo", "")).replace("\n", " ")
+                line = (
+                    f"#{index} [{entry.get('tag')}] {memo} "
+                    f"(by {entry.get('by')}, {entry.get('last_modified')})"
+                )
+                if budget is not None and used + len(line) + 1 > budget:
+                    if lines:
+                        has_more = True
+                        break
+                    # A single oversized memory is cut so that every page makes progress.
+                    line = line[: max(budget - 1, 1)] + "…"
+                lines.append(line)
+                used += len(line) + 1
+                last_id = memory_id
+
+        self.telemetry.log("Recalled memories", count=len(lines), cursor=cursor)
+
+        await emitter.emit(
+            description=f"Retrieved {len(lines)} stored memories.",
+            status="recall_complete",
+            done=True,
+        )
+
+        result = "Memories are :\n" + "\n".join(lines)
+        if has_more:
+            result += (
+                "\nMore memories are available; call recall_memories again "
+                f'with cursor="{last_id}".'
+            )
+        return result
+
+    async def recall_memories_by_tag(
+        self,
+        tags: list,
+        limit: int = 20,
+        offset: int = 0,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Retrieve only the memories with the given tags from the current file, e.g. ["work"].
+
+        :param tags: The tags to read, any of: personal, work, education, life, person, others.
+        :param limit: Maximum number of memories to return.
+        :param offset: Number of matching memories to skip, for reading further pages.
+        :return: The per-tag memory counts and the requested memories.
+        """
+        emitter = EventEmitter(__event_emitter__)
+        # Models often pass a single tag as a plain string.
+        tags = [tags] if isinstance(tags, str) else list(tags or [])
+        try:
+            # Negative values would make islice raise; treat them as the first page.
+            limit, offset = max(int(limit), 0), max(int(offset), 0)
+        except (TypeError, ValueError):
+            message = "Invalid limit or offset: both must be whole numbers."
+            self.telemetry.log(message)
+            await emitter.emit(description=message, status="invalid_limit", done=True)
+            return message
+        await emitter.emit(
+            f"Retrieving memories tagged {', '.join(tags)}.",
+            status="recall_in_progress",
+        )
+
+        async with self._memory_session(__user__) as memory:
+            counts = memory.tag_counts()
+            entries = [
+                (memory.ordinal(memory_id), entry)
+                for memory_id, entry in memory.recall_by_tag(tags, limit, offset)
+            ]
+        total = sum(counts.get(tag, 0) for tag in set(tags))
+
+        self.telemetry.log(
+            "Recalled memories by tag", count=len(entries), total=total, tags=tags
+        )
+
+        await emitter.emit(
+            description=f"Retrieved {len(entries)} of {total} memories tagged {', '.join(tags)}.",
+            status="recall_complete",
+            done=True,
+        )
+
+        return json.dumps(
+            {
+                "tag_counts": counts,
+                "total": total,
+                "offset": offset,
+                "memories": [{"index": index, **entry} for index, entry in entries],
+            },
+            ensure_ascii=False,
+        )
+
+    async def recent_memories(
+        self,
+        count: int = 10,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Retrieve the most recently added or changed memories of the current file, newest first.
+
+        :param count: How many memories to return.
+        :return: The memories with their index, newest first.
+        """
+        emitter = EventEmitter(__event_emitter__)
+
+        async with self._memory_session(__user__) as memory:
+            entries = [
+                (memory.ordinal(memory_id), entry)
+                for memory_id, entry in memory.recent_memories(max(int(count), 0))
+            ]
+
+        await emitter.emit(
+            description=f"Retrieved the {len(entries)} most recent memories.",
+            status="recall_complete",
+            done=True,
+        )
+
+        return json.dumps(
+            [{"index": index, **entry} for index, entry in entries],
+            ensure_ascii=False,
+        )
+
+    async def memories_between(
+        self,
+        start: str,
+        end: str = None,
+        limit: int = 50,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Retrieve the memories of the current file added or changed in a time range, e.g. everything since yesterday.
+
+        :param start: Start of the range, "YYYY-MM-DD" or "YYYY-MM-DD_HH:MM:SS".
+        :param end: Optional end of the range in the same format; a bare date includes that whole day. Defaults to now.
+        :param limit: Maximum number of memories to return; the most recent ones are kept.
+        :return: The number of memories in the range and the memories, oldest first.
+        """
+        emitter = EventEmitter(__event_emitter__)
+
+        bounds = []
+        for text, day_end in ((start, False), (end, True)):
+            if not text:
+                bounds.append(None)
+                continue
+            stamp = MemoryTimeIndex.timestamp(text)
+            if not stamp:
+                message = f"Could not read the time {text!r}; use YYYY-MM-DD or YYYY-MM-DD_HH:MM:SS."
+                await emitter.emit(
+                    description=message, status="recall_error", done=True
+                )
+                return message
+            if day_end and len(text.strip()) == 10:
+                stamp += 86400 - 1
+            bounds.append(stamp)
+
+        async with self._memory_session(__user__) as memory:
+            total, entries = memory.memories_between(*bounds, max(int(limit), 0))
+            entries = [
+                (memory.ordinal(memory_id), entry) for memory_id, entry in entries
+            ]
+
+        await emitter.emit(
+            description=f"Retrieved {len(entries)} of {total} memories in the time range.",
+            status="recall_complete",
+            done=True,
+        )
+
+        return json.dumps(
+            {
+                "total": total,
+                "memories": [{"index": index, **entry} for index, entry in entries],
+            },
+            ensure_ascii=False,
+        )
+
+    async def search_memories(
+        self,
+        query: str,
+        top_k: int = 5,
+        tag: str = None,
+        mode: str = "keyword",
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Search the current memory file and return only the most relevant memories. Prefer this over recall_memories.
+
+        :param query: Keywords describing what to look for.
+        :param top_k: Maximum number of memories to return.
+        :param tag: Optional tag to restrict the search to, e.g. "work".
+        :param mode: "keyword" to match exact words, or "semantic" to also find memories phrased differently.
+        :return: The best matching memories, most relevant first.
+        """
+        emitter = EventEmitter(__event_emitter__)
+        await emitter.emit(
+            f"Searching memories for: {query}", status="search_in_progress"
+        )
+
+        self.telemetry.log(
+            "Searching memories", query=query, top_k=top_k, tag=tag, mode=mode
+        )
+
+        async with self._memory_session(__user__) as memory:
+            matches = [
+                (memory.ordinal(memory_id), entry, score)
+                for memory_id, entry, score in memory.search_memories(
+                    query, top_k, tag, mode
+                )
+            ]
+        if not matches:
+            message = "No matching memories found."
+            await emitter.emit(description=message, status="search_complete", done=True)
+            return json.dumps({"message": message}, ensure_ascii=False)
+
+        results = [
+            {"index": index, **entry, "score": round(score, 3)}
+            for index, entry, score in matches
+        ]
+
+        await emitter.emit(
+            description=f"Found {len(results)} matching memories.",
+            status="search_complete",
+            done=True,
+        )
+
+        return f"Matching memories are : {json.dumps(results, ensure_ascii=False)}"
+
+    # Below this many files to read from disk, a process pool is not worth starting.
+    search_process_min_files = 8
+
+    def _search_executor(self, file_count: int):
+        """
+        The process pool for reading many memory files at once, or None for the
+        I/O threads. One pool lives as long as the instance. Its workers are
+        spawned rather than forked, as forking a process that runs threads can
+        deadlock the child, and load this module from its file; a module
+        without one is searched on the threads.
+        """
+        processes = self.valves.SEARCH_PROCESSES
+        if self._search_pool is not None and self._search_pool[1] != processes:
+            self._drop_search_pool()
+        if min(processes, file_count) < 2 or file_count < self.search_process_min_files:
+            return None
+        if self._search_pool is None:
+            module = sys.modules.get(_search_memory_file.__module__)
+            path = getattr(module, "__file__", None)
+            if not path or not os.path.exists(path):
+                return None
+            pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=exec,
+                initargs=(
+                    _SEARCH_WORKER_BOOTSTRAP,
+                    {"name": module.__name__, "path": path},
+                ),
+            )
+            self._search_pool = (pool, processes)
+            # Released with the instance, like the rest; see __init__.
+            weakref.finalize(self, pool.shutdown, wait=False, cancel_futures=True)
+        return self._search_pool[0]
+
+    def _drop_search_pool(self):
+        pool, _ = self._search_pool
+        self._search_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _search_files(
+        self, executor, backend: str, directory: str, file_names: list, query, top_k
+    ) -> list:
+        """Rank memory files from disk on executor (None: the I/O threads)."""
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    executor or self.io.executor,
+                    _search_memory_file,
+                    backend,
+                    os.path.join(directory, file_name),
+                    query,
+                    top_k,
+                )
+                for file_name in file_names
+            ),
+            return_exceptions=True,
+        )
+
+    async def search_all_memory_files(
+        self,
+        query: str,
+        top_k: int = 5,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Search every memory file, not only the current one, and return the most relevant memories with the file they are in.
+
+        :param query: Keywords describing what to look for.
+        :param top_k: Maximum number of memories to return.
+        :return: The best matching memories across all files, most relevant first.
+        """
+        emitter = EventEmitter(__event_emitter__)
+        await emitter.emit(
+            f"Searching all memory files for: {query}", status="search_in_progress"
+        )
+
+        async with self._memory_session(__user__) as memory:
+            hits, others = await self.io.run(
+                memory.search_loaded_memory_files, query, top_k
+            )
+            backend, directory = memory.backend, memory.directory
+
+        # Files that are not in memory are read one per worker and dropped once
+        # ranked, so at most one file per worker is held at a time.
+        executor = self._search_executor(len(others))
+        search = (backend, directory, others, query, top_k)
+        try:
+            results = await self._search_files(executor, *search)
+            broken = any(isinstance(result, BrokenProcessPool) for result in results)
+        except BrokenProcessPool:
+            broken = True
+        if broken:
+            # A worker died (e.g. killed for using too much memory): search on
+            # the threads this time and start a new pool the next.
+            self.telemetry.log("Search worker pool broke; using the I/O threads")
+            if self._search_pool is not None and self._search_pool[0] is executor:
+                self._drop_search_pool()
+            results = await self._search_files(None, *search)
+        for file_name, result in zip(others, results):
+            if isinstance(result, Exception):
+                self.telemetry.log(
+                    "Could not search memory file", file=file_name, error=result
+                )
+                continue
+            hits.extend((file_name, *hit) for hit in result)
+
+        # BM25 scores come from each file's own statistics; they are merged as is.
+        top = heapq.nlargest(top_k, hits, key=lambda hit: hit[3])
+        if not top:
+            message = "No matching memories found."
+            await emitter.emit(description=message, status="search_complete", done=True)
+            return json.dumps({"message": message}, ensure_ascii=False)
+
+        results = [
+            {"file": file_name, "index": index, **entry, "score": round(score, 3)}
+            for file_name, index, entry, score in top
+        ]
+
+        await emitter.emit(
+            description=f"Found {len(results)} matching memories in {len(set(hit[0] for hit in top))} files.",
+            status="search_complete",
+            done=True,
+        )
+
+        return f"Matching memories are : {json.dumps(results, ensure_ascii=False)}"
+
+    async def clear_memories(
+        self,
+        user_confirmation: bool,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Clear all stored memories in current file after user confirmation;ask twice the user for confimation.
+
+        :param user_confirmation: Boolean indicating user confirmation to clear memories.
+        :return: A message indicating the status of the operation.
+        """
+        emitter = EventEmitter(__event_emitter__)
+        await emitter.emit(
+            "Attempting to clear all memory entries.", status="clear_memory_attempt"
+        )
+
+        pending = self._confirmation_pending(__user__, "clear_memories")
+        if pending and user_confirmation:
+            async with self._memory_session(__user__) as memory:
+                if self.valves.SNAPSHOT_BEFORE_DESTRUCTIVE:
+                    await self.io.run(memory.snapshot, "before clear_memories")
+                await self.io.run(memory.clear_memory)
+            await emitter.emit(
+                description="All memory entries have been cleared.",
+                status="clear_memory_complete",
+                done=True,
+            )
+            return json.dumps(
+                {"message": "All memory entries cleared."}, ensure_ascii=False
+            )
+
+        if not pending:
+            self._request_confirmation(__user__, "clear_memories")
+            await emitter.emit(
+                description="Please confirm that you want to clear all memories. Call this function again with confirmation.",
+                status="confirmation_required",
+                done=False,
+            )
+            return json.dumps(
+                {"message": "Please confirm to clear all memories."}, ensure_ascii=False
+            )
+
+        await emitter.emit(
+            description="Clear memory operation aborted.",
+            status="clear_memory_aborted",
+            done=True,
+        )
+        return json.dumps(
+            {"message": "Memory clear operation aborted."}, ensure_ascii=False
+        )
+
+    @staticmethod
+    def _deduplicate(memory: MemoryFunctions, remove: bool) -> list:
+        # Report the indices as the LLM saw them, before anything was removed.
+        ids = list(memory.order_index.ids)
+        return [
+            {
+                "kept": bisect.bisect_left(ids, kept) + 1,
+                "duplicate": bisect.bisect_left(ids, index) + 1,
+                "similarity": round(score, 2),
+            }
+            for kept, index, score in memory.deduplicate(dry_run=not remove)
+        ]
+
+    async def deduplicate_memories(
+        self,
+        user_confirmation: bool,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Find near-duplicate memories in the current file and, once the user confirms, remove them keeping the most recently changed one of each group.
+
+        :param user_confirmation: False to only list the duplicates, True to remove them.
+        :returns: The duplicates found, as JSON.
+        """
+        emitter = EventEmitter(__event_emitter__)
+        await emitter.emit("Looking for near-duplicate memories.")
+
+        async with self._memory_session(__user__) as memory:
+            if user_confirmation and self.valves.SNAPSHOT_BEFORE_DESTRUCTIVE:
+                await self.io.run(memory.snapshot, "before deduplicate_memories")
+            duplicates = await self.io.run(self._deduplicate, memory, user_confirmation)
+        if user_confirmation:
+            message = f"Removed {len(duplicates)} near-duplicate memories."
+        else:
+            message = f"Found {len(duplicates)} near-duplicate memories; call again with confirmation to remove them."
+
+        await emitter.emit(description=message, status="memory_dedup", done=True)
+
+        return json.dumps(
+            {"message": message, "duplicates": duplicates}, ensure_ascii=False
+        )
+
+    async def refresh_memory(
+        self, __user__: dict = None, __event_emitter__: Callable[[dict], Any] = None
+    ):
+        """
+        Periodically refresh and optimize memory data, includes reindexing.
+
+        :returns: A message indicating the status of the refresh operation.
+        """
+        emitter = EventEmitter(__event_emitter__)
+        await emitter.emit("Starting memory refresh process.")
+
+        self.telemetry.log("Refreshing memory...")
+
+        if self.valves.USE_MEMORY:
+            async with self._memory_session(__user__) as memory:
+                refresh_message = await self.io.run(memory.reindex_memory)
+
+            self.telemetry.log(refresh_message)
+
+            await emitter.emit(
+                description=refresh_message, status="memory_refresh", done=True
+            )
+
+            return refresh_message
+
+        self.telemetry.log("Memory refreshed.")
+
+        await emitter.emit(
+            status="complete", description="Memory refresh completed.", done=True
+        )
+
+    async def update_memory_entry(
+        self,
+        index: int,
+        tag: str,
+        memo: str,
+        by: str,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Update an existing memory entry based on its index.
+
+        :param index: The index of the memory entry to update,STARTING FROM 1.
+        :param tag: The tag for the memory entry.
+        :param memo: The memory information to update.
+        :param by: Who is making the update ('user' or 'LLM').
+        :returns: A message indicating the success or failure of the update.
+        """
+        emitter = EventEmitter(__event_emitter__)
+
+        self.telemetry.log("Updating memory", index=index, tag=tag, memo=memo, by=by)
+
+        async with self._memory_session(__user__) as memory:
+            update_message = await self.io.run(
+                memory.update_memory_by_index, index, tag, memo, by
+            )
+
+        await emitter.emit(
+            description=update_message, status="memory_update", done=True
+        )
+
+        return update_message
+
+    async def add_multiple_memories(
+        self,
+        memory_entries: list,
+        llm_wants_to_add: bool,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Allows the LLM to add multiple memory entries at once.
+
+        :param memory_entries: A list of dictionary entries, each containing tag, memo, by.Usage Example: memory_entries = [{"tag": "personal", "memo": "This is a personal note", "by": "LLM"},{"tag": "work", "memo": "Project deadline is tomorrow", "by": "LLM"}]
+        :param llm_wants_to_add: Boolean indicating LLM's desire to add the memories.
+        :returns: A message indicating the success or failure of the operations.
+        """
+        emitter = EventEmitter(__event_emitter__)
+        responses = []
 
+        if not llm_wants_to_add:
+            return "LLM has not requested to add multiple memories."
 
-class MemoryFunctions:
-    def __init__(
-        self, memory_file="memory.json", debug=False, directory="memory_jsons"
-    ):
-        self.directory = directory
-        os.makedirs(self.directory, exist_ok=True)  # Ensure the directory exists
-        self.memory_file = os.path.join(self.directory, memory_file)
-        self.debug = debug
-        self.memory_data = self.load_memory()
-        self.tag_options = ["personal", "work", "education", "life", "person", "others"]
+        def add_all(memory: MemoryFunctions):
+            with memory.transaction():
+                for idx, entry in enumerate(memory_entries):
+                    tag = entry.get("tag", "others")
+                    memo = entry.get("memo", "")
+                    by = entry.get("by", "LLM")
 
-    def switch_memory_file(self, new_file: str):
-        """Switch and initialize operations on a new memory file in designated directory."""
-        self.memory_file = os.path.join(self.directory, new_file)
-        self.memory_data = self.load_memory()
-        if self.debug:
-            print(f"Switched to memory file: {self.memory_file}")
+                    if tag not in memory.tag_options:
+                        tag = "others"
 
-    def reindex_memory(self):
-        if self.debug:
-            print("Reindexing memory entries.")
-
-        # Reindex memory in ascending order
-        sorted_indices = sorted(self.memory_data.keys())
-        reindexed_memory = {
-            new_index + 1: self.memory_data[old_index]
-            for new_index, old_index in enumerate(sorted_indices)
-        }
-        self.memory_data = reindexed_memory
-        self.save_memory()
+                    self.telemetry.log(
+                        "Adding memory", number=idx + 1, tag=tag, memo=memo, by=by
+                    )
 
-        return "Memory reindexed successfully."
+                    # Add the memory
+                    added = memory.add_to_memory(tag, memo, by)
+                    if added[1] != "added":
+                        message = self._duplicate_message(memory, *added)
+                        responses.append(f"Memory {idx+1}: {message}")
+                        continue
+                    responses.append(f"Memory {idx+1} added with tag {tag} by {by}.")
 
-    def delete_memory_by_index(self, index: int):
-        if index in self.memory_data:
-            del self.memory_data[index]
-            self.save_memory()
-            return f"Memory index {index} deleted successfully."
-        else:
-            return f"Memory index {index} does not exist."
+        try:
+            async with self._memory_session(__user__) as memory:
+                await self.io.run(add_all, memory)
+        except Exception as e:
+            message = f"No memories were added: {str(e)}"
+            await emitter.emit(
+                description=message, status="memory_update_error", done=True
+            )
+            return message
 
-    def update_memory_by_index(self, index: int, tag: str, memo: str, by: str):
-        if index in self.memory_data:
-            if tag not in self.tag_options:
-                tag = "others"
+        for response in responses:
+            await emitter.emit(description=response, status="memory_update", done=False)
 
-            # Update the entry
-            self.memory_data[index]["tag"] = tag
-            self.memory_data[index]["memo"] = memo
-            self.memory_data[index]["by"] = by
-            self.memory_data[index]["last_modified"] = datetime.datetime.now().strftime(
-                "%Y-%m-%d_%H:%M:%S"
-            )
-            self.save_memory()
-            return f"Memory index {index} updated successfully."
-        else:
-            return f"Memory index {index} does not exist."
+        await emitter.emit(
+            description="All requested memories have been processed.",
+            status="memory_update_complete",
+            done=True,
+        )
+
+        return "\n".join(responses)
 
     async def update_multiple_memories(
         self,
         memory_updates: list,
         llm_wants_to_update: bool,
+        __user__: dict = None,
         __event_emitter__: Callable[[dict], Any] = None,
     ) -> str:
         """
@@ -96,22 +4929,36 @@ class MemoryFunctions:
         if not llm_wants_to_update:
             return "LLM has not requested to update multiple memories."
 
-        for update in memory_updates:
-            index = update.get("index")
-            tag = update.get("tag", "others")
-            memo = update.get("memo", "")
-            by = update.get("by", "LLM")
+        def update_all(memory: MemoryFunctions):
+            with memory.transaction():
+                for update in memory_updates:
+                    index = update.get("index")
+                    tag = update.get("tag", "others")
+                    memo = update.get("memo", "")
+                    by = update.get("by", "LLM")
+
+                    if tag not in memory.tag_options:
+                        tag = "others"  # Default tag to 'others' if invalid
 
-            if tag not in self.memory.tag_options:
-                tag = "others"  # Default tag to 'others' if invalid
+                    self.telemetry.log(
+                        "Updating memory", index=index, tag=tag, memo=memo, by=by
+                    )
 
-            if self.valves.DEBUG:
-                print(f"Updating memory {index}: tag={tag}, memo={memo}, by={by}")
+                    # Update the memory
+                    update_message = memory.update_memory_by_index(index, tag, memo, by)
+                    responses.append(update_message)
 
-            # Update the memory
-            update_message = self.memory.update_memory_by_index(index, tag, memo, by)
-            responses.append(update_message)
+        try:
+            async with self._memory_session(__user__) as memory:
+                await self.io.run(update_all, memory)
+        except Exception as e:
+            message = f"No memories were updated: {str(e)}"
+            await emitter.emit(
+                description=message, status="memory_update_error", done=True
+            )
+            return message
 
+        for update_message in responses:
             await emitter.emit(
                 description=update_message, status="memory_update", done=False
             )
@@ -124,454 +4971,460 @@ class MemoryFunctions:
 
         return "\n".join(responses)
 
-    def load_memory(self):
-        if os.path.exists(self.memory_file):
-            if self.debug:
-                print(f"Loading memory from {self.memory_file}")
-            with open(self.memory_file, "r") as file:
-                return json.load(file)
-        else:
-            return {}
-
-    def save_memory(self):
-        if self.debug:
-            print(f"Saving memory to {self.memory_file}")
-        with open(self.memory_file, "w") as file:
-            json.dump(self.memory_data, file, ensure_ascii=False, indent=4)
-
-    def add_to_memory(self, tag: str, memo: str, by: str):
-        if tag not in self.tag_options:
-            tag = "others"
-
-        index = len(self.memory_data) + 1
-        entry = {
-            "tag": tag,
-            "memo": memo,
-            "by": by,
-            "last_modified": datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S"),
-        }
-        self.memory_data[index] = entry
-        self.save_memory()
-
-    # Other methods remain unchanged...
-    def retrieve_from_memory(self, key: str):
-        if self.debug:
-            print(f"Retrieving from memory: {key}")
-        return self.memory_data.get(key, None)
-
-    def process_input_for_memory(self, input_text: str):
-        return {"timestamp": str(datetime.datetime.now()), "input": input_text}
-
-    def get_all_memories(self) -> dict:
-        if self.debug:
-            print("Retrieving all memories.")
-        return self.memory_data
-
-    def clear_memory(self):
-        if self.debug:
-            print("Clearing all memory entries.")
-        self.memory_data.clear()
-        self.save_memory()
-        return "ALL MEMORIES CLEARED!"
+    async def delete_memory_entry(
+        self,
+        index: int,
+        llm_wants_to_delete: bool,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Delete a memory entry based on its index.
 
+        :param index: The index of the memory entry to delete,STARTING FROM 1.
+        :param llm_wants_to_delete: Boolean indicating if the LLM has requested the deletion.
+        :returns: A message indicating the success or failure of the deletion.
+        """
+        emitter = EventEmitter(__event_emitter__)
 
-class EventEmitter:
-    def __init__(self, event_emitter: Callable[[dict], Any] = None):
-        self.event_emitter = event_emitter
+        if not llm_wants_to_delete:
+            return "LLM has not requested to delete a memory."
 
-    async def emit(self, description="Unknown state", status="in_progress", done=False):
-        if self.event_emitter:
-            await self.event_emitter(
-                {
-                    "type": "status",
-                    "data": {
-                        "status": status,
-                        "description": description,
-                        "done": done,
-                    },
-                }
-            )
+        self.telemetry.log("Deleting memory", index=index)
 
+        async with self._memory_session(__user__) as memory:
+            deletion_message = await self.io.run(memory.delete_memory_by_index, index)
 
-class Tools:
-    class Valves(BaseModel):
-        USE_MEMORY: bool = Field(
-            default=True, description="Enable or disable memory usage."
-        )
-        MEMORY_REFRESH_INTERVAL: int = Field(
-            default=60,
-            description="Interval in minutes to refresh and analyze memory data.",
+        await emitter.emit(
+            description=deletion_message, status="memory_deletion", done=True
         )
-        DEBUG: bool = Field(default=True, description="Enable or disable debug mode.")
 
-    def __init__(self):
-        self.valves = self.Valves()
-        self.memory = MemoryFunctions(debug=self.valves.DEBUG)
-        self.confirmation_pending = False
+        return deletion_message
 
-    async def handle_input(
+    async def delete_multiple_memories(
         self,
-        input_text: str,
-        tag: str,
-        user_wants_to_add: bool,
-        llm_wants_to_add: bool,
-        by: str,
+        indices: list,
+        llm_wants_to_delete: bool,
+        __user__: dict = None,
         __event_emitter__: Callable[[dict], Any] = None,
     ) -> str:
         """
-        AUTOMATICALLY Summarize user input and enhance responses using memory data.
+        Delete multiple memory entries based on their indices.
 
-        :params input_text: The TEXT .
-        :returns: The response considering memory data.
+        :param indices: A list of indices of the memory entries to delete,STARTING FROM 1.
+        :param llm_wants_to_delete: Boolean indicating if the LLM has requested the deletions.
+        :returns: A message indicating the success or failure of the deletions.
         """
         emitter = EventEmitter(__event_emitter__)
+        responses = []
 
-        if self.valves.DEBUG:
-            print(f"Handling input: {input_text}")
+        if not llm_wants_to_delete:
+            return "LLM has not requested to delete multiple memories."
 
-        await emitter.emit(f"Analyzing input for memory: {input_text}")
+        def delete_all(memory: MemoryFunctions):
+            messages = {}
+            with memory.transaction():
+                # Deleting a memory shifts the indices after it, so go from the
+                # highest index down; the lower ones then still mean the same.
+                for index in sorted(set(indices), key=int, reverse=True):
+                    self.telemetry.log("Deleting memory", index=index)
 
-        if self.valves.USE_MEMORY:
-            # Assume 'by' is determined outside and 'tag' is selected by LLM
-            if tag not in self.memory.tag_options:
-                tag = "others"
+                    messages[index] = memory.delete_memory_by_index(index)
+            responses.extend(messages[index] for index in dict.fromkeys(indices))
 
-            if user_wants_to_add:
-                await emitter.emit(
-                    description=f"User requested to add to memory with tag {tag}",
-                    status="memory_update",
-                    done=False,
-                )
-                self.memory.add_to_memory(tag, input_text, "user")
-                return "added to memory by user's request!"
-            elif llm_wants_to_add:
-                await emitter.emit(
-                    description=f"LLM added to memory with tag {tag}",
-                    status="memory_update",
-                    done=False,
-                )
-                self.memory.add_to_memory(tag, input_text, "LLM")
-                return "added to memory by LLM's request!"
+        try:
+            async with self._memory_session(__user__) as memory:
+                await self.io.run(delete_all, memory)
+        except Exception as e:
+            message = f"No memories were deleted: {str(e)}"
+            await emitter.emit(
+                description=message, status="memory_deletion_error", done=True
+            )
+            return message
 
-        # The remaining logic stays the same.
+        for deletion_message in responses:
+            await emitter.emit(
+                description=deletion_message, status="memory_deletion", done=False
+            )
 
-    async def recall_memories(
-        self, __event_emitter__: Callable[[dict], Any] = None
+        await emitter.emit(
+            description="All requested memory deletions have been processed.",
+            status="memory_deletion_complete",
+            done=True,
+        )
+
+        return "\n".join(responses)
+
+    async def create_or_switch_memory_file(
+        self,
+        new_file_name: str,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
     ) -> str:
         """
-        Retrieve all stored memories in current file and provide them to the user.
+        Create a new memory file or switch to an existing one.
 
-        :return: A structured representation of all memory contents.
+        :param new_file_name: The name of the new or existing memory file.
+        :returns: A message indicating the success or failure of the operation.
         """
         emitter = EventEmitter(__event_emitter__)
-        await emitter.emit(
-            "Retrieving all stored memories.", status="recall_in_progress"
-        )
 
-        all_memories = self.memory.get_all_memories()
-        if not all_memories:
-            message = "No memory stored."
-            if self.valves.DEBUG:
-                print(message)
+        self.telemetry.log("Switching to or creating memory file", file=new_file_name)
+
+        try:
+            file_name = _check_file_name(f"{new_file_name}.json")
+        except ValueError as e:
+            message = f'{e}. Use a plain name without folders, e.g. "work".'
             await emitter.emit(
-                description=message,
-                status="recall_complete",
-                done=True,
+                description=message, status="invalid_file_name", done=True
             )
-            return json.dumps({"message": message}, ensure_ascii=False)
+            return message
 
-        # Correctly format stored memories contents for readability
-        formatted_memories = json.dumps(all_memories, ensure_ascii=False, indent=4)
+        async with self._memory_session(__user__) as memory:
+            await self.io.run(memory.switch_memory_file, file_name)
 
-        if self.valves.DEBUG:
-            print(f"All stored memories retrieved: {formatted_memories}")
+        message = f"Memory file switched to {new_file_name}."
 
-        await emitter.emit(
-            description=f"All stored memories retrieved: {formatted_memories}",
-            status="recall_complete",
-            done=True,
-        )
+        await emitter.emit(description=message, status="file_switching", done=True)
 
-        return f"Memories are : {formatted_memories}"
+        return message
 
-    async def clear_memories(
-        self, user_confirmation: bool, __event_emitter__: Callable[[dict], Any] = None
+    async def list_memory_files(
+        self, __user__: dict = None, __event_emitter__: Callable[[dict], Any] = None
     ) -> str:
         """
-        Clear all stored memories in current file after user confirmation;ask twice the user for confimation.
+        List available memory files in the designated directory, with their number of memories, size, tags and last change.
 
-        :param user_confirmation: Boolean indicating user confirmation to clear memories.
-        :return: A message indicating the status of the operation.
+        :returns: A message with the list of available memory files.
         """
         emitter = EventEmitter(__event_emitter__)
-        await emitter.emit(
-            "Attempting to clear all memory entries.", status="clear_memory_attempt"
-        )
+        memory_files = []
 
-        if self.confirmation_pending and user_confirmation:
-            self.memory.clear_memory()
-            await emitter.emit(
-                description="All memory entries have been cleared.",
-                status="clear_memory_complete",
-                done=True,
-            )
-            self.confirmation_pending = False
-            return json.dumps(
-                {"message": "All memory entries cleared."}, ensure_ascii=False
-            )
+        try:
+            async with self._memory_session(__user__) as memory:
+                self.telemetry.log("Listing memory files", directory=memory.directory)
+                available_files = await self.io.run(memory.memory_file_stats)
+
+            for file, stats in sorted(available_files.items()):
+                self.telemetry.log("Found memory file", file=file)
+                tags = ", ".join(
+                    f"{tag} {count}" for tag, count in sorted(stats["tags"].items())
+                )
+                memory_files.append(
+                    f"{file} ({stats['entries']} memories, {stats['bytes']} bytes, "
+                    f"changed {stats['last_modified']}; tags: {tags or 'none'})"
+                )
 
-        if not self.confirmation_pending:
-            self.confirmation_pending = True
-            await emitter.emit(
-                description="Please confirm that you want to clear all memories. Call this function again with confirmation.",
-                status="confirmation_required",
-                done=False,
-            )
-            return json.dumps(
-                {"message": "Please confirm to clear all memories."}, ensure_ascii=False
-            )
+            description = "Available memory files: " + ", ".join(memory_files)
+            status = "file_listing_complete"
 
-        await emitter.emit(
-            description="Clear memory operation aborted.",
-            status="clear_memory_aborted",
-            done=True,
-        )
-        self.confirmation_pending = False
-        return json.dumps(
-            {"message": "Memory clear operation aborted."}, ensure_ascii=False
-        )
+        except Exception as e:
+            description = f"Error accessing directory: {str(e)}"
+            status = "file_listing_error"
+
+        await emitter.emit(description=description, status=status, done=True)
+
+        return description
 
-    async def refresh_memory(self, __event_emitter__: Callable[[dict], Any] = None):
+    async def migrate_memory_files(
+        self, __user__: dict = None, __event_emitter__: Callable[[dict], Any] = None
+    ) -> str:
         """
-        Periodically refresh and optimize memory data, includes reindexing.
+        Import every memory file kept by another backend into the one selected in the valves.
 
-        :returns: A message indicating the status of the refresh operation.
+        :returns: A message listing the migrated memory files.
         """
         emitter = EventEmitter(__event_emitter__)
-        await emitter.emit("Starting memory refresh process.")
-
-        if self.valves.DEBUG:
-            print("Refreshing memory...")
 
-        if self.valves.USE_MEMORY:
-            refresh_message = self.memory.reindex_memory()
-
-            if self.valves.DEBUG:
-                print(refresh_message)
-
-            await emitter.emit(
-                description=refresh_message, status="memory_refresh", done=True
-            )
+        self.telemetry.log(
+            "Migrating memory files", backend=self.valves.STORAGE_BACKEND
+        )
 
-            return refresh_message
+        try:
+            async with self._memory_session(__user__) as memory:
+                migrated = await self.io.run(memory.migrate_memory_files)
+            if migrated:
+                message = (
+                    f"Migrated {len(migrated)} memory files to "
+                    f"{memory.backend}: " + ", ".join(migrated)
+                )
+            else:
+                message = "No memory files needed migrating."
+            status = "migration_complete"
+        except Exception as e:
+            message = f"Error migrating memory files: {str(e)}"
+            status = "migration_error"
 
-        if self.valves.DEBUG:
-            print("Memory refreshed.")
+        await emitter.emit(description=message, status=status, done=True)
 
-        await emitter.emit(
-            status="complete", description="Memory refresh completed.", done=True
-        )
+        return message
 
-    async def update_memory_entry(
-        self,
-        index: int,
-        tag: str,
-        memo: str,
-        by: str,
-        __event_emitter__: Callable[[dict], Any] = None,
+    async def memory_cache_stats(
+        self, __user__: dict = None, __event_emitter__: Callable[[dict], Any] = None
     ) -> str:
         """
-        Update an existing memory entry based on its index.
+        Report how often switching memory files was served from the in-memory cache.
 
-        :param index: The index of the memory entry to update,STARTING FROM 1.
-        :param tag: The tag for the memory entry.
-        :param memo: The memory information to update.
-        :param by: Who is making the update ('user' or 'LLM').
-        :returns: A message indicating the success or failure of the update.
+        :returns: Cache hit, miss and eviction counters as JSON.
         """
         emitter = EventEmitter(__event_emitter__)
 
-        if self.valves.DEBUG:
-            print(
-                f"Updating memory index {index} with tag: {tag}, memo: {memo}, by: {by}"
-            )
+        async with self._memory_session(__user__) as memory:
+            stats = memory.cache_stats()
+        message = json.dumps(stats, ensure_ascii=False)
 
-        update_message = self.memory.update_memory_by_index(index, tag, memo, by)
+        self.telemetry.log("Memory cache stats", stats=stats)
 
         await emitter.emit(
-            description=update_message, status="memory_update", done=True
+            description=f"Memory cache: {stats['hits']} hits, {stats['misses']} misses.",
+            status="cache_stats",
+            done=True,
         )
 
-        return update_message
+        return message
 
-    async def add_multiple_memories(
+    async def memory_maintenance_status(
         self,
-        memory_entries: list,
-        llm_wants_to_add: bool,
+        run_now: bool = False,
+        __user__: dict = None,
         __event_emitter__: Callable[[dict], Any] = None,
     ) -> str:
         """
-        Allows the LLM to add multiple memory entries at once.
+        Report what the background memory maintenance did to your memory files, optionally running a pass over them first.
 
-        :param memory_entries: A list of dictionary entries, each containing tag, memo, by.Usage Example: memory_entries = [{"tag": "personal", "memo": "This is a personal note", "by": "LLM"},{"tag": "work", "memo": "Project deadline is tomorrow", "by": "LLM"}]
-        :param llm_wants_to_add: Boolean indicating LLM's desire to add the memories.
-        :returns: A message indicating the success or failure of the operations.
+        :param run_now: Run a maintenance pass over your memory files before reporting.
+        :returns: Maintenance counters and memory file totals as JSON.
         """
         emitter = EventEmitter(__event_emitter__)
-        responses = []
-
-        if not llm_wants_to_add:
-            return "LLM has not requested to add multiple memories."
+        key = self._user_key(__user__)
+
+        if run_now:
+            await emitter.emit("Running memory maintenance.")
+            await self._maintain_store(key)
+
+        # Only the caller's store: other users' files and totals stay private.
+        async with self._store_session(key) as memory:
+            files = await self.io.run(memory.memory_file_stats)
+            cache = memory.cache_stats()
+        stats = dict(self._maintenance_stats)
+        stats.update(
+            self._store_maintenance.get(
+                key,
+                {"compactions": 0, "rebuilt_indexes": 0, "evictions": 0},
+            )
+        )
+        stats["files"] = len(files)
+        stats["entries"] = sum(file["entries"] for file in files.values())
+        stats["bytes"] = sum(file["bytes"] for file in files.values())
+        stats["cache"] = cache
+        message = json.dumps(stats, ensure_ascii=False)
 
-        for idx, entry in enumerate(memory_entries):
-            tag = entry.get("tag", "others")
-            memo = entry.get("memo", "")
-            by = entry.get("by", "LLM")
+        await emitter.emit(
+            description=f"Memory maintenance: {stats['runs']} runs, last at {stats['last_run']}.",
+            status="maintenance_stats",
+            done=True,
+        )
 
-            if tag not in self.memory.tag_options:
-                tag = "others"
+        return message
 
-            if self.valves.DEBUG:
-                print(f"Adding memory {idx+1}: tag={tag}, memo={memo}, by={by}")
+    async def list_evicted_memories(
+        self, __user__: dict = None, __event_emitter__: Callable[[dict], Any] = None
+    ) -> str:
+        """
+        List the memories of the current file that were evicted by the retention limits and can still be restored.
 
-            # Add the memory
-            self.memory.add_to_memory(tag, memo, by)
-            response = f"Memory {idx+1} added with tag {tag} by {by}."
-            responses.append(response)
+        :returns: The evicted memories with their eviction id, reason and time, as JSON.
+        """
+        emitter = EventEmitter(__event_emitter__)
 
-            await emitter.emit(description=response, status="memory_update", done=False)
+        async with self._memory_session(__user__) as memory:
+            records = await self.io.run(memory.evicted_memories)
+
+        evicted = [
+            {
+                "eviction_id": record["id"],
+                "tag": record["entry"].get("tag"),
+                "memo": record["entry"].get("memo"),
+                "reason": record["reason"],
+                "evicted_at": datetime.datetime.fromtimestamp(
+                    record["evicted_at"]
+                ).strftime("%Y-%m-%d_%H:%M:%S"),
+            }
+            for record in records
+        ]
 
         await emitter.emit(
-            description="All requested memories have been processed.",
-            status="memory_update_complete",
+            description=f"{len(evicted)} evicted memories can be restored.",
+            status="eviction_list",
             done=True,
         )
 
-        return "\n".join(responses)
+        return json.dumps(evicted, ensure_ascii=False)
 
-    async def delete_memory_entry(
+    async def undo_memory_eviction(
         self,
-        index: int,
-        llm_wants_to_delete: bool,
+        eviction_ids: list = None,
+        __user__: dict = None,
         __event_emitter__: Callable[[dict], Any] = None,
     ) -> str:
         """
-        Delete a memory entry based on its index.
+        Restore memories evicted by the retention limits.
 
-        :param index: The index of the memory entry to delete,STARTING FROM 1.
-        :param llm_wants_to_delete: Boolean indicating if the LLM has requested the deletion.
-        :returns: A message indicating the success or failure of the deletion.
+        :param eviction_ids: The eviction ids from list_evicted_memories; leave empty to restore all of them.
+        :returns: A message with the number of restored memories.
         """
         emitter = EventEmitter(__event_emitter__)
 
-        if not llm_wants_to_delete:
-            return "LLM has not requested to delete a memory."
-
-        if self.valves.DEBUG:
-            print(f"Attempting to delete memory at index {index}")
-
-        deletion_message = self.memory.delete_memory_by_index(index)
+        try:
+            async with self._memory_session(__user__) as memory:
+                restored = await self.io.run(
+                    memory.restore_evicted, eviction_ids or None
+                )
+            message = f"Restored {len(restored)} evicted memories."
+            status = "eviction_undone"
+        except Exception as e:
+            message = f"Error restoring evicted memories: {str(e)}"
+            status = "eviction_undo_error"
 
-        await emitter.emit(
-            description=deletion_message, status="memory_deletion", done=True
-        )
+        await emitter.emit(description=message, status=status, done=True)
 
-        return deletion_message
+        return message
 
-    async def delete_multiple_memories(
+    async def create_memory_snapshot(
         self,
-        indices: list,
-        llm_wants_to_delete: bool,
+        label: str = "",
+        __user__: dict = None,
         __event_emitter__: Callable[[dict], Any] = None,
     ) -> str:
         """
-        Delete multiple memory entries based on their indices.
+        Take a snapshot of all memory files that can be restored later; only changes since the last snapshot are stored.
 
-        :param indices: A list of indices of the memory entries to delete,STARTING FROM 1.
-        :param llm_wants_to_delete: Boolean indicating if the LLM has requested the deletions.
-        :returns: A message indicating the success or failure of the deletions.
+        :param label: Optional note describing the snapshot.
+        :returns: The snapshot id and what it contains.
         """
         emitter = EventEmitter(__event_emitter__)
-        responses = []
-
-        if not llm_wants_to_delete:
-            return "LLM has not requested to delete multiple memories."
-
-        for index in indices:
-            if self.valves.DEBUG:
-                print(f"Attempting to delete memory at index {index}")
-
-            deletion_message = self.memory.delete_memory_by_index(index)
-            responses.append(deletion_message)
 
-            await emitter.emit(
-                description=deletion_message, status="memory_deletion", done=False
-            )
+        async with self._memory_session(__user__) as memory:
+            record = await self.io.run(memory.snapshot, label)
 
-        await emitter.emit(
-            description="All requested memory deletions have been processed.",
-            status="memory_deletion_complete",
-            done=True,
+        message = (
+            f"Snapshot {record['id']} taken of {len(record['files'])} memory files "
+            f"({record['objects_written']} new chunks stored)."
         )
+        self.telemetry.log(message)
 
-        return "\n".join(responses)
+        await emitter.emit(description=message, status="snapshot_complete", done=True)
 
-    async def create_or_switch_memory_file(
-        self, new_file_name: str, __event_emitter__: Callable[[dict], Any] = None
+        return message
+
+    async def list_memory_snapshots(
+        self, __user__: dict = None, __event_emitter__: Callable[[dict], Any] = None
     ) -> str:
         """
-        Create a new memory file or switch to an existing one.
+        List the snapshots that memory files can be restored from, oldest first.
 
-        :param new_file_name: The name of the new or existing memory file.
-        :returns: A message indicating the success or failure of the operation.
+        :returns: The snapshots with their ids, times, labels and memory counts per file.
         """
         emitter = EventEmitter(__event_emitter__)
 
-        if self.valves.DEBUG:
-            print(f"Switching to or creating memory file: {new_file_name}")
-
-        self.memory.switch_memory_file(new_file_name + ".json")
-
-        message = f"Memory file switched to {new_file_name}."
+        async with self._memory_session(__user__) as memory:
+            records = await self.io.run(memory.snapshots.list)
+
+        snapshots = [
+            {
+                "id": record["id"],
+                "created": record["created"],
+                "label": record["label"],
+                "files": {
+                    file_name: details["entries"]
+                    for file_name, details in record["files"].items()
+                },
+            }
+            for record in records
+        ]
 
-        await emitter.emit(description=message, status="file_switching", done=True)
+        await emitter.emit(
+            description=f"Found {len(snapshots)} snapshots.",
+            status="snapshot_list",
+            done=True,
+        )
 
-        return message
+        return json.dumps(snapshots, ensure_ascii=False)
 
-    async def list_memory_files(
-        self, __event_emitter__: Callable[[dict], Any] = None
+    async def restore_memory_snapshot(
+        self,
+        snapshot_id: str,
+        file_name: str = None,
+        user_confirmation: bool = False,
+        __user__: dict = None,
+        __event_emitter__: Callable[[dict], Any] = None,
     ) -> str:
         """
-        List available memory files in the designated directory.
+        Restore memory files to the state of an earlier snapshot, replacing their current memories; ask twice the user for confirmation.
 
-        :returns: A message with the list of available memory files.
+        :param snapshot_id: The id of the snapshot, from list_memory_snapshots.
+        :param file_name: Optional single memory file to restore, e.g. "memory.json"; all files of the snapshot otherwise.
+        :param user_confirmation: Boolean indicating user confirmation to restore the snapshot.
+        :returns: A message indicating which files were restored.
         """
         emitter = EventEmitter(__event_emitter__)
-        memory_files = []
-
-        if self.valves.DEBUG:
-            print(f"Listing memory files in directory: {self.memory.directory}")
+        operation = ("restore_memory_snapshot", snapshot_id, file_name or "")
 
         try:
-            for file in os.listdir(self.memory.directory):
-                if file.endswith(".json"):
-                    if self.valves.DEBUG:
-                        print(f"Found memory file: {file}")
-                    memory_files.append(file)
+            async with self._memory_session(__user__) as memory:
+                record = await self.io.run(memory.snapshots.load, snapshot_id)
+                if file_name and file_name not in record["files"]:
+                    raise KeyError(
+                        f"{file_name} is not part of snapshot {snapshot_id}."
+                    )
 
-            description = "Available memory files: " + ", ".join(memory_files)
-            status = "file_listing_complete"
+                pending = self._confirmation_pending(__user__, *operation)
+                if pending and user_confirmation:
+                    backup = None
+                    if self.valves.SNAPSHOT_BEFORE_DESTRUCTIVE:
+                        backup = await self.io.run(
+                            memory.snapshot, f"before restoring {snapshot_id}"
+                        )
+                    restored = await self.io.run(
+                        memory.restore_snapshot,
+                        snapshot_id,
+                        [file_name] if file_name else None,
+                    )
+        except (KeyError, ValueError) as e:
+            message = str(e.args[0]) if e.args else str(e)
+            await emitter.emit(description=message, status="snapshot_error", done=True)
+            return message
 
-        except Exception as e:
-            description = f"Error accessing directory: {str(e)}"
-            status = "file_listing_error"
+        if pending and user_confirmation:
+            message = f"Restored {', '.join(restored)} from snapshot {snapshot_id}."
+            if backup is not None:
+                message += f" The previous state is in snapshot {backup['id']}."
+            self.telemetry.log(message)
+            await emitter.emit(
+                description=message, status="snapshot_restored", done=True
+            )
+            return message
 
-        await emitter.emit(description=description, status=status, done=True)
+        if not pending:
+            self._request_confirmation(__user__, *operation)
+            message = (
+                f"Please confirm that you want to replace the current memories of "
+                f"{file_name or 'every file'} with snapshot {snapshot_id}. "
+                "Call this function again with confirmation."
+            )
+            await emitter.emit(
+                description=message, status="confirmation_required", done=False
+            )
+            return message
 
-        return description
+        message = "Snapshot restore aborted."
+        await emitter.emit(
+            description=message, status="snapshot_restore_aborted", done=True
+        )
+        return message
 
     async def current_memory_file(
-        self, __event_emitter__: Callable[[dict], Any] = None
+        self, __user__: dict = None, __event_emitter__: Callable[[dict], Any] = None
     ) -> str:
         """
         Retrieve the name of the currently active memory file.
@@ -580,12 +5433,12 @@ class Tools:
         """
         emitter = EventEmitter(__event_emitter__)
 
-        current_file = self.memory.memory_file
+        async with self._memory_session(__user__) as memory:
+            current_file = memory.memory_file
 
         message = f"Currently using memory file: {current_file}"
 
-        if self.valves.DEBUG:
-            print(message)
+        self.telemetry.log(message)
 
         await emitter.emit(
             description=message, status="current_file_retrieved", done=True
@@ -597,6 +5450,7 @@ class Tools:
         self,
         file_to_delete: str,
         user_confirmation: bool,
+        __user__: dict = None,
         __event_emitter__: Callable[[dict], Any] = None,
     ) -> str:
         """
@@ -607,136 +5461,295 @@ class Tools:
         :returns: A message indicating the success or failure of the deletion.
         """
         emitter = EventEmitter(__event_emitter__)
-        file_path = os.path.join(self.memory.directory, file_to_delete)
-        available_files = [
-            f for f in os.listdir(self.memory.directory) if f.endswith(".json")
-        ]
 
-        if file_to_delete not in available_files:
-            message = f"File '{file_to_delete}' does not exist in the directory."
-            await emitter.emit(description=message, status="file_not_found", done=True)
-            if self.valves.DEBUG:
-                print(message)
+        try:
+            _check_file_name(file_to_delete)
+        except ValueError as e:
+            message = str(e)
+            await emitter.emit(
+                description=message, status="invalid_file_name", done=True
+            )
             return message
 
-        if self.confirmation_pending and user_confirmation:
-            try:
-                if self.memory.memory_file == file_path:
-                    # Switch to another file before deleting the current one
-                    alternative_file = next(
-                        (f for f in available_files if f != file_to_delete), None
-                    )
-                    if not alternative_file:
-                        message = (
-                            "No alternative memory file to switch to. Deletion aborted."
+        async with self._memory_session(__user__) as memory:
+            file_path = os.path.join(memory.directory, file_to_delete)
+            available_files = await self.io.run(memory.list_memory_files)
+
+            if file_to_delete not in available_files:
+                message = f"File '{file_to_delete}' does not exist in the directory."
+                await emitter.emit(
+                    description=message, status="file_not_found", done=True
+                )
+                self.telemetry.log(message)
+                return message
+
+            pending = self._confirmation_pending(
+                __user__, "delete_memory_file", file_to_delete
+            )
+            if pending and user_confirmation:
+                try:
+                    if memory.memory_file == file_path:
+                        # Switch to another file before deleting the current one
+                        alternative_file = next(
+                            (f for f in available_files if f != file_to_delete), None
                         )
+                        if not alternative_file:
+                            message = "No alternative memory file to switch to. Deletion aborted."
+                            await emitter.emit(
+                                description=message,
+                                status="no_alternative_file",
+                                done=True,
+                            )
+                            self.telemetry.log(message)
+                            return message
+
+                        await self.io.run(memory.switch_memory_file, alternative_file)
+                        switch_message = f"Switched to '{alternative_file}'. Now deleting '{file_to_delete}'."
                         await emitter.emit(
-                            description=message, status="no_alternative_file", done=True
+                            description=switch_message,
+                            status="file_switched",
+                            done=False,
                         )
-                        if self.valves.DEBUG:
-                            print(message)
-                        return message
+                        self.telemetry.log(switch_message)
 
-                    self.memory.switch_memory_file(alternative_file)
-                    switch_message = f"Switched to '{alternative_file}'. Now deleting '{file_to_delete}'."
-                    await emitter.emit(
-                        description=switch_message, status="file_switched", done=False
-                    )
-                    if self.valves.DEBUG:
-                        print(switch_message)
+                    if self.valves.SNAPSHOT_BEFORE_DESTRUCTIVE:
+                        await self.io.run(
+                            memory.snapshot, f"before deleting {file_to_delete}"
+                        )
+                    await self.io.run(memory.delete_memory_file, file_to_delete)
+                    message = f"File '{file_to_delete}' deleted successfully."
+                    status = "file_deletion_complete"
+                except Exception as e:
+                    message = f"Error deleting file '{file_to_delete}': {str(e)}"
+                    status = "deletion_error"
 
-                os.remove(file_path)
-                message = f"File '{file_to_delete}' deleted successfully."
-                status = "file_deletion_complete"
-            except Exception as e:
-                message = f"Error deleting file '{file_to_delete}': {str(e)}"
-                status = "deletion_error"
+                await emitter.emit(description=message, status=status, done=True)
+                return message
 
-            await emitter.emit(description=message, status=status, done=True)
-            self.confirmation_pending = False
-            return message
+            if not pending:
+                self._request_confirmation(
+                    __user__, "delete_memory_file", file_to_delete
+                )
+                confirmation_message = (
+                    "Please confirm that you want to delete the memory file. "
+                    "Call this function again with confirmation."
+                )
+                await emitter.emit(
+                    description=confirmation_message,
+                    status="confirmation_required",
+                    done=False,
+                )
+                return json.dumps(
+                    {
+                        "message": "Please confirm to delete the memory file.",
+                        "file": file_to_delete,
+                    },
+                    ensure_ascii=False,
+                )
 
-        if not self.confirmation_pending:
-            self.confirmation_pending = True
-            confirmation_message = (
-                "Please confirm that you want to delete the memory file. "
-                "Call this function again with confirmation."
-            )
             await emitter.emit(
-                description=confirmation_message,
-                status="confirmation_required",
-                done=False,
+                description="Deletion of memory file aborted.",
+                status="deletion_aborted",
+                done=True,
             )
             return json.dumps(
-                {
-                    "message": "Please confirm to delete the memory file.",
-                    "file": file_to_delete,
-                },
+                {"message": "Memory file deletion aborted.", "file": file_to_delete},
                 ensure_ascii=False,
             )
 
-        await emitter.emit(
-            description="Deletion of memory file aborted.",
-            status="deletion_aborted",
-            done=True,
-        )
-        self.confirmation_pending = False
-        return json.dumps(
-            {"message": "Memory file deletion aborted.", "file": file_to_delete},
-            ensure_ascii=False,
-        )
+    # Tools that only read; the executor does not order them among each other.
+    # Each still holds the store's lock, so reads of one store take turns.
+    _READ_ONLY_TOOLS = frozenset(
+        {
+            "recall_memories",
+            "recall_memories_by_tag",
+            "search_memories",
+            "search_all_memory_files",
+            "recent_memories",
+            "memories_between",
+            "list_memory_files",
+            "current_memory_file",
+            "memory_cache_stats",
+            "list_memory_snapshots",
+            "list_evicted_memories",
+        }
+    )
+    # Changes to the active file that can share one session and one write.
+    _BATCHABLE_TOOLS = frozenset(
+        {
+            "handle_input",
+            "add_multiple_memories",
+            "update_memory_entry",
+            "update_multiple_memories",
+            "delete_memory_entry",
+            "delete_multiple_memories",
+        }
+    )
+
+    def _plan_calls(self, function_calls: list) -> list:
+        """
+        Turn function calls into steps: {"calls": [positions], "after": [step
+        numbers]}, in order. Changes run one after another, each after every
+        earlier call; adjacent batchable ones share a step. A read waits for
+        its depends_on, or else for the last change before it.
+        """
+        positions = {}
+        for position, call in enumerate(function_calls):
+            positions.setdefault(str(position + 1), position)
+        for position, call in enumerate(function_calls):
+            if call.get("id") is not None:
+                positions[str(call["id"])] = position
+
+        steps, step_of, last_change = [], {}, None
+        for position, call in enumerate(function_calls):
+            name = call.get("name")
+            depends_on = call.get("depends_on")
+            if depends_on is not None and not isinstance(depends_on, list):
+                depends_on = [depends_on]
+            after = set()
+            for reference in depends_on or ():
+                target = positions.get(str(reference))
+                if target is None or target >= position:
+                    raise ValueError(
+                        f"Call {position + 1} ({name}) depends on {reference!r}, which is not an earlier call."
+                    )
+                after.add(step_of[target])
+
+            if name in self._READ_ONLY_TOOLS:
+                if depends_on is None and last_change is not None:
+                    after.add(last_change)
+                steps.append({"calls": [position], "after": sorted(after)})
+            elif (
+                name in self._BATCHABLE_TOOLS
+                and last_change == len(steps) - 1
+                and function_calls[steps[-1]["calls"][-1]].get("name")
+                in self._BATCHABLE_TOOLS
+                and all(step <= last_change for step in after)
+            ):
+                steps[-1]["calls"].append(position)
+            else:
+                after.update(range(len(steps)))
+                steps.append({"calls": [position], "after": sorted(after)})
+                last_change = len(steps) - 1
+            step_of[position] = len(steps) - 1
+        return steps
+
+    async def _run_call(
+        self, call: dict, emitter: EventEmitter, started: float, __user__: dict
+    ):
+        func_name = call.get("name")
+        params = call.get("params") or {}
+        outcome = {"name": func_name}
+        if call.get("id") is not None:
+            outcome["id"] = call["id"]
+        begin = time.monotonic()
+        outcome["start_ms"] = round((begin - started) * 1000, 1)
+
+        if (
+            not isinstance(func_name, str)
+            or func_name.startswith("_")
+            or func_name == "execute_functions_sequentially"
+            or not callable(getattr(self, func_name, None))
+        ):
+            outcome["error"] = f"Function {func_name} not found or not callable."
+            await emitter.emit(
+                description=outcome["error"], status="function_missing", done=False
+            )
+        else:
+            self.telemetry.log("Executing function", function=func_name, params=params)
+            await emitter.emit(
+                f"Executing {func_name}", status="function_execution", done=False
+            )
+            try:
+                func = getattr(self, func_name)
+                outcome["result"] = await func(
+                    __user__=__user__, __event_emitter__=emitter.event_emitter, **params
+                )
+                await emitter.emit(
+                    description=f"{func_name} executed successfully.",
+                    status="function_complete",
+                    done=False,
+                )
+            except Exception as e:
+                outcome["error"] = f"Error executing {func_name}: {str(e)}"
+                await emitter.emit(
+                    description=outcome["error"], status="function_error", done=False
+                )
+        outcome["duration_ms"] = round((time.monotonic() - begin) * 1000, 1)
+        return outcome
+
+    async def _run_batch(
+        self, calls: list, emitter: EventEmitter, started: float, __user__: dict
+    ):
+        """
+        Run changes to the active file in one session and one transaction, so
+        they are written to disk once. If that write fails, none is kept.
+        """
+        if len(calls) == 1:
+            return [await self._run_call(calls[0], emitter, started, __user__)]
+        async with self._memory_session(__user__) as memory:
+            transaction = memory.transaction()
+            await self.io.run(transaction.__enter__)
+            try:
+                outcomes = [
+                    await self._run_call(call, emitter, started, __user__)
+                    for call in calls
+                ]
+            except BaseException as e:
+                await self.io.run(transaction.__exit__, type(e), e, e.__traceback__)
+                raise
+            try:
+                await self.io.run(transaction.__exit__, None, None, None)
+            except Exception as e:
+                for outcome in outcomes:
+                    outcome.pop("result", None)
+                    outcome["error"] = f"Changes were not saved: {str(e)}"
+        return outcomes
 
     async def execute_functions_sequentially(
         self,
         function_calls: list,
+        __user__: dict = None,
         __event_emitter__: Callable[[dict], Any] = None,
-    ) -> dict:
+    ) -> str:
         """
-        Execute a series of functions in sequence.
+        Execute a plan of function calls; reads only wait for what they depend on, changes run in the given order and are saved together.
 
-        :param function_calls: A list of dictionaries each containing 'name' and 'params'.
-                               Example: [{'name': 'handle_input', 'params': {...}}, ...]
-        :returns: A dictionary with results of each function call.
+        :param function_calls: A list of dictionaries each containing 'name' and 'params', and optionally an 'id' and 'depends_on' (ids or 1-based positions of earlier calls that must finish first).
+                               Example: [{'name': 'handle_input', 'params': {...}}, {'name': 'search_memories', 'params': {...}, 'depends_on': [1]}, ...]
+        :returns: The result of every call, in the given order, with its start time and duration in milliseconds.
         """
         emitter = EventEmitter(__event_emitter__)
-        results = {}
+        started = time.monotonic()
 
-        for call in function_calls:
-            func_name = call.get("name")
-            params = call.get("params", {})
-
-            if hasattr(self, func_name) and callable(getattr(self, func_name)):
-                if self.valves.DEBUG:
-                    print(f"Executing function: {func_name} with params: {params}")
+        try:
+            steps = self._plan_calls(function_calls)
+        except ValueError as e:
+            await emitter.emit(description=str(e), status="function_error", done=True)
+            return str(e)
 
-                await emitter.emit(
-                    f"Executing {func_name}", status="function_execution", done=False
-                )
+        results = [None] * len(function_calls)
+        done = [asyncio.get_running_loop().create_future() for _ in steps]
 
+        async def run_step(number: int, step: dict):
+            try:
+                await asyncio.gather(*(done[after] for after in step["after"]))
+                calls = [function_calls[position] for position in step["calls"]]
                 try:
-                    func = getattr(self, func_name)
-                    result = await func(__event_emitter__=__event_emitter__, **params)
-                    results[func_name] = result
-
-                    await emitter.emit(
-                        description=f"{func_name} executed successfully.",
-                        status="function_complete",
-                        done=False,
-                    )
+                    outcomes = await self._run_batch(calls, emitter, started, __user__)
                 except Exception as e:
-                    error_msg = f"Error executing {func_name}: {str(e)}"
-                    results[func_name] = error_msg
-
-                    await emitter.emit(
-                        description=error_msg, status="function_error", done=False
-                    )
-            else:
-                error_msg = f"Function {func_name} not found or not callable."
-                results[func_name] = error_msg
-
-                await emitter.emit(
-                    description=error_msg, status="function_missing", done=False
-                )
+                    outcomes = [
+                        {"name": call.get("name"), "error": f"Error: {str(e)}"}
+                        for call in calls
+                    ]
+                for position, outcome in zip(step["calls"], outcomes):
+                    results[position] = outcome
+            finally:
+                done[number].set_result(None)
+
+        await asyncio.gather(
+            *(run_step(number, step) for number, step in enumerate(steps))
+        )
 
         await emitter.emit(
             description="All requested functions have been processed.",
@@ -744,96 +5757,136 @@ class Tools:
             done=True,
         )
 
-        return f"executed successfully :{results}"
+        return f"executed successfully :{json.dumps(results, ensure_ascii=False)}"
 
     async def download_memory(
         self,
         memory_file_name: str,
         download_all: bool,
+        __user__: dict = None,
         __event_emitter__: Callable[[dict], Any] = None,
     ) -> str:
         """
-        Download a specific memory file or all memory files in a tarball;ONLY FOR 14 SECONDS, AND WHEN LLM ANSWERS THE LINK IS EXPIRED
+        Download a specific memory file or all memory files in a tarball; give the user the returned link, which works for a limited time.
 
         :param memory_file_name: Name of the memory file or target tarball name.
         :param download_all: Boolean indicating whether to download all memories as a tarball.
         :returns: A message with a link or status of the operation.
         """
         emitter = EventEmitter(__event_emitter__)
-        available_files = os.listdir(self.memory.directory)
         found_files = []
 
-        if download_all:
-            tarball_path = os.path.join(self.memory.directory, "all_memories.tar.gz")
-            with tarfile.open(tarball_path, "w:gz") as tar:
-                for file in available_files:
-                    if file.endswith(".json"):
-                        tar.add(os.path.join(self.memory.directory, file), arcname=file)
-                        found_files.append(file)
-
-            target_file = tarball_path
-        else:
-            file_path = os.path.join(self.memory.directory, memory_file_name)
-            if memory_file_name in available_files:
-                target_file = file_path
-                found_files.append(memory_file_name)
+        if not download_all:
+            try:
+                # Also a partial name, e.g. "work" for "work.json".
+                _check_file_name(memory_file_name.removesuffix(".json") + ".json")
+            except (ValueError, AttributeError):
+                message = f"Invalid memory file name: {memory_file_name!r}"
+                await emitter.emit(
+                    description=message, status="invalid_file_name", done=True
+                )
+                return message
+
+        async with self._memory_session(__user__) as memory:
+            available_files = await self.io.run(memory.list_memory_files)
+            if download_all:
+                download_name = "all_memories.tar.gz"
+                found_files.extend(available_files)
             else:
-                matched = sorted(f for f in available_files if memory_file_name in f)
-                if matched:
-                    target_file = os.path.join(self.memory.directory, matched[0])
-                    found_files.append(matched[0])
-                else:
-                    message = f"No memory file matching '{memory_file_name}' was found."
-                    await emitter.emit(
-                        description=message, status="file_not_found", done=True
+                matched = (
+                    [memory_file_name] if memory_file_name in available_files else []
+                )
+                if not matched:
+                    matched = sorted(
+                        f for f in available_files if memory_file_name in f
                     )
-                    if self.valves.DEBUG:
-                        print(message)
-                    return message
+                if matched:
+                    download_name = matched[0]
+                    found_files.append(download_name)
+            # The download is served after this session ends, so the sets in
+            # memory are copied while their lock is held.
+            copy = await self.io.run(memory.export_copy, found_files)
+            copied = await self.io.run(memory.export_signature, found_files)
+
+        if download_all:
+            # The archive is compressed while it is being sent; nothing is
+            # staged on disk.
+            chunks = functools.partial(
+                memory.stream_tarball, found_files, int(time.time()), copy
+            )
+        else:
+            # Serve a JSON export, which works for every storage backend.
+            chunks = lambda: [memory.export_memory_file(download_name, copy)]
+        # The copies never change; the files read from disk when the link is
+        # used may have.
+        stored_files = [
+            file_name for file_name in found_files if copy[file_name] is None
+        ]
+        etag = lambda: copied + memory.export_signature(stored_files)
+
+        if not download_all and not found_files:
+            message = f"No memory file matching '{memory_file_name}' was found."
+            await emitter.emit(description=message, status="file_not_found", done=True)
+            self.telemetry.log(message)
+            return message
 
         if not found_files:
             message = "No files were found to download."
             await emitter.emit(description=message, status="not_found", done=True)
-            if self.valves.DEBUG:
-                print(message)
+            self.telemetry.log(message)
             return message
 
-        httpd = None
         try:
-            handler = SimpleHTTPRequestHandler
-            handler.directory = self.memory.directory
-            httpd = TCPServer(("", 0), handler)
-            ip, port = httpd.server_address
-            server_url = f"http://{ip}:{port}/{target_file}"
-
-            # Start the server in a new thread
-            server_thread = threading.Thread(target=httpd.serve_forever, daemon=True)
-            server_thread.start()
-
-            message = f"Download available for 14 seconds in this link: {server_url}"
-            await emitter.emit(description=message, status="download", done=True)
-            if self.valves.DEBUG:
-                print(message)
-
-            # Give the user time to download
-            await asyncio.sleep(14)
-            return "TELL THE USER THAT LINK IS EXPIRED AND YOU SHOULD HAVE DOWNLOADED FILES!"
+            server = await self._download_server()
+            path = server.register(download_name, chunks, etag)
+            server_url = self._download_url(server) + path
         except Exception as e:
             message = f"Error setting up download server: {str(e)}"
             await emitter.emit(description=message, status="download_error", done=True)
-            if self.valves.DEBUG:
-                print(message)
-        finally:
-            if httpd:
-                httpd.shutdown()  # Ensure server is shut down
-            if os.path.exists(target_file):
-                os.remove(target_file)  # Delete the file after the server is shut down
-                if self.valves.DEBUG:
-                    await emitter.emit(
-                        description="file deleted sucessfully",
-                        status=f"Deleted file: {target_file}",
-                        done=True,
-                    )
-                    print(f"Deleted file: {target_file}")
+            self.telemetry.log(message)
+            return message
+
+        minutes = max(1, round(self.valves.DOWNLOAD_LINK_TTL / 60))
+        message = f"Download available for {minutes} minutes in this link: {server_url}"
+        if self.valves.DOWNLOAD_SINGLE_USE:
+            message += " (it works for one download only)"
+        await emitter.emit(description=message, status="download", done=True)
+        self.telemetry.log(message)
         return message
 
+
+def _traced_tool(method: Callable) -> Callable:
+    """
+    Run a tool method in a "tool.<name>" span, with a span around each call it
+    makes to __event_emitter__. functools.wraps keeps the signature and docstring
+    Open WebUI builds the tool spec from.
+    """
+    name = "tool." + method.__name__
+
+    @functools.wraps(method)
+    async def traced(self, *args, **kwargs):
+        self._configure_telemetry()
+        telemetry = self.telemetry
+        if not telemetry.sinks:
+            return await method(self, *args, **kwargs)
+        event_emitter = kwargs.get("__event_emitter__")
+        if event_emitter is not None:
+            kwargs["__event_emitter__"] = _traced_emitter(telemetry, event_emitter)
+        with telemetry.span(name):
+            return await method(self, *args, **kwargs)
+
+    return traced
+
+
+def _traced_emitter(telemetry: MemoryTelemetry, event_emitter: Callable) -> Callable:
+    async def traced(event: dict):
+        with telemetry.span("emitter", status=event.get("data", {}).get("status")):
+            return await event_emitter(event)
+
+    return traced
+
+
+# Every public coroutine of Tools is a tool Open WebUI offers to the LLM.
+for _name, _method in list(vars(Tools).items()):
+    if not _name.startswith("_") and inspect.iscoroutinefunction(_method):
+        setattr(Tools, _name, _traced_tool(_method))
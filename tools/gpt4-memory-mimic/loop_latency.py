@@ -0,0 +1,134 @@
+"""
+Event loop responsiveness while a large memory file is loaded or saved on
+MemoryIO's thread pool, against the same work run on the loop itself.
+
+A heartbeat task sleeps for --interval milliseconds over and over and records
+how late it wakes up; that lag is what every other request served by the same
+Open WebUI process waits on top of its own work. Results are printed as JSON:
+
+    python loop_latency.py --sizes 10000,100000
+    python loop_latency.py --sizes 1000000 --backend binary --repeat 1
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+
+from benchmark import generate_memory_file, git_commit, load_tool_module, percentile
+
+
+async def heartbeat(interval: float, lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - expected) * 1000)
+
+
+async def measure(operation, io, offload: bool, interval: float) -> dict:
+    """Run operation once, on io or inline, while the heartbeat runs."""
+    lags = []
+    stop = asyncio.Event()
+    beating = asyncio.create_task(heartbeat(interval, lags, stop))
+    # Let the heartbeat settle before the work starts.
+    await asyncio.sleep(interval * 5)
+    started = time.perf_counter()
+    if offload:
+        await io.run(operation)
+    else:
+        operation()
+    duration = time.perf_counter() - started
+    stop.set()
+    await beating
+    return {
+        "operation_ms": round(duration * 1000, 3),
+        "heartbeats": len(lags),
+        "lag_p50_ms": round(percentile(lags, 0.5), 3),
+        "lag_p99_ms": round(percentile(lags, 0.99), 3),
+        "lag_max_ms": round(max(lags), 3),
+    }
+
+
+def operations(module, backend: str, directory: str) -> dict:
+    """The blocking work to measure, each a callable without arguments."""
+    memory = module.MemoryFunctions(directory=directory, backend=backend)
+
+    def load():
+        module.MemoryFunctions(directory=directory, backend=backend).close()
+
+    def save():
+        memory.save_memory()
+
+    return {"load": load, "save": save}, memory
+
+
+async def measure_size(module, backend: str, size: int, repeat: int, interval):
+    results = {}
+    io = module.MemoryIO()
+    with tempfile.TemporaryDirectory() as directory:
+        generate_memory_file(
+            module, backend, os.path.join(directory, "memory.json"), size, 0
+        )
+        work, memory = operations(module, backend, directory)
+        for name, operation in work.items():
+            for mode, offload in (("memory_io", True), ("inline", False)):
+                runs = [
+                    await measure(operation, io, offload, interval)
+                    for _ in range(repeat)
+                ]
+                # The run with the worst stall, as that is what users notice.
+                results[f"{name}_{mode}"] = max(runs, key=lambda run: run["lag_max_ms"])
+        memory.close()
+    io.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000", help="Comma-separated.")
+    parser.add_argument(
+        "--backend", default="json", choices=["json", "binary", "sqlite"]
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per operation.")
+    parser.add_argument(
+        "--interval", type=float, default=5, help="Heartbeat period in ms."
+    )
+    parser.add_argument("--output", help="Write the JSON here instead of stdout.")
+    arguments = parser.parse_args()
+
+    module = load_tool_module()
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": arguments.backend,
+        "interval_ms": arguments.interval,
+        "switch_interval_ms": sys.getswitchinterval() * 1000,
+        "results": {},
+    }
+    for size in (int(size) for size in arguments.sizes.split(",")):
+        report["results"][str(size)] = asyncio.run(
+            measure_size(
+                module,
+                arguments.backend,
+                size,
+                arguments.repeat,
+                arguments.interval / 1000,
+            )
+        )
+        print(f"Finished {size} entries.", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
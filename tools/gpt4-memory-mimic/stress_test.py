@@ -0,0 +1,125 @@
+"""
+Multi-process stress test for the memory tool: several processes (as with
+several uvicorn workers) add memories to the same memory file at once, then
+the file is read back and checked for lost and duplicated memories.
+
+Runs every storage backend, and JSON both with a journal that stays below the
+compaction threshold and with one that is compacted over and over while the
+others keep appending. Exits with status 1 if any scenario loses or repeats a
+memory:
+
+    python stress_test.py --processes 8 --memories 200
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+from benchmark import load_tool_module, synthetic_memo
+
+# name -> MemoryFunctions options.
+SCENARIOS = {
+    "json": {"backend": "json"},
+    "json-compacting": {"backend": "json", "compact_threshold": 4096},
+    "binary": {"backend": "binary", "compact_threshold": 4096},
+    "sqlite": {"backend": "sqlite"},
+}
+NOTE = re.compile(r"\(note (\d+)\)\.$")
+
+
+def worker(directory: str, options: dict, number: int, memories: int, barrier):
+    """Add memories numbered number * memories onwards, one call at a time."""
+    module = load_tool_module()
+    memory = module.MemoryFunctions(
+        memory_file="stress.json", directory=directory, **options
+    )
+    rng = random.Random(number)
+    barrier.wait()
+    for offset in range(memories):
+        memo = synthetic_memo(rng, number * memories + offset)
+        memory.add_to_memory("work", memo, f"worker {number}")
+    memory.close()
+
+
+def run_scenario(options: dict, processes: int, memories: int) -> dict:
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        barrier = context.Barrier(processes)
+        workers = [
+            context.Process(
+                target=worker, args=(directory, options, number, memories, barrier)
+            )
+            for number in range(processes)
+        ]
+        started = time.perf_counter()
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        elapsed = time.perf_counter() - started
+
+        # Read the result the way a new process would.
+        module = load_tool_module()
+        memory = module.MemoryFunctions(
+            memory_file="stress.json", directory=directory, **options
+        )
+        notes = []
+        for entry in memory.memory_data.values():
+            match = NOTE.search(entry.get("memo", ""))
+            notes.append(int(match.group(1)) if match else None)
+        next_id = memory.storage.next_id
+        highest_id = max(memory.memory_data, default=0)
+        memory.close()
+
+    expected = set(range(processes * memories))
+    seen = set(notes)
+    return {
+        "seconds": round(elapsed, 3),
+        "entries": len(notes),
+        "expected": len(expected),
+        "lost": len(expected - seen),
+        "duplicated": len(notes) - len(seen),
+        "unexpected": len(seen - expected),
+        "failed_workers": sum(process.exitcode != 0 for process in workers),
+        # A later add must never reuse the id of a memory that is already there.
+        "next_id_ok": next_id > highest_id,
+    }
+
+
+def passed(result: dict) -> bool:
+    return (
+        result["lost"] == result["duplicated"] == result["unexpected"] == 0
+        and result["failed_workers"] == 0
+        and result["next_id_ok"]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--memories", type=int, default=200, help="Per process.")
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(SCENARIOS),
+        help="Comma-separated, from: " + ", ".join(SCENARIOS),
+    )
+    arguments = parser.parse_args()
+
+    results = {}
+    for name in arguments.scenarios.split(","):
+        results[name] = run_scenario(
+            SCENARIOS[name], arguments.processes, arguments.memories
+        )
+        results[name]["passed"] = passed(results[name])
+        print(f"Finished {name}.", file=sys.stderr)
+    print(json.dumps(results, indent=2))
+    sys.exit(0 if all(result["passed"] for result in results.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()